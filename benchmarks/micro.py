@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""Micro benchmarks for the wire protocol.
+
+    python -m benchmarks.micro                      # run everything
+    python -m benchmarks.micro -k bitfield          # only matching cases
+    python -m benchmarks.micro --save               # store a new baseline
+    python -m benchmarks.micro --compare            # flag regressions
+
+Every case reports the best time per call out of several repeats, which
+is the figure least disturbed by other load on the machine.
+"""
+
+import os
+import sys
+import json
+import random
+import timeit
+import asyncio
+from types import SimpleNamespace
+from collections import OrderedDict
+
+import click
+
+from bt.bitfield import Bitfield
+from bt.mixins import DispatchMixin
+from bt.message import (REQUEST_SIZE,
+                        decode_message,
+                        HandshakeMessage,
+                        BitFieldMessage,
+                        HaveMessage,
+                        RequestMessage,
+                        PieceMessage,
+                        CancelMessage,
+                        InterestedMessage)
+from bt.peers import (decode_compact, decode_compact6, encode_compact,
+                      encode_compact6)
+from bt.protocol import PeerStreamIterator
+from bt.transport import PeerProtocol
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'micro.json')
+
+CASES = OrderedDict()
+
+MB = 1024 * 1024
+
+
+def benchmark(name):
+    """Register a case. The decorated function does the setup and returns
+    the callable which is timed.
+    """
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+
+class ChunkReader:
+    """Stand-in for `asyncio.StreamReader` replaying a byte stream in the
+    given chunks.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+        self.offset = 0
+
+    async def read(self, n=-1):
+        if self.offset >= len(self.pending):
+            self.pending, self.offset = next(self.chunks, b''), 0
+        end = len(self.pending) if n < 0 else self.offset + n
+        data = self.pending[self.offset:end]
+        self.offset += len(data)
+        return data
+
+
+def random_chunks(data, seed=0, low=1, high=32 * 1024):
+    """Split `data` at random boundaries, like reads from a socket."""
+    rnd = random.Random(seed)
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rnd.randint(low, high)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def mixed_stream(pieces=64, seed=0):
+    """Pipelined traffic as seen by a downloader: mostly Piece messages
+    interleaved with Have and the occasional control message.
+    """
+    rnd = random.Random(seed)
+    block = bytes(REQUEST_SIZE)
+    messages = []
+    for i in range(pieces):
+        messages.append(PieceMessage(i, 0, block).encode())
+        messages.append(HaveMessage(rnd.randrange(10000)).encode())
+        if i % 8 == 0:
+            messages.append(InterestedMessage().encode())
+    return b''.join(messages)
+
+
+def drain(chunks):
+    """Parse every message of a chunked stream through
+    `PeerStreamIterator`.
+    """
+    async def consume():
+        count = 0
+        async for _ in PeerStreamIterator(ChunkReader(chunks)):
+            count += 1
+        return count
+    return consume
+
+
+# Messages
+
+@benchmark('handshake.encode')
+def handshake_encode():
+    message = HandshakeMessage(b'i' * 20, b'p' * 20)
+    return message.encode
+
+
+@benchmark('handshake.decode')
+def handshake_decode():
+    data = HandshakeMessage(b'i' * 20, b'p' * 20).encode()
+    return lambda: HandshakeMessage.decode(data)
+
+
+@benchmark('have.encode')
+def have_encode():
+    return HaveMessage(1234).encode
+
+
+@benchmark('have.decode')
+def have_decode():
+    data = HaveMessage(1234).encode()
+    return lambda: HaveMessage.decode(data)
+
+
+@benchmark('request.encode')
+def request_encode():
+    return RequestMessage(1234, 5 * REQUEST_SIZE).encode
+
+
+@benchmark('request.decode')
+def request_decode():
+    data = RequestMessage(1234, 5 * REQUEST_SIZE).encode()
+    return lambda: RequestMessage.decode(data)
+
+
+@benchmark('cancel.encode')
+def cancel_encode():
+    return CancelMessage(1234, 5 * REQUEST_SIZE, REQUEST_SIZE).encode
+
+
+@benchmark('cancel.decode')
+def cancel_decode():
+    data = CancelMessage(1234, 5 * REQUEST_SIZE, REQUEST_SIZE).encode()
+    return lambda: CancelMessage.decode(data)
+
+
+@benchmark('piece.encode')
+def piece_encode():
+    return PieceMessage(1234, 0, bytes(REQUEST_SIZE)).encode
+
+
+@benchmark('piece.decode')
+def piece_decode():
+    data = PieceMessage(1234, 0, bytes(REQUEST_SIZE)).encode()
+    return lambda: PieceMessage.decode(data)
+
+
+# Bitfields
+
+def make_bitfield(flags):
+    bitfield = Bitfield(len(flags))
+    for index, flag in enumerate(flags):
+        if flag:
+            bitfield[index] = 1
+    return bitfield
+
+
+def bitfield_cases(pieces):
+    rnd = random.Random(pieces)
+    flags = [rnd.random() < 0.5 for _ in range(pieces)]
+    indexes = [rnd.randrange(pieces) for _ in range(1000)]
+
+    @benchmark('bitfield.{}.encode'.format(pieces))
+    def encode():
+        return BitFieldMessage(make_bitfield(flags)).encode
+
+    @benchmark('bitfield.{}.decode'.format(pieces))
+    def decode():
+        data = BitFieldMessage(make_bitfield(flags)).encode()
+        return lambda: BitFieldMessage.decode(data)
+
+    @benchmark('bitfield.{}.test_1000'.format(pieces))
+    def test():
+        bitfield = make_bitfield(flags)
+
+        def run():
+            for index in indexes:
+                bitfield[index]
+        return run
+
+    @benchmark('bitfield.{}.set_1000'.format(pieces))
+    def set_():
+        bitfield = make_bitfield(flags)
+
+        def run():
+            for index in indexes:
+                bitfield[index] = 1
+        return run
+
+    @benchmark('bitfield.{}.count'.format(pieces))
+    def count():
+        bitfield = make_bitfield(flags)
+        return bitfield.count
+
+    @benchmark('bitfield.{}.and'.format(pieces))
+    def and_():
+        ours = make_bitfield(flags)
+        theirs = make_bitfield(list(reversed(flags)))
+        return lambda: ours & theirs
+
+    @benchmark('bitfield.{}.pick'.format(pieces))
+    def pick():
+        # Piece picker step: first piece the peer has which is missing
+        theirs = make_bitfield(flags)
+        missing = make_bitfield(list(reversed(flags)))
+        return lambda: (theirs & missing).first()
+
+
+bitfield_cases(10000)
+bitfield_cases(100000)
+
+
+# Peer lists of tracker responses and PEX messages
+
+@benchmark('peers.decode_compact_200')
+def peers_decode_compact():
+    data = encode_compact(('10.0.{}.{}'.format(i // 256, i % 256), 6881)
+                          for i in range(200))
+    return lambda: decode_compact(data)
+
+
+@benchmark('peers.decode_compact6_200')
+def peers_decode_compact6():
+    data = encode_compact6(('2001:db8::{:x}'.format(i), 6881)
+                           for i in range(200))
+    return lambda: decode_compact6(data)
+
+
+# Codec and dispatch
+
+def control_messages():
+    return [HaveMessage(1), InterestedMessage(), RequestMessage(1, 0),
+            CancelMessage(1, 0, 1), HaveMessage(2)] * 200
+
+
+@benchmark('codec.decode_1000')
+def codec_decode():
+    frames = [message.encode() for message in control_messages()]
+
+    def run():
+        for frame in frames:
+            decode_message(frame)
+    return run
+
+
+@benchmark('dispatch.handlers_1000')
+def dispatch_handlers():
+    messages = control_messages()
+    dispatcher = DispatchMixin()
+    for cls in (HaveMessage, InterestedMessage, RequestMessage,
+                CancelMessage):
+        dispatcher.register_handler(cls, lambda message: None)
+
+    def run():
+        for message in messages:
+            dispatcher.dispatch(message)
+    return run
+
+
+# Framing
+
+@benchmark('framing.mixed_1mb')
+def framing_mixed():
+    loop = asyncio.new_event_loop()
+    chunks = random_chunks(mixed_stream(pieces=64))
+    return lambda: loop.run_until_complete(drain(chunks)())
+
+
+@benchmark('framing.small_chunks_256k')
+def framing_small_chunks():
+    loop = asyncio.new_event_loop()
+    chunks = random_chunks(mixed_stream(pieces=16), low=1, high=1500)
+    return lambda: loop.run_until_complete(drain(chunks)())
+
+
+@benchmark('framing.control_1000')
+def framing_control():
+    # Small messages only, dominated by per message decode and dispatch
+    loop = asyncio.new_event_loop()
+    messages = [HaveMessage(1).encode(), InterestedMessage().encode(),
+                RequestMessage(1, 0).encode(), CancelMessage(1, 0, 1).encode(),
+                HaveMessage(2).encode()]
+    chunks = random_chunks(b''.join(messages * 200), high=4096)
+    return lambda: loop.run_until_complete(drain(chunks)())
+
+
+@benchmark('framing.burst_8mb')
+def framing_burst():
+    # A burst of pipelined blocks arriving faster than we parse them, so
+    # every read returns as much as it asks for.
+    loop = asyncio.new_event_loop()
+    data = b''.join(PieceMessage(i, 0, bytes(REQUEST_SIZE)).encode()
+                    for i in range(512))
+    chunks = [data[i:i + MB] for i in range(0, len(data), MB)]
+    return lambda: loop.run_until_complete(drain(chunks)())
+
+
+# Transports: receive a burst of blocks and copy each into a piece buffer
+
+class PieceSink:
+    def __init__(self):
+        self.piece = bytearray(REQUEST_SIZE)
+        # The protocol caps messages at the bitfield size of the torrent
+        self.download_manager = SimpleNamespace(total_pieces=512)
+
+    def handshake_received(self, message):
+        pass
+
+    def message_received(self, message):
+        self.piece[:len(message.block)] = message.block
+
+    def messages_processed(self):
+        pass
+
+
+def piece_burst(count=512):
+    return b''.join(PieceMessage(i, 0, bytes(REQUEST_SIZE)).encode()
+                    for i in range(count))
+
+
+@benchmark('transport.stream_8mb')
+def transport_stream():
+    loop = asyncio.new_event_loop()
+    data = piece_burst()
+    chunks = [data[i:i + MB] for i in range(0, len(data), MB)]
+    sink = PieceSink()
+
+    async def consume():
+        async for message in PeerStreamIterator(ChunkReader(chunks)):
+            sink.message_received(message)
+    return lambda: loop.run_until_complete(consume())
+
+
+@benchmark('transport.buffered_8mb')
+def transport_buffered():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    data = memoryview(piece_burst())
+    read_size = PeerStreamIterator.CHUNK_SIZE
+
+    def run():
+        protocol = PeerProtocol(PieceSink())
+        protocol.expect_handshake = False
+        offset = 0
+        while offset < len(data):
+            target = protocol.get_buffer(read_size)
+            size = min(len(target), read_size, len(data) - offset)
+            # Stands in for the recv_into done by the event loop
+            target[:size] = data[offset:offset + size]
+            offset += size
+            protocol.buffer_updated(size)
+    return run
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Best seconds per call of `func`."""
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        number *= 10
+    best = min([elapsed] + timer.repeat(repeat=repeat - 1, number=number))
+    return best / number
+
+
+def run(pattern=None, repeat=5):
+    results = OrderedDict()
+    for name, case in CASES.items():
+        if pattern and pattern not in name:
+            continue
+        results[name] = measure(case(), repeat=repeat)
+        click.echo('{:<32} {}'.format(name, format_time(results[name])))
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:>10.2f} {}'.format(seconds / scale, unit)
+    return '{:>10.2f} ns'.format(seconds / 1e-9)
+
+
+def compare(results, baseline, threshold):
+    """Print the change against `baseline` and return the names of the
+    cases that are slower by more than `threshold`.
+    """
+    regressions = []
+    click.echo('')
+    for name, seconds in results.items():
+        if name not in baseline:
+            click.echo('{:<32} {:>10}'.format(name, 'new'))
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        click.echo('{:<32} {:>+9.1f}%{}'.format(name, change * 100, flag))
+    return regressions
+
+
+@click.command()
+@click.option('-k', 'pattern', default=None,
+              help='Only run cases containing this string')
+@click.option('--repeat', default=5, help='Repeats per case')
+@click.option('--save', is_flag=True, help='Store results as baseline')
+@click.option('--compare', 'do_compare', is_flag=True,
+              help='Compare results with the baseline')
+@click.option('--threshold', default=0.2,
+              help='Relative slowdown reported as a regression')
+@click.option('--baseline', default=BASELINE, help='Baseline file')
+def main(pattern, repeat, save, do_compare, threshold, baseline):
+    results = run(pattern, repeat=repeat)
+
+    if do_compare:
+        with open(baseline) as f:
+            stored = json.load(f)
+        regressions = compare(results, stored, threshold)
+        if regressions:
+            click.echo('\n{} regression(s): {}'.format(
+                len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+    if save:
+        stored = OrderedDict()
+        if os.path.exists(baseline):
+            with open(baseline) as f:
+                stored.update(json.load(f))
+        stored.update(results)
+        os.makedirs(os.path.dirname(baseline), exist_ok=True)
+        with open(baseline, 'w') as f:
+            json.dump(stored, f, indent=2)
+            f.write('\n')
+        click.echo('\nBaseline saved to {}'.format(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Seeding benchmark, the upload side of `bt.server` on its own.
+
+Raw leechers keep `--depth` requests outstanding each and only count the
+bytes they receive, so nearly all the measured CPU is spent serving.
+
+    python -m benchmarks.seeding --size=256 --connections=4 [--no-sendfile]
+    python -m benchmarks.seeding --workers=4 --connections=16
+
+With `--workers` the seeder runs as a `WorkerPool` and the CPU includes the
+workers' own.
+"""
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from collections import namedtuple
+
+import click
+
+from bt import get_logger, parse, run_server
+from bt.cache import PieceCache
+from bt.workers import WorkerPool
+from bt.message import (HANDSHAKE,
+                        LENGTH,
+                        MessageID,
+                        HandshakeMessage,
+                        InterestedMessage,
+                        RequestMessage)
+
+from .swarm import MB, make_payload, make_torrent, peak_rss_mb
+
+
+BLOCK_SIZE = 2 ** 14
+
+SeedingResult = namedtuple('SeedingResult', [
+    'size', 'seconds', 'mb_per_s', 'cpu_seconds', 'cpu_per_gb',
+    'peak_rss_mb', 'cache_hit_rate'])
+
+
+class Leecher(asyncio.BufferedProtocol):
+    """Requests `blocks` blocks round robin over the torrent and frames the
+    replies just enough to count the pieces.
+    """
+
+    def __init__(self, torrent, blocks, depth):
+        self.torrent = torrent
+        self.blocks = blocks
+        self.depth = depth
+        self.buffer = memoryview(bytearray(256 * 1024))
+        self.transport = None
+        self.requested = 0
+        self.received = 0
+        # Bytes left of the handshake or of the current message payload
+        self.skip = HANDSHAKE.size
+        self.header = bytearray()
+        self.message_id = None
+        self.done = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(HandshakeMessage(self.torrent.hash,
+                                         b'-BENCH-' + b'0' * 13).encode() +
+                        InterestedMessage().encode())
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        data = self.buffer
+        pos = 0
+        while pos < nbytes:
+            if self.skip:
+                take = min(self.skip, nbytes - pos)
+                self.skip -= take
+                pos += take
+                if not self.skip:
+                    self.message_done()
+                continue
+            # Length prefix and message id
+            need = LENGTH.size + 1 - len(self.header)
+            self.header += data[pos:pos + need]
+            pos += min(need, nbytes - pos)
+            if len(self.header) == LENGTH.size and \
+                    LENGTH.unpack(self.header)[0] == 0:
+                self.header.clear()
+            elif len(self.header) == LENGTH.size + 1:
+                self.skip = LENGTH.unpack_from(self.header)[0] - 1
+                self.message_id = self.header[LENGTH.size]
+                self.header.clear()
+                if not self.skip:
+                    self.message_done()
+
+    def message_done(self):
+        if self.message_id == MessageID.Unchoke.value:
+            self.request()
+        elif self.message_id == MessageID.Piece.value:
+            self.received += 1
+            if self.received == self.blocks:
+                self.done.set_result(None)
+                self.transport.close()
+            else:
+                self.request()
+        self.message_id = None
+
+    def request(self):
+        info = self.torrent.info
+        blocks_per_piece = info.piece_length // BLOCK_SIZE
+        total = info.length // BLOCK_SIZE
+        messages = []
+        while self.requested < self.blocks and \
+                self.requested - self.received < self.depth:
+            block = self.requested % total
+            messages.append(RequestMessage(
+                block // blocks_per_piece,
+                block % blocks_per_piece * BLOCK_SIZE,
+                BLOCK_SIZE).encode())
+            self.requested += 1
+        if messages:
+            self.transport.write(b''.join(messages))
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_exception(
+                ConnectionError('Seeder closed the connection'))
+
+
+async def run(workdir, size, piece_length, connections, depth, sendfile,
+              cache_size=PieceCache.CAPACITY, workers=0):
+    payload = make_payload(os.path.join(workdir, 'payload.bin'), size)
+    torrent_path = make_torrent(payload, 'http://127.0.0.1/announce',
+                                piece_length=piece_length,
+                                path=os.path.join(workdir, 'seed.torrent'))
+    torrent = parse(torrent_path)
+    pool = server = None
+    if workers:
+        # Slots are per worker, connections spread over the workers
+        pool = WorkerPool(torrent_path, workers, host='127.0.0.1',
+                          path=payload, slots=connections, sendfile=sendfile,
+                          cache_size=cache_size).start()
+        port = pool.port
+    else:
+        server = await run_server(port=0, torrent=torrent, path=payload,
+                                  slots=connections, sendfile=sendfile,
+                                  cache_size=cache_size)
+        port = server.sockets[0].getsockname()[1]
+    loop = asyncio.get_event_loop()
+    blocks = size // BLOCK_SIZE
+    cache = PieceCache.stats.copy()
+    try:
+        started = time.monotonic()
+        cpu = time.process_time()
+        before = pool.stats() if pool else None
+        leechers = []
+        for _ in range(connections):
+            _, leecher = await loop.create_connection(
+                lambda: Leecher(torrent, blocks, depth), '127.0.0.1', port)
+            leechers.append(leecher)
+        await asyncio.gather(*(leecher.done for leecher in leechers))
+        cpu = time.process_time() - cpu
+        seconds = time.monotonic() - started
+    finally:
+        if pool:
+            pool.stop()
+        else:
+            server.close()
+            await server.wait_closed()
+
+    served = blocks * BLOCK_SIZE * connections
+    cache = PieceCache.stats - cache
+    if pool:
+        after = pool.stats()
+        cpu += (after['cpu_ms'] - before['cpu_ms']) / 1000
+        cache = {'hits': after['cache_hits'] - before['cache_hits'],
+                 'misses': after['cache_misses'] - before['cache_misses']}
+    lookups = cache['hits'] + cache['misses']
+    return SeedingResult(size=served, seconds=seconds,
+                         mb_per_s=served / MB / seconds, cpu_seconds=cpu,
+                         cpu_per_gb=cpu / (served / 1024 ** 3),
+                         peak_rss_mb=peak_rss_mb(),
+                         cache_hit_rate=(cache['hits'] / lookups
+                                         if lookups else None))
+
+
+@click.command()
+@click.option('--size', default=64, help='Payload size in MB')
+@click.option('--piece-length', default=256, help='Piece length in KB')
+@click.option('--connections', default=4,
+              help='Leechers, each downloads the whole payload')
+@click.option('--depth', default=64, help='Outstanding requests per leecher')
+@click.option('--sendfile/--no-sendfile', default=True,
+              help='Serve blocks with os.sendfile')
+@click.option('--cache-size', default=32,
+              help='Piece cache in MB, used for blocks not sent with '
+                   'sendfile')
+@click.option('--workers', default=0,
+              help='Seed from this many processes sharing the port, 0 '
+                   'seeds from the benchmark process')
+@click.option('--json', 'as_json', is_flag=True, help='Print JSON')
+def main(size, piece_length, connections, depth, sendfile, cache_size,
+         workers, as_json):
+    get_logger().setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='bt-seed-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(run(
+            workdir, size=size * MB, piece_length=piece_length * 1024,
+            connections=connections, depth=depth, sendfile=sendfile,
+            cache_size=cache_size * MB, workers=workers))
+    finally:
+        loop.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if as_json:
+        click.echo(json.dumps(result._asdict(), indent=2))
+        return
+    click.echo('served           {:>10.1f} MB'.format(result.size / MB))
+    click.echo('elapsed          {:>10.3f} s'.format(result.seconds))
+    click.echo('throughput       {:>10.2f} MB/s'.format(result.mb_per_s))
+    click.echo('cpu              {:>10.3f} s'.format(result.cpu_seconds))
+    click.echo('cpu per GB       {:>10.3f} s'.format(result.cpu_per_gb))
+    click.echo('peak rss         {:>10.1f} MB'.format(result.peak_rss_mb))
+    if result.cache_hit_rate is not None:
+        click.echo('cache hit rate   {:>10.1%}'.format(
+            result.cache_hit_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,799 @@
+# -*- coding: utf-8 -*-
+"""Local swarm simulator.
+
+Everything needed to run `Client.download` end to end without touching
+the network: synthetic payloads and .torrent files, an in-process HTTP
+tracker (HTTP or UDP), seeders built on `bt.server`, HTTP servers of the
+payload for web seeding and shaping proxies (TCP and UDP) which inject
+latency, bandwidth limits and loss in front of every seeder.
+`LocalDHT` runs a small DHT network on loopback, `local_discovery` puts
+local service discovery on a private multicast group of the loopback
+interface.
+"""
+
+import os
+import time
+import random
+import socket
+import asyncio
+import resource
+from hashlib import sha1
+from collections import namedtuple
+from urllib.parse import unquote_to_bytes
+
+import bencodepy
+
+from bt import Client, parse, run_server, run_utp_server, get_logger
+from bt.dht import DHTNode
+from bt.lsd import LSD_GROUP, LocalServiceDiscovery
+from bt.streaming import STREAM_RATE
+from bt.tracker import (UDP_PROTOCOL_ID,
+                        CONNECT,
+                        ANNOUNCE,
+                        SCRAPE,
+                        ERROR,
+                        UDP_REQUEST,
+                        UDP_RESPONSE,
+                        CONNECT_RESPONSE,
+                        ANNOUNCE_REQUEST,
+                        ANNOUNCE_RESPONSE,
+                        SCRAPE_ENTRY,
+                        close_http_session)
+from bt.writer import MessageWriter
+
+
+logger = get_logger()
+
+MB = 1024 * 1024
+
+# Penalty applied to a chunk which is "lost" in the shaping proxy. TCP
+# recovers from a lost segment by retransmitting it, which stalls the
+# stream for about one retransmission timeout.
+RETRANSMIT_TIMEOUT = 0.2
+
+SwarmResult = namedtuple('SwarmResult', [
+    'size', 'seconds', 'mb_per_s', 'time_to_first_piece', 'cpu_seconds',
+    'cpu_per_gb', 'peak_rss_mb', 'announces', 'messages_sent',
+    'write_calls', 'time_to_all_peers', 'lan_connections',
+    'web_seed_bytes', 'time_to_first_byte', 'stall_seconds'])
+
+
+def make_payload(path, size, seed=0):
+    """Write `size` pseudo random bytes to `path`, deterministic for a
+    given `seed`.
+    """
+    rnd = random.Random(seed)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, MB)
+            f.write(rnd.getrandbits(chunk * 8).to_bytes(chunk, 'little'))
+            remaining -= chunk
+    return path
+
+
+def make_torrent(payload, announce, piece_length=2 ** 18, path=None,
+                 announce_list=None, url_list=None):
+    """Create a single file .torrent describing `payload`.
+
+    :param announce_list: Tiers of tracker URLs (BEP 12).
+    :param url_list: URLs of web seeds (BEP 19).
+
+    :return Path of the written .torrent file.
+    """
+    pieces = []
+    with open(payload, 'rb') as f:
+        while True:
+            data = f.read(piece_length)
+            if not data:
+                break
+            pieces.append(sha1(data).digest())
+    info = {b'name': os.path.basename(payload).encode('utf-8'),
+            b'length': os.path.getsize(payload),
+            b'piece length': piece_length,
+            b'pieces': b''.join(pieces)}
+    meta = {b'announce': announce.encode('utf-8'),
+            b'created by': b'bt swarm simulator',
+            b'info': info}
+    if announce_list:
+        meta[b'announce-list'] = [[url.encode('utf-8') for url in tier]
+                                  for tier in announce_list]
+    if url_list:
+        meta[b'url-list'] = [url.encode('utf-8') for url in url_list]
+    path = path if path else payload + '.torrent'
+    with open(path, 'wb') as f:
+        f.write(bencodepy.encode(meta))
+    return path
+
+
+def compact_peers(peers):
+    return b''.join(socket.inet_aton(host) + port.to_bytes(2, 'big')
+                    for host, port in peers)
+
+
+class MockTracker(asyncio.Protocol):
+    """Minimal HTTP tracker answering every announce with the configured
+    peers in compact format, at most `max_peers` of them.
+
+    Connections are kept alive, `connections` counts the accepted ones.
+    Scrapes are recorded as lists of info hashes in `scrapes`.
+    """
+    def __init__(self, peers, interval=1800, max_peers=None):
+        self.peers = peers
+        self.interval = interval
+        self.max_peers = max_peers
+        self.announces = []
+        self.scrapes = []
+        self.connections = 0
+        self.server = None
+
+    def __call__(self):
+        self.connections += 1
+        return _TrackerConnection(self)
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(self, host=host, port=port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.url = 'http://{}:{}/announce'.format(host, self.port)
+        return self
+
+    def response(self, params):
+        self.announces.append(params)
+        return bencodepy.encode({b'complete': len(self.peers),
+                                 b'incomplete': 0,
+                                 b'interval': self.interval,
+                                 b'peers': compact_peers(
+                                     self.peers[:self.max_peers])})
+
+    def scrape_response(self, info_hashes):
+        self.scrapes.append(info_hashes)
+        stats = {b'complete': len(self.peers), b'downloaded': 0,
+                 b'incomplete': 0}
+        return bencodepy.encode({b'files': {info_hash: stats
+                                            for info_hash in info_hashes}})
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+
+class _TrackerConnection(asyncio.Protocol):
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\r\n\r\n' in self.buffer:
+            head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+            self.handle(head)
+
+    def handle(self, head):
+        lines = head.split(b'\r\n')
+        target = lines[0].split(b' ')[1]
+        path, _, query = target.partition(b'?')
+        pairs = []
+        for pair in query.split(b'&'):
+            key, _, value = pair.partition(b'=')
+            pairs.append((unquote_to_bytes(key), unquote_to_bytes(value)))
+        if path.endswith(b'/scrape'):
+            body = self.tracker.scrape_response(
+                [value for key, value in pairs if key == b'info_hash'])
+        else:
+            body = self.tracker.response(dict(pairs))
+        close = b'connection: close' in (line.lower() for line in lines)
+        self.transport.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/plain\r\n' +
+            (b'Connection: close\r\n' if close else b'') +
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' +
+            body)
+        if close:
+            self.transport.close()
+
+
+class MockWebSeed:
+    """HTTP server of a file answering `Range` requests, the stand-in of
+    a web seed. Connections are kept alive, the requested `(start, end)`
+    ranges are recorded in `ranges`. Without `partial` it ignores the
+    `Range` header and sends the whole file.
+    """
+    def __init__(self, path, partial=True):
+        self.path = path
+        self.partial = partial
+        self.ranges = []
+        self.server = None
+
+    def __call__(self):
+        return _WebSeedConnection(self)
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_event_loop()
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.server = await loop.create_server(self, host=host, port=port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        self.url = 'http://{}:{}/{}'.format(
+            host, self.address[1], os.path.basename(self.path))
+        return self
+
+    def response(self, headers):
+        value = headers.get(b'range', b'')
+        if not self.partial or not value.startswith(b'bytes='):
+            return b'200 OK', [], os.pread(self.fd, self.size, 0)
+        start, _, end = value[6:].partition(b'-')
+        start, end = int(start), min(int(end) + 1, self.size)
+        self.ranges.append((start, end))
+        return (b'206 Partial Content',
+                [b'Content-Range: bytes %d-%d/%d' % (start, end - 1,
+                                                    self.size)],
+                os.pread(self.fd, end - start, start))
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            os.close(self.fd)
+
+
+class _WebSeedConnection(asyncio.Protocol):
+    def __init__(self, web_seed):
+        self.web_seed = web_seed
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\r\n\r\n' in self.buffer:
+            head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+            self.handle(head)
+
+    def handle(self, head):
+        headers = {}
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        status, extra, body = self.web_seed.response(headers)
+        self.transport.write(b'\r\n'.join(
+            [b'HTTP/1.1 ' + status, b'Content-Type: application/octet-stream',
+             b'Content-Length: %d' % len(body)] + extra) +
+            b'\r\n\r\n' + body)
+
+
+class MockUDPTracker(asyncio.DatagramProtocol):
+    """`MockTracker` speaking the UDP tracker protocol (BEP 15).
+
+    Announces are recorded with the same keys as the HTTP query string.
+    The first `drop` datagrams are ignored, as if they were lost.
+    """
+    def __init__(self, peers, interval=1800, max_peers=None, drop=0):
+        self.peers = peers
+        self.interval = interval
+        self.max_peers = max_peers
+        self.drop = drop
+        self.announces = []
+        self.scrapes = []
+        self.connects = 0
+        self.connection_ids = set()
+        self.transport = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(host, port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.url = 'udp://{}:{}/announce'.format(host, self.port)
+        return self
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = UDP_REQUEST.unpack_from(data)
+        body = data[UDP_REQUEST.size:]
+        if action == CONNECT and connection_id == UDP_PROTOCOL_ID:
+            self.connects += 1
+            connection_id = random.getrandbits(64)
+            self.connection_ids.add(connection_id)
+            reply = CONNECT_RESPONSE.pack(connection_id)
+        elif connection_id not in self.connection_ids:
+            action, reply = ERROR, b'Unknown connection id'
+        elif action == ANNOUNCE:
+            fields = ANNOUNCE_REQUEST.unpack_from(body)
+            self.announces.append(dict(zip(
+                (b'info_hash', b'peer_id', b'downloaded', b'left',
+                 b'uploaded', b'event', b'ip', b'key', b'numwant', b'port'),
+                fields)))
+            reply = ANNOUNCE_RESPONSE.pack(
+                self.interval, 0, len(self.peers)) + \
+                compact_peers(self.peers[:self.max_peers])
+        elif action == SCRAPE:
+            hashes = [body[i:i + 20] for i in range(0, len(body), 20)]
+            self.scrapes.append(hashes)
+            reply = b''.join(SCRAPE_ENTRY.pack(len(self.peers), 0, 0)
+                             for _ in hashes)
+        else:
+            action, reply = ERROR, b'Unknown action'
+        self.transport.sendto(UDP_RESPONSE.pack(action, transaction_id) +
+                              reply, addr)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+class ShapingProxy:
+    """TCP proxy in front of a seeder which delays every chunk by
+    `latency` seconds, limits each direction to `bandwidth` bytes per
+    second and "loses" a chunk with probability `loss`.
+    """
+    def __init__(self, target, latency=0.0, bandwidth=None, loss=0.0,
+                 seed=0):
+        self.target = target
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.server = None
+        self.tasks = set()
+
+    @property
+    def passthrough(self):
+        return not (self.latency or self.bandwidth or self.loss)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.accept, host, port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        return self
+
+    async def accept(self, reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection(
+                *self.target)
+        except OSError:
+            writer.close()
+            return
+        for task in (self.pipe(reader, up_writer),
+                     self.pipe(up_reader, writer)):
+            future = asyncio.ensure_future(task)
+            self.tasks.add(future)
+            future.add_done_callback(self.tasks.discard)
+
+    async def pipe(self, reader, writer):
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send(queue, writer))
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                queue.put_nowait((loop.time() + self.latency, data))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            queue.put_nowait((None, None))
+            await asyncio.wait([sender])
+
+    async def send(self, queue, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                if not self.passthrough:
+                    delay = due - loop.time()
+                    if self.bandwidth:
+                        delay = max(delay, 0) + len(data) / self.bandwidth
+                    if self.loss and self.random.random() < self.loss:
+                        delay = max(delay, 0) + RETRANSMIT_TIMEOUT
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+class DatagramShapingProxy:
+    """UDP counterpart of `ShapingProxy` for uTP.
+
+    Datagrams of every client are relayed from their own upstream socket.
+    Each direction is a link of `bandwidth` bytes per second with a drop
+    tail queue holding at most `queue` seconds of data, followed by
+    `latency` seconds of delay. Datagrams are dropped with probability
+    `loss`.
+    """
+    def __init__(self, target, latency=0.0, bandwidth=None, loss=0.0,
+                 seed=0, queue=1.0):
+        self.target = target
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.queue = queue
+        self.random = random.Random(seed)
+        self.transport = None
+        # client address -> [upstream transport or None, pending datagrams]
+        self.upstreams = {}
+        self.links = {}
+        self.dropped = 0
+        # Longest time a datagram waited in a link queue
+        self.max_queue = 0.0
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramRelay(self.from_client), local_addr=(host, port))
+        self.address = self.transport.get_extra_info('sockname')[:2]
+        return self
+
+    def from_client(self, data, addr):
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream = self.upstreams[addr] = [None, []]
+            asyncio.ensure_future(self.open_upstream(addr))
+        self.shape(('up', addr), data, lambda data: self.to_target(addr, data))
+
+    async def open_upstream(self, addr):
+        loop = asyncio.get_event_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramRelay(
+                lambda data, _: self.shape(
+                    ('down', addr), data,
+                    lambda data: self.transport.sendto(data, addr))),
+            remote_addr=self.target)
+        upstream = self.upstreams[addr]
+        upstream[0] = transport
+        for data in upstream[1]:
+            transport.sendto(data)
+        upstream[1] = []
+
+    def to_target(self, addr, data):
+        transport, pending = self.upstreams[addr]
+        if transport is None:
+            pending.append(data)
+        elif not transport.is_closing():
+            transport.sendto(data)
+
+    def shape(self, link, data, deliver):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        departure = now
+        if self.bandwidth:
+            start = max(now, self.links.get(link, now))
+            if start - now > self.queue:
+                self.dropped += 1
+                return
+            self.max_queue = max(self.max_queue, start - now)
+            departure = start + len(data) / self.bandwidth
+            self.links[link] = departure
+        if departure + self.latency > now:
+            loop.call_at(departure + self.latency, deliver, data)
+        else:
+            deliver(data)
+
+    async def close(self):
+        if self.transport:
+            self.transport.close()
+        for transport, _ in self.upstreams.values():
+            if transport is not None:
+                transport.close()
+
+
+class _DatagramRelay(asyncio.DatagramProtocol):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def datagram_received(self, data, addr):
+        self.callback(data, addr)
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def local_discovery(port):
+    """A started `LocalServiceDiscovery` on the loopback interface, all
+    instances with the same group `port` find each other.
+    """
+    return await LocalServiceDiscovery(group=(LSD_GROUP[0], port),
+                                       interface='127.0.0.1').start()
+
+
+class LocalDHT:
+    """`count` DHT nodes on loopback, each joining through the ones
+    started before it.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.nodes = []
+
+    @property
+    def bootstrap(self):
+        return [node.address for node in self.nodes[:3]]
+
+    async def start(self, host='127.0.0.1'):
+        for _ in range(self.count):
+            node = DHTNode(bootstrap=self.bootstrap)
+            self.nodes.append(await node.start(host=host))
+        return self
+
+    async def node(self, host='127.0.0.1', **kwargs):
+        """A new node joined to the network, closed by the caller."""
+        return await DHTNode(bootstrap=self.bootstrap, **kwargs).start(
+            host=host)
+
+    def close(self):
+        for node in self.nodes:
+            node.close()
+
+
+class LocalSwarm:
+    """A tracker plus `seeders` seeders of a freshly generated payload,
+    all running in the current event loop.
+
+    The tracker returns at most `tracker_peers` seeders, every seeder knows
+    all of them and advertises them through PEX. With `utp` the seeders
+    also accept uTP on the UDP port of the same number. `sendfile` turns
+    the zero-copy serving of the TCP seeders on or off. `udp_tracker`
+    runs a `MockUDPTracker` instead of the HTTP one. `dead_trackers` UDP
+    trackers which never answer share the tier of the working one. With
+    `dht` nodes in a `LocalDHT` the seeders are announced on the DHT and
+    the tracker returns none of them. `lan_seeders` more seeders, without
+    shaping proxies, are only found through local service discovery.
+    `web_seeds` HTTP servers of the payload, behind shaping proxies like
+    the seeders, are listed in the `url-list` of the torrent. The first
+    `slow_seeders` seeders have ten times the latency.
+    """
+    def __init__(self, workdir, size=16 * MB, piece_length=2 ** 18,
+                 seeders=2, latency=0.0, bandwidth=None, loss=0.0, seed=0,
+                 tracker_peers=None, utp=False, sendfile=True,
+                 udp_tracker=False, dead_trackers=0, dht=0, lan_seeders=0,
+                 web_seeds=0, slow_seeders=0):
+        self.workdir = workdir
+        self.size = size
+        self.piece_length = piece_length
+        self.num_seeders = seeders
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.seed = seed
+        self.tracker_peers = tracker_peers
+        self.utp = utp
+        self.sendfile = sendfile
+        self.udp_tracker = udp_tracker
+        self.dead_trackers = []
+        self.num_dead_trackers = dead_trackers
+        self.num_dht_nodes = dht
+        self.dht = None
+        self.num_lan_seeders = lan_seeders
+        self.lsd_port = free_udp_port() if lan_seeders else None
+        self.lan_peers = set()
+        self.discoveries = []
+        self.num_web_seeds = web_seeds
+        self.slow_seeders = slow_seeders
+        self.web_seeds = []
+        self.swarm_peers = set()
+        self.servers = []
+        self.proxies = []
+        self.tracker = None
+
+    async def start(self):
+        seed_dir = os.path.join(self.workdir, 'seed')
+        os.makedirs(seed_dir, exist_ok=True)
+        self.payload = make_payload(os.path.join(seed_dir, 'payload.bin'),
+                                    self.size, seed=self.seed)
+        tracker_class = MockUDPTracker if self.udp_tracker else MockTracker
+        self.tracker = await tracker_class(
+            peers=[], max_peers=self.tracker_peers).start()
+        for _ in range(self.num_dead_trackers):
+            self.dead_trackers.append(
+                await MockUDPTracker(peers=[], drop=float('inf')).start())
+        announce_list = None
+        if self.dead_trackers:
+            announce_list = [[self.tracker.url] + [
+                tracker.url for tracker in self.dead_trackers]]
+        url_list = []
+        for index in range(self.num_web_seeds):
+            web_seed = await MockWebSeed(self.payload).start()
+            self.web_seeds.append(web_seed)
+            proxy = await ShapingProxy(
+                web_seed.address, latency=self.latency,
+                bandwidth=self.bandwidth, loss=self.loss,
+                seed=self.seed + self.num_seeders + index).start()
+            self.proxies.append(proxy)
+            url_list.append('http://{}:{}/'.format(*proxy.address))
+        self.torrent_path = make_torrent(
+            self.payload, self.tracker.url, piece_length=self.piece_length,
+            path=os.path.join(self.workdir, 'payload.torrent'),
+            announce_list=announce_list, url_list=url_list)
+        torrent = parse(self.torrent_path)
+        if self.num_dht_nodes:
+            self.dht = await LocalDHT(self.num_dht_nodes).start()
+
+        for index in range(self.num_seeders):
+            server = await run_server(port=0, torrent=torrent,
+                                      path=self.payload,
+                                      peers=self.swarm_peers,
+                                      sendfile=self.sendfile)
+            self.servers.append(server)
+            address = server.sockets[0].getsockname()[:2]
+            latency = self.latency
+            if index < self.slow_seeders:
+                latency *= 10
+            proxy = await ShapingProxy(
+                address, latency=latency, bandwidth=self.bandwidth,
+                loss=self.loss, seed=self.seed + index).start()
+            self.proxies.append(proxy)
+            if self.utp:
+                server = await run_utp_server(port=0, torrent=torrent,
+                                              path=self.payload,
+                                              peers=self.swarm_peers)
+                self.servers.append(server)
+                udp_proxy = await DatagramShapingProxy(
+                    server.address, latency=self.latency,
+                    bandwidth=self.bandwidth, loss=self.loss,
+                    seed=self.seed + index).start(port=proxy.address[1])
+                self.proxies.append(udp_proxy)
+            if self.dht is not None:
+                node = self.dht.nodes[index % len(self.dht.nodes)]
+                await node.announce(torrent.hash, port=proxy.address[1])
+            else:
+                self.tracker.peers.append(proxy.address)
+            self.swarm_peers.add(proxy.address)
+
+        for _ in range(self.num_lan_seeders):
+            server = await run_server(port=0, torrent=torrent,
+                                      path=self.payload,
+                                      peers=self.swarm_peers,
+                                      sendfile=self.sendfile)
+            self.servers.append(server)
+            address = server.sockets[0].getsockname()[:2]
+            discovery = await local_discovery(self.lsd_port)
+            discovery.add(torrent.hash, port=address[1],
+                          on_peers=lambda peers: None)
+            self.discoveries.append(discovery)
+            self.lan_peers.add(address)
+        return self
+
+    async def download(self, savedir, connections=None, transport='stream',
+                       pex=True, stream=None, stream_position=0,
+                       stream_rate=STREAM_RATE):
+        """Download the payload into `savedir` and measure the run.
+
+        :param stream: Read the payload in order from `stream_position`
+                       while it downloads, with 'deadlines' in streaming
+                       mode at `stream_rate`, with 'reader' only reading.
+        """
+        dht = await self.dht.node() if self.dht is not None else None
+        lsd = None
+        if self.num_lan_seeders:
+            lsd = await local_discovery(self.lsd_port)
+        client = Client(max_connections=connections or self.num_seeders,
+                        transport=transport, pex=pex, dht=dht, lsd=lsd,
+                        stream_rate=(stream_rate if stream == 'deadlines'
+                                     else None),
+                        stream_position=stream_position)
+        loop = asyncio.get_event_loop()
+        first_piece = []
+        last_piece = []
+        all_peers = []
+        dialed = set()
+        readers = []
+
+        async def consume(reader):
+            # Plays the stream at `stream_rate`
+            try:
+                while True:
+                    data = await reader.read()
+                    if not data:
+                        return
+                    await asyncio.sleep(len(data) / stream_rate)
+            except EOFError:
+                pass
+
+        async def watch():
+            # The client only notices completion on its next monitor tick,
+            # so the pieces are timestamped here.
+            while True:
+                manager = client.download_manager
+                dialed.update(client.available_peers.connected)
+                if not all_peers and len(client.available_peers.connected) \
+                        >= client.max_connections:
+                    all_peers.append(loop.time())
+                if manager is not None and stream and not readers:
+                    reader = client.stream or manager.reader(stream_position)
+                    readers.append((reader,
+                                    asyncio.ensure_future(consume(reader))))
+                if manager is not None:
+                    if manager.have_pieces and not first_piece:
+                        first_piece.append(loop.time())
+                    if len(manager.have_pieces) == manager.total_pieces:
+                        last_piece.append(loop.time())
+                        return
+                await asyncio.sleep(0.001)
+
+        watcher = asyncio.ensure_future(watch())
+        MessageWriter.stats.clear()
+        cpu = time.process_time()
+        started = loop.time()
+        await client.download(self.torrent_path, savedir.encode('utf-8'))
+        cpu = time.process_time() - cpu
+        watcher.cancel()
+        web_seed_bytes = sum(web_seed.downloaded
+                             for web_seed in client.web_seeds)
+        reader = None
+        if readers:
+            reader, consumer = readers[0]
+            consumer.cancel()
+        if dht is not None:
+            dht.close()
+        if lsd is not None:
+            lsd.close()
+        elapsed = (last_piece[0] if last_piece else loop.time()) - started
+
+        gigabytes = self.size / (1024 * MB)
+        return SwarmResult(
+            size=self.size,
+            seconds=elapsed,
+            mb_per_s=self.size / MB / elapsed,
+            time_to_first_piece=(first_piece[0] - started
+                                 if first_piece else None),
+            cpu_seconds=cpu,
+            cpu_per_gb=cpu / gigabytes,
+            peak_rss_mb=peak_rss_mb(),
+            announces=len(self.tracker.announces),
+            # Client and seeders together, every write call is a send()
+            messages_sent=MessageWriter.stats['messages'],
+            write_calls=MessageWriter.stats['writes'],
+            time_to_all_peers=(all_peers[0] - started
+                               if all_peers else None),
+            lan_connections=len(dialed & self.lan_peers),
+            web_seed_bytes=web_seed_bytes,
+            time_to_first_byte=(reader.time_to_first_byte
+                                if reader is not None else None),
+            stall_seconds=reader.stalled if reader is not None else None)
+
+    async def stop(self):
+        await close_http_session()
+        for proxy in self.proxies:
+            await proxy.close()
+        for server in self.servers:
+            server.close()
+        if self.tracker:
+            self.tracker.close()
+        for tracker in self.dead_trackers:
+            tracker.close()
+        for discovery in self.discoveries:
+            discovery.close()
+        for web_seed in self.web_seeds:
+            web_seed.close()
+        if self.dht is not None:
+            self.dht.close()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""End-to-end download benchmark against a local swarm.
+
+    python -m benchmarks.throughput --size=64 --seeders=4 --latency=0.02
+"""
+
+import os
+import json
+import shutil
+import asyncio
+import logging
+import tempfile
+
+import click
+
+from bt import get_logger
+
+from bt.streaming import STREAM_RATE
+
+from .swarm import LocalSwarm, MB
+
+
+async def run(workdir, size, piece_length, seeders, connections, latency,
+              bandwidth, loss, seed, transport='stream', tracker_peers=None,
+              pex=True, sendfile=True, udp_tracker=False, dead_trackers=0,
+              dht=0, lan_seeders=0, web_seeds=0, slow_seeders=0, stream=None,
+              stream_position=0, stream_rate=STREAM_RATE):
+    swarm = LocalSwarm(workdir, size=size, piece_length=piece_length,
+                       seeders=seeders, latency=latency, bandwidth=bandwidth,
+                       loss=loss, seed=seed, tracker_peers=tracker_peers,
+                       utp=transport == 'utp', sendfile=sendfile,
+                       udp_tracker=udp_tracker, dead_trackers=dead_trackers,
+                       dht=dht, lan_seeders=lan_seeders, web_seeds=web_seeds,
+                       slow_seeders=slow_seeders)
+    await swarm.start()
+    try:
+        savedir = os.path.join(workdir, 'leech')
+        os.makedirs(savedir, exist_ok=True)
+        result = await swarm.download(savedir, connections=connections,
+                                      transport=transport, pex=pex,
+                                      stream=stream,
+                                      stream_position=stream_position,
+                                      stream_rate=stream_rate)
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            if expected.read() != got.read():
+                raise click.ClickException('Downloaded payload is corrupt')
+        return result
+    finally:
+        await swarm.stop()
+
+
+@click.command()
+@click.option('--size', default=16, help='Payload size in MB')
+@click.option('--piece-length', default=256, help='Piece length in KB')
+@click.option('--seeders', default=2, help='Number of local seeders')
+@click.option('--connections', default=0,
+              help='Peer connections opened by the client, '
+                   'defaults to one per seeder')
+@click.option('--latency', default=0.0, help='One way latency in seconds')
+@click.option('--bandwidth', default=0.0,
+              help='Per connection bandwidth in MB/s, 0 is unlimited')
+@click.option('--loss', default=0.0, help='Chunk loss probability')
+@click.option('--seed', default=0, help='Seed for payload and loss')
+@click.option('--transport', default='stream',
+              type=click.Choice(['stream', 'buffered', 'utp']),
+              help='Peer connection implementation of the client')
+@click.option('--tracker-peers', default=0,
+              help='Peers returned by the tracker, 0 returns all seeders')
+@click.option('--pex/--no-pex', default=True, help='Enable peer exchange')
+@click.option('--tracker', default='http', type=click.Choice(['http', 'udp']),
+              help='Protocol of the local tracker')
+@click.option('--dead-trackers', default=0,
+              help='Silent UDP trackers in the tier of the local tracker')
+@click.option('--dht', default=0,
+              help='Nodes of a local DHT the seeders are found through, '
+                   'instead of the tracker')
+@click.option('--lan-seeders', default=0,
+              help='Unshaped seeders found through local service discovery')
+@click.option('--web-seeds', default=0,
+              help='Shaped HTTP servers of the payload in the url-list')
+@click.option('--slow-seeders', default=0,
+              help='Seeders with ten times the latency')
+@click.option('--stream', default='none',
+              type=click.Choice(['none', 'reader', 'deadlines']),
+              help='Read the payload in order while it downloads, with '
+                   'deadlines in streaming mode')
+@click.option('--stream-position', default=0.0,
+              help='MB into the payload the stream starts at')
+@click.option('--stream-rate', default=STREAM_RATE / MB,
+              help='Playback rate of the stream in MB/s')
+@click.option('--sendfile/--no-sendfile', default=True,
+              help='Seeders serve blocks with os.sendfile')
+@click.option('--workdir', default=None,
+              help='Directory for payloads, defaults to a temporary one')
+@click.option('--json', 'as_json', is_flag=True, help='Print JSON')
+def main(size, piece_length, seeders, connections, latency, bandwidth, loss,
+         seed, transport, tracker_peers, pex, tracker, dead_trackers, dht,
+         lan_seeders, web_seeds, slow_seeders, stream, stream_position,
+         stream_rate, sendfile, workdir, as_json):
+    get_logger().setLevel(logging.WARNING)
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='bt-bench-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(run(
+            workdir, size=size * MB, piece_length=piece_length * 1024,
+            seeders=seeders, connections=connections or None,
+            latency=latency, bandwidth=bandwidth * MB or None, loss=loss,
+            seed=seed, transport=transport,
+            tracker_peers=tracker_peers or None, pex=pex,
+            sendfile=sendfile, udp_tracker=tracker == 'udp',
+            dead_trackers=dead_trackers, dht=dht, lan_seeders=lan_seeders,
+            web_seeds=web_seeds, slow_seeders=slow_seeders,
+            stream=None if stream == 'none' else stream,
+            stream_position=int(stream_position * MB),
+            stream_rate=stream_rate * MB))
+    finally:
+        loop.close()
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if as_json:
+        click.echo(json.dumps(result._asdict(), indent=2))
+        return
+    click.echo('size             {:>10.1f} MB'.format(result.size / MB))
+    click.echo('elapsed          {:>10.3f} s'.format(result.seconds))
+    click.echo('throughput       {:>10.2f} MB/s'.format(result.mb_per_s))
+    if result.time_to_first_piece is not None:
+        click.echo('first piece      {:>10.3f} s'.format(
+            result.time_to_first_piece))
+    if result.time_to_first_byte is not None:
+        click.echo('first byte       {:>10.3f} s'.format(
+            result.time_to_first_byte))
+        click.echo('stalled          {:>10.3f} s'.format(
+            result.stall_seconds))
+    if result.time_to_all_peers is not None:
+        click.echo('all peers        {:>10.3f} s'.format(
+            result.time_to_all_peers))
+    click.echo('cpu              {:>10.3f} s'.format(result.cpu_seconds))
+    click.echo('cpu per GB       {:>10.3f} s'.format(result.cpu_per_gb))
+    click.echo('peak rss         {:>10.1f} MB'.format(result.peak_rss_mb))
+    click.echo('announces        {:>10d}'.format(result.announces))
+    click.echo('messages sent    {:>10d}'.format(result.messages_sent))
+    click.echo('write calls      {:>10d}'.format(result.write_calls))
+    if result.lan_connections:
+        click.echo('lan connections  {:>10d}'.format(result.lan_connections))
+    if result.web_seed_bytes:
+        click.echo('from web seeds   {:>10.1f} MB'.format(
+            result.web_seed_bytes / MB))
+
+
+if __name__ == '__main__':
+    main()
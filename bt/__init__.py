@@ -5,4 +5,4 @@ from .torrent_parser import parse  # NOQA
 from .logger import get_logger  # NOQA
 from .client import Client  # NOQA
 from .protocol import PeerConnection  # NOQA
-from .server import run_server  # NOQA
+from .server import run_server, run_utp_server  # NOQA
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+
+try:
+    _popcount = int.bit_count  # Python 3.10+
+except AttributeError:
+    def _popcount(value):
+        return bin(value).count('1')
+
+
+class Bitfield:
+    """
+    Set of piece indexes in the wire format of the BitField message: bit 0
+    is the high bit of the first byte, spare bits at the end are zero.
+
+    Single bits are tested and set in O(1) on a `bytearray`. Bulk operations
+    (`count`, `&`, `|`, `andnot`, `first`) go through one big integer so
+    they run in C rather than looping over pieces in Python.
+    """
+    __slots__ = ('length', 'data')
+
+    def __init__(self, length, data=None):
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self.data = bytearray(size)
+        else:
+            self.data = bytearray(data[:size])
+            if len(self.data) < size:
+                self.data.extend(bytes(size - len(self.data)))
+            self._clear_spare_bits()
+
+    @classmethod
+    def from_bytes(cls, data, length=None):
+        """Bitfield from the payload of a BitField message. Without
+        `length` every bit of `data` is a piece.
+        """
+        return cls(len(data) * 8 if length is None else length, data)
+
+    @classmethod
+    def full(cls, length):
+        return cls(length, b'\xff' * ((length + 7) // 8))
+
+    @classmethod
+    def _from_int(cls, length, value):
+        return cls(length, value.to_bytes((length + 7) // 8, 'big'))
+
+    def _to_int(self):
+        return int.from_bytes(self.data, 'big')
+
+    def _clear_spare_bits(self):
+        spare = len(self.data) * 8 - self.length
+        if spare:
+            self.data[-1] &= (0xff << spare) & 0xff
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError('Piece index {} out of range'.format(index))
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError('Piece index {} out of range'.format(index))
+        if value:
+            self.data[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __eq__(self, other):
+        return (isinstance(other, Bitfield) and
+                self.length == other.length and self.data == other.data)
+
+    def __and__(self, other):
+        return Bitfield._from_int(self.length,
+                                  self._to_int() & other._aligned(self))
+
+    def __or__(self, other):
+        return Bitfield._from_int(self.length,
+                                  self._to_int() | other._aligned(self))
+
+    def andnot(self, other):
+        """Pieces in this bitfield but not in `other`, e.g. the pieces a
+        peer has which we are still missing.
+        """
+        return Bitfield._from_int(self.length,
+                                  self._to_int() & ~other._aligned(self))
+
+    def _aligned(self, other):
+        """This bitfield as an integer of the same width as `other`."""
+        if self.length == other.length:
+            return self._to_int()
+        return Bitfield(other.length, self.data)._to_int()
+
+    def count(self):
+        """Number of set bits."""
+        return _popcount(self._to_int())
+
+    def any(self):
+        return any(self.data)
+
+    def all(self):
+        return self.count() == self.length
+
+    def first(self):
+        """Lowest set index, or None if no bit is set."""
+        value = self._to_int()
+        if not value:
+            return None
+        return len(self.data) * 8 - value.bit_length()
+
+    def indexes(self):
+        """Iterate over the set indexes in ascending order."""
+        for byte_index, byte in enumerate(self.data):
+            if byte:
+                base = byte_index << 3
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield base + bit
+
+    def tobytes(self):
+        return bytes(self.data)
+
+    def copy(self):
+        return Bitfield(self.length, self.data)
+
+    def __repr__(self):
+        return '<Bitfield({}/{})>'.format(self.count(), self.length)
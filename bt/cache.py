@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter, OrderedDict
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+
+class PieceCache:
+    """
+    LRU cache of whole pieces, shared by the connections of a server.
+
+    Peers request the blocks of a piece in order and popular pieces are
+    requested by many peers, so a miss reads ahead the entire piece with a
+    single `pread` (or maps it) and the following blocks are sliced out of
+    memory. The least recently used pieces are evicted to stay within
+    `capacity` bytes, a capacity smaller than a piece disables caching.
+
+    :param file_reader: `SourceFileReader` of the payload.
+    """
+    CAPACITY = 32 * 1024 * 1024
+
+    # Totals over all caches, read by the benchmarks
+    stats = Counter()
+
+    def __init__(self, file_reader, capacity=CAPACITY):
+        self.file_reader = file_reader
+        self.capacity = capacity
+        self.pieces = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, index):
+        return index in self.pieces
+
+    def __len__(self):
+        return len(self.pieces)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def read(self, index, begin, length):
+        """Return `length` bytes at `begin` of piece `index`."""
+        piece = self.pieces.get(index)
+        if piece is not None:
+            self.pieces.move_to_end(index)
+            self.hits += 1
+            PieceCache.stats['hits'] += 1
+            return memoryview(piece)[begin:begin + length]
+
+        self.misses += 1
+        PieceCache.stats['misses'] += 1
+        _, size = self.file_reader.piece_extent(index)
+        if size > self.capacity:
+            return self.file_reader.read(begin=begin, index=index,
+                                         length=length)
+        piece = self.file_reader.read_piece(index)
+        PieceCache.stats['read_bytes'] += len(piece)
+        self._evict(self.capacity - len(piece))
+        self.pieces[index] = piece
+        self.size += len(piece)
+        return memoryview(piece)[begin:begin + length]
+
+    def add(self, index, piece):
+        """Cache the data of piece `index`, e.g. a piece just downloaded
+        and verified, so serving it doesn't read it back from disk.
+        """
+        if len(piece) > self.capacity:
+            return
+        if index in self.pieces:
+            self.size -= len(self.pieces.pop(index))
+        self._evict(self.capacity - len(piece))
+        self.pieces[index] = piece
+        self.size += len(piece)
+
+    def _evict(self, limit):
+        while self.pieces and self.size > limit:
+            _, piece = self.pieces.popitem(last=False)
+            self.size -= len(piece)
+            PieceCache.stats['evictions'] += 1
+
+    def clear(self):
+        self.pieces.clear()
+        self.size = 0
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import random
+from collections import deque
+
+from .logger import get_logger
+from .timer import get_wheel
+from .message import (ChokeMessage,
+                      UnchokeMessage,
+                      HaveMessage,
+                      RejectRequestMessage)
+
+
+logger = get_logger()
+
+
+class Choker:
+    """
+    Tit-for-tat choking of the connections we upload to.
+
+    Every `ROUND_INTERVAL` seconds the interested peers are ranked by the
+    rate they sent us data at during the round, or by the rate we sent them
+    data at while seeding, and the best `slots` of them are unchoked. Every
+    `OPTIMISTIC_ROUNDS` rounds one more choked, interested peer is picked at
+    random as the optimistic unchoke, so newcomers get a chance to prove
+    themselves.
+
+    Peers have `interested` and `choked` flags, `uploaded` and `downloaded`
+    byte counters and `choke()`/`unchoke()` methods sending the messages.
+
+    :param seeding: Callable returning True when we have all pieces.
+    """
+    ROUND_INTERVAL = 10
+    OPTIMISTIC_ROUNDS = 3
+    UPLOAD_SLOTS = 4
+
+    def __init__(self, slots=UPLOAD_SLOTS, seeding=None):
+        self.slots = slots
+        self.seeding = seeding or (lambda: False)
+        self.peers = set()
+        self.optimistic = None
+        self.rounds = 0
+        # Byte counters of every peer at the start of the round
+        self.counters = {}
+        self.timer = None
+
+    def add(self, peer):
+        self.peers.add(peer)
+        self.counters[peer] = (peer.uploaded, peer.downloaded)
+        if self.timer is None:
+            self.timer = get_wheel().schedule(Choker.ROUND_INTERVAL,
+                                              self.on_round)
+
+    def remove(self, peer):
+        self.peers.discard(peer)
+        self.counters.pop(peer, None)
+        if peer is self.optimistic:
+            self.optimistic = None
+        if not self.peers and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def free_slot(self):
+        """True if an interested peer can be unchoked before the next
+        round.
+        """
+        unchoked = sum(1 for peer in self.peers
+                       if not peer.choked and peer is not self.optimistic)
+        return unchoked < self.slots
+
+    def on_round(self):
+        self.timer = get_wheel().schedule(Choker.ROUND_INTERVAL,
+                                          self.on_round)
+        self.run()
+
+    def rate(self, peer):
+        uploaded, downloaded = self.counters.get(peer, (0, 0))
+        if self.seeding():
+            return peer.uploaded - uploaded
+        return peer.downloaded - downloaded
+
+    def run(self):
+        """Choke and unchoke peers for the next round."""
+        interested = [peer for peer in self.peers if peer.interested]
+        if self.rounds % Choker.OPTIMISTIC_ROUNDS == 0:
+            self.optimistic = self.pick_optimistic(interested)
+        self.rounds += 1
+
+        ranked = sorted((peer for peer in interested
+                         if peer is not self.optimistic),
+                        key=self.rate, reverse=True)
+        unchoked = set(ranked[:self.slots])
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        for peer in self.peers:
+            if peer in unchoked:
+                if peer.choked:
+                    peer.unchoke()
+            elif not peer.choked:
+                peer.choke()
+            self.counters[peer] = (peer.uploaded, peer.downloaded)
+        logger.debug('Choker round {}: {} of {} peers unchoked'.format(
+            self.rounds, len(unchoked), len(self.peers)))
+
+    def pick_optimistic(self, interested):
+        candidates = [peer for peer in interested
+                      if peer.choked and peer is not self.optimistic]
+        if not candidates:
+            return self.optimistic if self.optimistic in interested \
+                else None
+        return random.choice(candidates)
+
+
+class UploadStateMixin:
+    """
+    Upload side of a connection, the peer interface of the `Choker`.
+
+    Used by the connections the server accepts and by the ones a download
+    opens, so both are choked together and serve requests through the same
+    `RequestHandler`. Subclasses have an `outgoing` `MessageWriter` and a
+    `fast` flag.
+    """
+
+    def reset_upload_state(self):
+        # Peers start choked, the choker decides who we upload to
+        self.interested = False
+        self.choked = True
+        self.uploaded = 0
+        self.downloaded = 0
+        # Queued `RequestMessage`s, served in order
+        self.requests = deque()
+
+    def choke(self):
+        self.choked = True
+        self.outgoing.send(ChokeMessage())
+        # Queued requests are dropped, Fast Extension peers are told so
+        if self.fast:
+            for request in self.requests:
+                self.outgoing.send(RejectRequestMessage(
+                    request.index, request.begin, request.length))
+        self.requests.clear()
+
+    def unchoke(self):
+        self.choked = False
+        self.outgoing.send(UnchokeMessage())
+
+    def send_haves(self, indexes):
+        """Announce pieces we completed, all Haves queued during one
+        iteration of the event loop go out in a single write.
+        """
+        if self.outgoing is None:
+            return
+        for index in indexes:
+            self.outgoing.send(HaveMessage(index))
@@ -7,17 +7,31 @@ import os
 from collections import namedtuple
 from hashlib import sha1
 import asyncio
+from functools import partial
 
 import uvloop
 from progress.bar import Bar
 
 from .torrent_parser import parse
 from .logger import get_logger
-from .tracker import HTTPTracker, UDPTracker
+from .tracker import (BaseTracker, MultiTracker, TrackerError,
+                      close_http_session)
+from .peers import PeerQueue
+from .dht import DHTError
 from .protocol import PeerConnection
+from .transport import BufferedPeerConnection, UTPPeerConnection
 from .message import REQUEST_SIZE
+from .bitfield import Bitfield
 from .mixins import ReprMixin
-from .server import run_server
+from .utils import generate_peer_id
+from .cache import PieceCache
+from .server import SourceFileReader, TorrentServer
+from .webseed import WebSeed
+from .streaming import (STREAM_RATE,
+                        DEADLINE_WINDOW,
+                        DUPLICATE_TIME,
+                        PeerRates,
+                        PieceStream)
 
 
 logger = get_logger()
@@ -31,6 +45,13 @@ PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
 # TODO: Accept this argument from user
 MAX_CONNECTIONS = 50
 
+# Implementations of the peer connection, selected with `Client(transport=)`
+PEER_TRANSPORTS = {
+    'stream': PeerConnection,
+    'buffered': BufferedPeerConnection,
+    'utp': UTPPeerConnection,
+}
+
 
 class Block(ReprMixin):
     Missing = 0
@@ -44,7 +65,6 @@ class Block(ReprMixin):
         self.offset = offset
         self.length = length
         self.status = Block.Missing
-        self.data = None
 
 
 class Piece(ReprMixin):
@@ -54,10 +74,15 @@ class Piece(ReprMixin):
         self.index = index
         self.blocks = blocks
         self.hash = hash_value
+        self.length = sum(b.length for b in blocks)
+        # Allocated on the first block and released once the piece is on disk
+        self.buffer = None
 
     def reset(self):
         for block in self.blocks:
             block.status = Block.Missing
+        # Bytes of a corrupt piece are not kept around
+        self.buffer = None
 
     def next_request(self):
         missing = [b for b in self.blocks if b.status is Block.Missing]
@@ -66,21 +91,37 @@ class Piece(ReprMixin):
             return missing[0]
         return None
 
+    def block(self, offset, length):
+        """The block at `offset` if it is `length` bytes long, else None."""
+        for block in self.blocks:
+            if block.offset == offset:
+                return block if block.length == length else None
+        return None
+
     def block_received(self, offset, data):
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            logger.debug('Block retrieved, offset {}'.format(offset))
-            block.status = Block.Retrieved
-            block.data = data
-        else:
-            logging.warning('Trying to complete a non-existing block {offset}'
-                            .format(offset=offset))
+        """Copy the data of a block into the piece.
+
+        :return False if the piece has no block of that offset and length,
+                nothing is copied then.
+        """
+        block = self.block(offset, len(data))
+        if block is None:
+            logger.warning('Ignoring invalid block of {length} bytes at '
+                           '{offset}'.format(length=len(data), offset=offset))
+            return False
+        logger.debug('Block retrieved, offset {}'.format(offset))
+        block.status = Block.Retrieved
+        # `data` may be a view into the receive buffer of the connection,
+        # this is the only copy made of it.
+        if self.buffer is None:
+            self.buffer = bytearray(self.length)
+        self.buffer[offset:offset + len(data)] = data
+        return True
 
     def is_complete(self):
         blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
         logger.debug('Pending pieces: {}'.format(len(blocks)))
-        return len(blocks) is 0
+        return len(blocks) == 0
 
     def is_hash_matching(self):
         piece_hash = bytearray(sha1(self.data).hexdigest(), 'utf-8')
@@ -90,25 +131,39 @@ class Piece(ReprMixin):
 
     @property
     def data(self):
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return self.buffer if self.buffer is not None else b''
+
+    def release(self):
+        self.buffer = None
 
 
 class DownloadManager:
     """Manager keeps track of all the pieces, connections, 
     state of the download and all the other info.
+
+    Verified pieces are served while the download goes on: they are read
+    back from the file through `cache`, which also keeps the most recently
+    completed ones in memory. Every connection in `connections` is sent a
+    Have for each of them.
+
+    With `stream` the download is played while it goes on, pieces are then
+    picked in order from the playback position and against deadlines.
     """
-    def __init__(self, torrent, savedir):
+    def __init__(self, torrent, savedir, cache_size=PieceCache.CAPACITY):
         self.torrent = torrent
         self.total_pieces = len(self.torrent.info.pieces)
         self.peers = {}
+        # Pieces suggested by each peer (BEP 6), tried first when picking
+        self.suggested = {}
         # TODO: Come up with different data structure to store
-        # states of different pieces and blocks. Probably dict or set?
+        # states of different blocks. Probably dict or set?
         self.pending_blocks = []
         self.ongoing_pieces = []
         self.have_pieces = []
-        self.missing_pieces = self.make_pieces()
+        self.pieces = self.make_pieces()
+        # Pieces nobody has started on yet and pieces written to disk
+        self.missing = Bitfield.full(self.total_pieces)
+        self.have = Bitfield(self.total_pieces)
         self.max_pending_time = 300 * 1000 # Seconds
         self.progress_bar = Bar('Downloading', max=self.total_pieces)
         if savedir == '.':
@@ -116,6 +171,26 @@ class DownloadManager:
         else:
             name = os.path.join(savedir, self.torrent.name)
         self.fd = os.open(name, os.O_RDWR | os.O_CREAT)
+        self.file_reader = SourceFileReader(torrent, path=name,
+                                            have=self.have)
+        self.cache = PieceCache(self.file_reader, capacity=cache_size)
+        # Connections we upload on, they announce the pieces we complete
+        self.connections = set()
+        self.pending_haves = []
+        self.have_handle = None
+        # Streaming: playback offset, the time it was set and bytes/s
+        self.position = None
+        self.position_time = None
+        self.stream_rate = None
+        self.rates = PeerRates()
+        # (piece, offset) of the blocks requested a second time -> id of
+        # the peer asked the second time
+        self.duplicated = {}
+        # Connections by peer id, the slower of two peers sent a duplicated
+        # request is told to cancel it
+        self.peer_connections = {}
+        # `PieceStream` readers waiting for pieces
+        self.streams = set()
 
     @property
     def complete(self):
@@ -124,10 +199,6 @@ class DownloadManager:
             self.progress_bar.finish()
         return res
 
-    @property
-    def bytes_uploaded(self):
-        return 0
-
     @property
     def bytes_downloaded(self):
         return len(self.have_pieces) * self.torrent.info.piece_length
@@ -138,8 +209,20 @@ class DownloadManager:
             block_offset=block_offset, piece_index=piece_index,
             peer_id=peer_id))
 
-        self.remove_from_pending_pieces(peer_id, piece_index,
-                                        block_offset, data)
+        if piece_index >= self.total_pieces or \
+                self.pieces[piece_index].block(block_offset,
+                                               len(data)) is None:
+            # Requested again like a rejected block
+            logger.info('Invalid block from peer {}'.format(peer_id))
+            self.block_rejected(peer_id, piece_index, block_offset)
+            return
+        request = self.remove_from_pending_pieces(peer_id, piece_index,
+                                                  block_offset, data)
+        if (piece_index, block_offset) in self.duplicated:
+            self.cancel_duplicate(peer_id, piece_index, block_offset)
+        if request is not None:
+            elapsed = int(round(time.time() * 1000)) - request.added
+            self.rates.update(peer_id, len(data), elapsed / 1000)
         piece = self.update_ongoing_pieces(peer_id, piece_index,
                                          block_offset, data)
         if piece:
@@ -153,7 +236,21 @@ class DownloadManager:
                logger.debug('Removing from pending offset: {}'.format(
                    self.pending_blocks))
                del self.pending_blocks[index]
-               break
+               return request
+        return None
+
+    def cancel_duplicate(self, peer_id, piece_index, block_offset):
+        """The first copy of a block requested twice arrived, the other
+        peer is told not to send it.
+        """
+        del self.duplicated[(piece_index, block_offset)]
+        self.pending_blocks = [
+            request for request in self.pending_blocks
+            if request.block.piece != piece_index or
+            request.block.offset != block_offset]
+        for other, connection in list(self.peer_connections.items()):
+            if other != peer_id:
+                connection.cancel_request(piece_index, block_offset)
 
     def update_ongoing_pieces(self, peer_id,
                              piece_index, block_offset, data):
@@ -163,8 +260,15 @@ class DownloadManager:
         if piece:
             piece.block_received(block_offset, data)
             if piece.is_complete():
+                self.duplicated = {
+                    key: peer for key, peer in self.duplicated.items()
+                    if key[0] != piece_index}
                 if piece.is_hash_matching():
                     self._write(piece)
+                    # The buffer moves to the cache, peers requesting the
+                    # piece soon are served without reading it back
+                    self.cache.add(piece.index, piece.buffer)
+                    piece.release()
                     self.ongoing_pieces.remove(piece)
                     return piece
                 else:
@@ -175,7 +279,23 @@ class DownloadManager:
 
     def update_have_piece(self, piece):
         self.have_pieces.append(piece)
+        self.have[piece.index] = 1
         self.progress_bar.next()
+        self.pending_haves.append(piece.index)
+        if self.have_handle is None:
+            self.have_handle = asyncio.get_event_loop().call_soon(
+                self.send_haves)
+        for stream in list(self.streams):
+            stream.piece_done(piece.index)
+
+    def send_haves(self):
+        """Announce the pieces completed since the last call to all
+        connections at once.
+        """
+        self.have_handle = None
+        indexes, self.pending_haves = self.pending_haves, []
+        for connection in list(self.connections):
+            connection.send_haves(indexes)
 
     def make_pieces(self):
         total_pieces = len(self.torrent.info.pieces)
@@ -188,7 +308,9 @@ class DownloadManager:
                                 REQUEST_SIZE)
                           for offset in range(total_piece_blocks)]
             else:
-                last_length = self.torrent.info.length % self.torrent.info.piece_length
+                last_length = (self.torrent.info.length %
+                               self.torrent.info.piece_length or
+                               self.torrent.info.piece_length)
                 num_blocks = math.ceil(last_length / REQUEST_SIZE)
                 blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
                           for offset in range(num_blocks)]
@@ -202,29 +324,134 @@ class DownloadManager:
         return pieces
 
     def add_peer(self, peer_id, bitfield):
-        self.peers[peer_id] = bitfield
+        # The wire format pads to whole bytes, keep only the real pieces
+        self.peers[peer_id] = Bitfield(self.total_pieces, bitfield.data)
 
     def update_peer(self, peer_id, index):
-        if peer_id in self.peers:
+        if peer_id in self.peers and index < self.total_pieces:
             self.peers[peer_id][index] = 1
 
-    def next_request(self, peer_id):
+    def suggest_piece(self, peer_id, piece_index):
+        if piece_index < self.total_pieces:
+            self.suggested.setdefault(peer_id, []).append(piece_index)
+
+    def block_rejected(self, peer_id, piece_index, block_offset):
+        """Make a block the peer refused to send available to the next
+        request instead of waiting for the request to expire. A duplicated
+        block stays pending while the other peer may still send it.
+        """
+        if self.duplicated.pop((piece_index, block_offset), None) is not None:
+            for index, request in enumerate(self.pending_blocks):
+                if request.block.piece == piece_index and \
+                        request.block.offset == block_offset:
+                    del self.pending_blocks[index]
+                    break
+            return
+        self.pending_blocks = [
+            request for request in self.pending_blocks
+            if request.block.piece != piece_index or
+            request.block.offset != block_offset]
+        if piece_index >= self.total_pieces:
+            return
+        for block in self.pieces[piece_index].blocks:
+            if block.offset == block_offset and block.status is Block.Pending:
+                block.status = Block.Missing
+
+    def reader(self, position=0):
+        """`PieceStream` of the verified bytes from `position` on, the
+        order pieces are picked in stays as it is.
+        """
+        stream = PieceStream(self, position)
+        self.streams.add(stream)
+        return stream
+
+    def stream(self, position=0, rate=STREAM_RATE):
+        """Download for playback from `position` at `rate` bytes/s.
+
+        Pieces are picked in order from the position on, the ones due
+        within `DEADLINE_WINDOW` seconds from the fastest peers only. Reads
+        and seeks of the returned `PieceStream` move the position.
+        """
+        self.stream_rate = rate
+        self.set_position(position)
+        stream = PieceStream(self, position, follow=True)
+        self.streams.add(stream)
+        return stream
+
+    def set_position(self, position):
+        self.position = min(max(position, 0), self.torrent.info.length - 1)
+        self.position_time = time.monotonic()
+
+    def deadline(self, index):
+        """Monotonic time playback reaches piece `index`, None for pieces
+        behind the position or when not streaming.
+        """
+        if self.position is None:
+            return None
+        start = index * self.torrent.info.piece_length
+        if start + self.torrent.info.piece_length <= self.position:
+            return None
+        return self.position_time + \
+            max(start - self.position, 0) / self.stream_rate
+
+    def deadline_range(self, seconds):
+        """Indexes of the pieces playback reaches within `seconds` from the
+        position. The window slides with the position, so it stays the
+        same size while playback waits for a piece.
+        """
+        piece_length = self.torrent.info.piece_length
+        first = self.position // piece_length
+        last = (self.position + int(seconds * self.stream_rate) - 1) // \
+            piece_length
+        return range(first, min(last + 1, self.total_pieces))
+
+    def deadline_pieces(self):
+        """Missing pieces due within `DEADLINE_WINDOW` seconds, in
+        playback order.
+        """
+        return [index for index in self.deadline_range(DEADLINE_WINDOW)
+                if not self.have[index]]
+
+    def interesting_pieces(self, peer_id):
+        """Pieces the peer has which we don't."""
+        return self.peers[peer_id].andnot(self.have)
+
+    def next_request(self, peer_id, allowed=None):
+        """
+        :param allowed: `Bitfield` limiting the pieces to pick from, e.g.
+                        the allowed fast set of a peer choking us.
+        """
         if peer_id not in self.peers:
             return None
 
-        block = self._expired_request(peer_id)
+        available = self.peers[peer_id]
+        if allowed is not None:
+            available = available & allowed
+        if self.position is not None:
+            pieces = self.deadline_pieces()
+            if self.rates.is_fast(peer_id):
+                block = self._next_deadline(peer_id, available, pieces)
+                if block:
+                    return block
+            elif pieces:
+                # Slow peers would make the pieces late, they take later ones
+                urgent = Bitfield(self.total_pieces)
+                for index in pieces:
+                    urgent[index] = 1
+                available = available.andnot(urgent)
+        block = self._expired_request(available)
         if not block:
-            block = self._next_ongoing(peer_id)
+            block = self._next_ongoing(available)
             if not block:
-                block = self._next_missing(peer_id)
+                block = self._next_missing(peer_id, available)
         return block
 
-    def _expired_request(self, peer_id):
+    def _expired_request(self, available):
         """
         """
         current = int(round(time.time() * 1000))
         for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
+            if available[request.block.piece]:
                 if request.added + self.max_pending_time < current:
                     logger.debug('Re-requesting block {block} for '
                                  'piece {piece}'.format(
@@ -235,9 +462,9 @@ class DownloadManager:
                     return request.block
         return None
 
-    def _next_ongoing(self, peer_id):
+    def _next_ongoing(self, available):
         for piece in self.ongoing_pieces:
-            if self.peers[peer_id][piece.index]:
+            if available[piece.index]:
                 # Is there any blocks left to request in this piece?
                 block = piece.next_request()
                 if block:
@@ -246,35 +473,195 @@ class DownloadManager:
                     return block
         return None
 
-    def _next_missing(self, peer_id):
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
-                # Move this piece from missing to ongoing
-                piece = self.missing_pieces.pop(index)
+    def _next_deadline(self, peer_id, available, pieces):
+        """Next block of the pieces due soon, or a block requested before
+        of a piece about to be late.
+        """
+        for index in pieces:
+            if not available[index]:
+                continue
+            piece = self.pieces[index]
+            if self.missing[index]:
+                self.missing[index] = 0
                 self.ongoing_pieces.append(piece)
-                # The missing pieces does not have any previously requested
-                # blocks (then it is ongoing).
-                return piece.next_request()
+            block = piece.next_request()
+            if block:
+                self.pending_blocks.append(
+                    PendingRequest(block, int(round(time.time() * 1000))))
+                return block
+        # Only the pieces right ahead of the position are duplicated
+        urgent = self.deadline_range(DUPLICATE_TIME)
+        for index in pieces:
+            if index not in urgent:
+                break
+            if not available[index]:
+                continue
+            for block in self.pieces[index].blocks:
+                key = (index, block.offset)
+                if block.status is Block.Pending and \
+                        key not in self.duplicated:
+                    logger.debug('Duplicating request of block {} of piece '
+                                 '{}'.format(block.offset, index))
+                    self.duplicated[key] = peer_id
+                    self.pending_blocks.append(PendingRequest(
+                        block, int(round(time.time() * 1000))))
+                    return block
         return None
 
+    def _first_missing(self, available):
+        """First missing piece of `available`, when streaming the first
+        one from the playback position on.
+        """
+        candidates = available & self.missing
+        if self.position is not None:
+            start = self.position // self.torrent.info.piece_length
+            for index in candidates.indexes():
+                if index >= start:
+                    return index
+        return candidates.first()
+
+    def _next_missing(self, peer_id, available):
+        index = None
+        suggested = self.suggested.get(peer_id)
+        # Suggestions would break the playback order
+        while suggested and index is None and self.position is None:
+            candidate = suggested.pop(0)
+            if available[candidate] and self.missing[candidate]:
+                index = candidate
+        if index is None:
+            index = self._first_missing(available)
+        if index is None:
+            return None
+        # Move this piece from missing to ongoing
+        self.missing[index] = 0
+        piece = self.pieces[index]
+        self.ongoing_pieces.append(piece)
+        # The missing pieces does not have any previously requested
+        # blocks (then it is ongoing).
+        return piece.next_request()
+
+    def next_range(self, peer_id, max_length):
+        """Consecutive blocks for one ranged request of a web seed: a run
+        of missing pieces or, once every piece is started, the next blocks
+        of an ongoing piece nobody requested yet.
+
+        :param max_length: Bytes to request at most, at least one piece is
+                           taken from the missing ones.
+        :return Blocks in payload order, empty if there is nothing left.
+        """
+        if peer_id not in self.peers:
+            return []
+        available = self.peers[peer_id]
+        index = self._first_missing(available)
+        if index is not None:
+            blocks = []
+            length = 0
+            while index < self.total_pieces and available[index] and \
+                    self.missing[index]:
+                piece = self.pieces[index]
+                if blocks and length + piece.length > max_length:
+                    break
+                self.missing[index] = 0
+                self.ongoing_pieces.append(piece)
+                blocks.extend(piece.blocks)
+                length += piece.length
+                index += 1
+            return self._mark_pending(blocks)
+        for piece in self.ongoing_pieces:
+            if not available[piece.index]:
+                continue
+            blocks = []
+            length = 0
+            for block in piece.blocks:
+                if block.status is Block.Missing and \
+                        length + block.length <= max_length:
+                    blocks.append(block)
+                    length += block.length
+                elif blocks:
+                    break
+            if blocks:
+                return self._mark_pending(blocks)
+        return []
+
+    def _mark_pending(self, blocks):
+        added = int(round(time.time() * 1000))
+        for block in blocks:
+            block.status = Block.Pending
+            self.pending_blocks.append(PendingRequest(block, added))
+        return blocks
+
     def _write(self, piece):
         pos = piece.index * self.torrent.info.piece_length
         os.lseek(self.fd, pos, os.SEEK_SET)
         os.write(self.fd, piece.data)
 
     def close(self):
+        if self.have_handle is not None:
+            self.have_handle.cancel()
+            self.have_handle = None
+        for stream in list(self.streams):
+            stream.close()
+        self.cache.clear()
+        self.file_reader.close()
         if self.fd:
             os.close(self.fd)
 
 
 class Client:
-    def __init__(self):
+    # Seconds the trackers get to acknowledge the stopped event
+    BYE_TIMEOUT = 5
+    # Seconds between two announces until a tracker tells otherwise
+    ANNOUNCE_INTERVAL = 15 * 60
+    # Seconds between two DHT lookups of the torrent
+    DHT_INTERVAL = 15 * 60
+
+    def __init__(self, max_connections=2, transport='stream', pex=True,
+                 host='0.0.0.0', port=0, dht=None, lsd=None, web_seeds=True,
+                 stream_rate=None, stream_position=0):
+        """
+        :param host: Address peers connect to while we download.
+        :param port: Port of `host`, 0 picks a free one and None doesn't
+                     accept connections. Verified pieces are uploaded
+                     either way to the peers we connect to.
+        :param dht: A started `DHTNode`, peers are looked up on the DHT
+                    next to the trackers and we announce ourselves there.
+        :param lsd: A started `LocalServiceDiscovery`, peers it finds on
+                    the local network are dialed before all others.
+        :param web_seeds: Download from the HTTP servers in the `url-list`
+                          of the torrent (BEP 19) next to the peers.
+        :param stream_rate: Playback rate in bytes/s to stream the download
+                            at from `stream_position`, `stream` then reads
+                            the verified bytes in order.
+        """
+        self.max_connections = max_connections
+        # Announced to the trackers and sent in every handshake
+        self.peer_id = generate_peer_id()
+        self.connection_class = PEER_TRANSPORTS[transport]
+        self.pex = pex
+        self.host = host
+        self.port = port
         self.tracker = None
-        self.available_peers = asyncio.Queue()
+        self.available_peers = PeerQueue()
         self.peers = []
         self.download_manager = None
+        self.uploader = None
+        self.server = None
+        self.dht = dht
+        self.dht_task = None
+        self.lsd = lsd
+        self.use_web_seeds = web_seeds
+        self.web_seeds = []
+        self.stream_rate = stream_rate
+        self.stream_position = stream_position
+        self.stream = None
         self.abort = False
 
+    @property
+    def bytes_uploaded(self):
+        if self.uploader is None:
+            return 0
+        return self.uploader.request_handler.uploaded
+
     def on_block_complete(self, peer_id,
                           piece_index, block_offset, data):
         self.download_manager.on_block_complete(
@@ -287,30 +674,94 @@ class Client:
         torrent = parse(path)
         torrent.print_all_info()
 
-        if torrent.announce.startswith(b'http'):
-            tracker = HTTPTracker(url=torrent.announce,
-                                  size=torrent.info.length,
-                                  info_hash=torrent.hash)
-            self.tracker = tracker
+        # Peers of trackers answering after the first are dialed as they
+        # arrive
+        tracker = MultiTracker(torrent.tiers, size=torrent.info.length,
+                               info_hash=torrent.hash,
+                               on_peers=self.available_peers.add,
+                               peer_id=self.peer_id)
+        web_seeds = torrent.web_seeds if self.use_web_seeds else []
+        if torrent.files and web_seeds:
+            logger.info('Web seeds of multi file torrents are not supported')
+            web_seeds = []
+        # Sources of pieces or peers besides the trackers
+        others = self.dht is not None or self.lsd is not None or web_seeds
+        if not tracker.trackers and not others:
+            logger.info("None of the trackers {} is supported".format(
+                torrent.tiers))
+            exit(1)
+        self.tracker = tracker
+        self.download_manager = DownloadManager(torrent, savedir)
+        if self.stream_rate is not None:
+            self.stream = self.download_manager.stream(
+                self.stream_position, rate=self.stream_rate)
+        self.web_seeds = [WebSeed(url, self.download_manager,
+                                  on_block_complete=self.on_block_complete)
+                          .start() for url in web_seeds]
+        await self.start_uploader(torrent)
+        port = None
+        if self.server is not None:
+            port = tracker.port = self.server.sockets[0].getsockname()[1]
+        if self.dht is not None:
+            self.dht_task = asyncio.ensure_future(self.search_dht(torrent))
+        if self.lsd is not None:
+            self.lsd.add(torrent.hash, port=port,
+                         on_peers=partial(self.available_peers.add,
+                                          preferred=True))
+        try:
             resp = await tracker.announce()
             self.previous = time.time()
             logger.debug("Tracker Resp: {}".format(resp))
-            self.download_manager = DownloadManager(torrent, savedir)
-            for peer in resp.peers:
-                self.available_peers.put_nowait(peer)
-            self.peers = [PeerConnection(
-                info_hash=torrent.hash,
-                peer_id=tracker.peer_id,
-                available_peers=self.available_peers,
-                download_manager=self.download_manager,
-                on_block_complete=self.on_block_complete)
-                          for _ in range(2)]
-
-            await self.monitor()
-
-        elif torrent.announce.startswith(b'udp'):
-            logger.info("UDP tracker isn't supported")
-            exit(1)
+        except TrackerError as e:
+            if not others:
+                raise
+            # Carry on with the peers of the DHT or LAN and the web seeds,
+            # the monitor retries
+            logger.info('Announce failed: {}'.format(e))
+            self.previous = time.time() - self.ANNOUNCE_INTERVAL + \
+                MultiTracker.BACKOFF
+        self.peers = [self.connection_class(
+            info_hash=torrent.hash,
+            peer_id=self.peer_id,
+            available_peers=self.available_peers,
+            download_manager=self.download_manager,
+            on_block_complete=self.on_block_complete,
+            pex=self.pex,
+            uploader=self.uploader)
+                      for _ in range(self.max_connections)]
+
+        await self.monitor()
+
+    async def start_uploader(self, torrent):
+        """Serve the pieces of the download as they are verified, to the
+        peers we connect to and, with a `port`, to peers connecting to us.
+        """
+        self.uploader = TorrentServer(
+            torrent, download_manager=self.download_manager,
+            peer_id=self.peer_id).setup()
+        if self.port is not None:
+            loop = asyncio.get_event_loop()
+            self.server = await loop.create_server(
+                self.uploader, host=self.host, port=self.port)
+            logger.info('Accepting peers on port {}'.format(
+                self.server.sockets[0].getsockname()[1]))
+
+    async def search_dht(self, torrent):
+        """Look up the peers of the torrent on the DHT every
+        `DHT_INTERVAL` seconds, queueing them as they are found.
+        """
+        port = None
+        if self.server is not None:
+            port = self.server.sockets[0].getsockname()[1]
+        while not self.abort:
+            try:
+                peers = await self.dht.announce(
+                    torrent.hash, port=port,
+                    on_peers=self.available_peers.add)
+                logger.info('DHT returned {} peers'.format(len(peers)))
+            except DHTError as e:
+                logger.info('DHT lookup failed: {}'.format(e))
+            await asyncio.sleep(self.DHT_INTERVAL)
 
     def get_filesize(self, name):
         return os.path.getsize(name)
@@ -319,12 +770,16 @@ class Client:
         torrent = parse(path)
         self.torrent = torrent
 
-    async def upload(self):
+    async def upload(self, port=BaseTracker.PORT):
+        """Announce the parsed torrent as complete.
+
+        :param port: Port the seeding server listens on.
+        """
         torrent = self.torrent
-        if torrent.announce.startswith(b'http'):
-            tracker = HTTPTracker(url=torrent.announce,
-                                  size=torrent.info.length,
-                                  info_hash=torrent.hash)
+        tracker = MultiTracker(torrent.tiers, size=torrent.info.length,
+                               info_hash=torrent.hash, port=port,
+                               peer_id=self.peer_id)
+        if tracker.trackers:
             downloaded = self.get_filesize(torrent.name)
             resp = await tracker.connect(
                 first=False, uploaded=0,
@@ -335,7 +790,7 @@ class Client:
 
     async def monitor(self):
         # Interval in seconds
-        interval = 15 * 60
+        interval = self.ANNOUNCE_INTERVAL
 
         while True:
             if self.download_manager.complete:
@@ -347,31 +802,62 @@ class Client:
 
             current = time.time()
             if (self.previous + interval < current):
-                response = await self.tracker.connect(
-                    first=self.previous if self.previous else False,
-                    uploaded=self.download_manager.bytes_uploaded,
-                    downloaded=self.download_manager.bytes_downloaded)
+                # The trackers queue their peers as they answer
+                self.available_peers.clear()
+                try:
+                    response = await self.tracker.connect(
+                        first=False, uploaded=self.bytes_uploaded,
+                        downloaded=self.download_manager.bytes_downloaded)
+                except TrackerError as e:
+                    logger.info('Announce failed: {}'.format(e))
+                    # Try again once the first backoff is over
+                    self.previous = current - interval + MultiTracker.BACKOFF
+                    continue
                 logger.debug('Tracker response: {}'.format(response))
-                if response:
-                    self.previous = current
+                self.previous = current
+                if response.interval:
                     interval = response.interval
-                    self._empty_queue()
-                    for peer in response.peers:
-                        self.available_peers.put_nowait(peer)
             else:
                 await asyncio.sleep(0.1)
         self.stop()
 
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
-
     def stop(self):
         self.abort = True
+        if self.server is not None:
+            self.server.close()
+        for connection in list(self.download_manager.connections):
+            connection.drop('Download stopped')
         [peer.stop() for peer in self.peers]
+        for web_seed in self.web_seeds:
+            web_seed.stop()
         self.download_manager.close()
         self.tracker.close()
-
-    def close(self):
-        # TODO: Fix uploaded
-        self.tracker.bye(uploaded=0, downloaded=downloaded)
+        if self.dht_task is not None:
+            self.dht_task.cancel()
+            self.dht_task = None
+        if self.lsd is not None:
+            self.lsd.remove(self.download_manager.torrent.hash)
+
+    async def close(self):
+        """Tell the trackers we stopped and close their connections."""
+        if self.tracker is not None:
+            if self.download_manager is not None:
+                downloaded = self.download_manager.bytes_downloaded
+            else:
+                downloaded = self.get_filesize(self.torrent.name)
+            byes = self.tracker.bye(uploaded=self.bytes_uploaded,
+                                    downloaded=downloaded)
+            if byes:
+                done, pending = await asyncio.wait(
+                    byes, timeout=self.BYE_TIMEOUT)
+                for bye in pending:
+                    bye.cancel()
+                for bye in done:
+                    if bye.exception() is not None:
+                        logger.info('Stopped event failed: {}'.format(
+                            bye.exception()))
+        if self.dht is not None:
+            self.dht.close()
+        if self.lsd is not None:
+            self.lsd.close()
+        await close_http_session()
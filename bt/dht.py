@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+Mainline DHT (BEP 5), trackerless peer discovery.
+
+A Kademlia node speaking KRPC, bencoded queries and responses over UDP.
+Nodes are kept in k-buckets of a routing table split around our own id,
+lookups ask the `ALPHA` closest nodes not asked yet at a time until the
+`K` closest nodes answered. `get_peers` lookups collect the peers of an
+info hash and a write token of every node they asked, `announce_peer`
+hands the tokens back to store our address on the closest nodes.
+
+The node id and the good nodes of the routing table are saved to
+`state_path`, the next start bootstraps from them instead of only the
+public routers.
+"""
+
+import os
+import time
+import heapq
+import random
+import socket
+import struct
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import bencodepy
+
+from .logger import get_logger
+from .peers import decode_compact, encode_compact
+
+
+logger = get_logger()
+
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881),
+                   ('router.utorrent.com', 6881),
+                   ('dht.transmissionbt.com', 6881)]
+
+ID_SIZE = 20
+ID_SPACE = 2 ** (ID_SIZE * 8)
+# Nodes per bucket and nodes a lookup converges on
+K = 8
+# Queries in flight per lookup
+ALPHA = 3
+# id, IPv4 address, port
+COMPACT_NODE = struct.Struct('>20s4sH')
+
+# Queries a node may fail in a row before it is dropped
+MAX_FAILURES = 2
+# A node not heard from for this many seconds is pinged before it is
+# replaced by a new one
+QUESTIONABLE_AFTER = 15 * 60
+# Buckets without changes are refreshed with a lookup after this long
+REFRESH_INTERVAL = 15 * 60
+# Seconds between two rotations of the token secret, tokens of the
+# previous secret are still accepted
+TOKEN_INTERVAL = 5 * 60
+# Seconds an announced peer is kept
+PEER_LIFETIME = 30 * 60
+# Peers returned for an info hash
+MAX_VALUES = 50
+# Info hashes and peers per info hash stored for other nodes, the entries
+# expiring first make room for new ones
+MAX_STORED_HASHES = 1000
+MAX_STORED_PEERS = 200
+MAINTENANCE_INTERVAL = 60
+
+# KRPC error codes
+GENERIC_ERROR = 201
+PROTOCOL_ERROR = 203
+METHOD_UNKNOWN = 204
+
+
+class DHTError(Exception):
+    pass
+
+
+def random_id():
+    return os.urandom(ID_SIZE)
+
+
+def is_id(value):
+    return isinstance(value, bytes) and len(value) == ID_SIZE
+
+
+def decode_nodes(data):
+    """Decode nodes in compact format into `Node` objects."""
+    size = COMPACT_NODE.size
+    nodes = []
+    for offset in range(0, len(data) - size + 1, size):
+        node_id, ip, port = COMPACT_NODE.unpack_from(data, offset)
+        if port:
+            nodes.append(Node(node_id, (socket.inet_ntoa(ip), port)))
+    return nodes
+
+
+def encode_nodes(nodes):
+    return b''.join(COMPACT_NODE.pack(node.id,
+                                      socket.inet_aton(node.address[0]),
+                                      node.address[1])
+                    for node in nodes)
+
+
+class Node:
+    __slots__ = ('id', 'key', 'address', 'last_seen', 'failures')
+
+    def __init__(self, node_id, address):
+        self.id = node_id
+        self.key = int.from_bytes(node_id, 'big')
+        self.address = address
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    def __repr__(self):
+        return '<Node({}, {})>'.format(self.id.hex()[:8], self.address)
+
+
+class Bucket:
+    """Nodes with keys in `[low, high)`, least recently seen first."""
+    __slots__ = ('low', 'high', 'nodes', 'changed')
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.nodes = OrderedDict()
+        self.changed = time.monotonic()
+
+    def covers(self, key):
+        return self.low <= key < self.high
+
+
+class RoutingTable:
+    """
+    k-buckets covering the id space. Only the bucket our own id falls into
+    is split when full, so the table knows many nodes close to us and a
+    few far away.
+    """
+
+    def __init__(self, node_id, k=K):
+        self.id = node_id
+        self.key = int.from_bytes(node_id, 'big')
+        self.k = k
+        self.buckets = [Bucket(0, ID_SPACE)]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket.nodes.values()
+
+    def bucket(self, key):
+        for bucket in self.buckets:
+            if bucket.covers(key):
+                return bucket
+
+    def get(self, node_id):
+        return self.bucket(int.from_bytes(node_id, 'big')).nodes.get(
+            node_id)
+
+    def add(self, node_id, address):
+        """Add a node or mark it as seen.
+
+        :return False if its bucket is full.
+        """
+        if node_id == self.id:
+            return True
+        key = int.from_bytes(node_id, 'big')
+        bucket = self.bucket(key)
+        node = bucket.nodes.get(node_id)
+        if node is not None:
+            node.address = address
+            node.last_seen = time.monotonic()
+            node.failures = 0
+            bucket.nodes.move_to_end(node_id)
+            bucket.changed = node.last_seen
+            return True
+        if len(bucket.nodes) < self.k:
+            bucket.nodes[node_id] = Node(node_id, address)
+            bucket.changed = time.monotonic()
+            return True
+        if bucket.covers(self.key) and bucket.high - bucket.low > self.k:
+            self.split(bucket)
+            return self.add(node_id, address)
+        return False
+
+    def split(self, bucket):
+        middle = (bucket.low + bucket.high) // 2
+        upper = Bucket(middle, bucket.high)
+        bucket.high = middle
+        for node_id in [node_id for node_id, node in bucket.nodes.items()
+                        if node.key >= middle]:
+            upper.nodes[node_id] = bucket.nodes.pop(node_id)
+        self.buckets.insert(self.buckets.index(bucket) + 1, upper)
+
+    def remove(self, node_id):
+        bucket = self.bucket(int.from_bytes(node_id, 'big'))
+        bucket.nodes.pop(node_id, None)
+
+    def failed(self, node_id):
+        """Count a query the node didn't answer, dropping it after
+        `MAX_FAILURES` in a row.
+        """
+        node = self.get(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        if node.failures >= MAX_FAILURES:
+            self.remove(node_id)
+
+    def questionable(self, node_id):
+        """The least recently seen node of the full bucket of `node_id`,
+        if it wasn't heard from for `QUESTIONABLE_AFTER` seconds.
+        """
+        bucket = self.bucket(int.from_bytes(node_id, 'big'))
+        oldest = next(iter(bucket.nodes.values()), None)
+        if oldest is not None and \
+                time.monotonic() - oldest.last_seen >= QUESTIONABLE_AFTER:
+            return oldest
+        return None
+
+    def closest(self, target, count=K):
+        key = int.from_bytes(target, 'big')
+        return heapq.nsmallest(count, self, key=lambda node: node.key ^ key)
+
+    def stale_buckets(self):
+        now = time.monotonic()
+        return [bucket for bucket in self.buckets
+                if now - bucket.changed >= REFRESH_INTERVAL]
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    """
+    A DHT node on one UDP socket.
+
+    :param node_id: Our id, a random one unless restored from `state_path`.
+    :param bootstrap: `(host, port)` of nodes to join the DHT through.
+    :param state_path: File the node id and routing table are saved to.
+    """
+    QUERY_TIMEOUT = 2.0
+
+    def __init__(self, node_id=None, bootstrap=BOOTSTRAP_NODES,
+                 state_path=None):
+        self.state_path = state_path
+        self.saved_nodes = []
+        saved_id = self.load() if state_path is not None else None
+        self.id = node_id or saved_id or random_id()
+        self.table = RoutingTable(self.id)
+        self.bootstrap_nodes = list(bootstrap)
+        self.transport = None
+        self.address = None
+        # transaction id -> (address, future of the response)
+        self.transactions = {}
+        self.next_transaction = random.getrandbits(16)
+        self.secrets = [os.urandom(8), os.urandom(8)]
+        self.secret_changed = time.monotonic()
+        # info hash -> {(host, port): time.monotonic() it expires at}
+        self.storage = {}
+        # Nodes being pinged before they are replaced
+        self.checking = set()
+        self.maintenance = None
+        self.handlers = {b'ping': self.on_ping,
+                         b'find_node': self.on_find_node,
+                         b'get_peers': self.on_get_peers,
+                         b'announce_peer': self.on_announce_peer}
+
+    async def start(self, host='0.0.0.0', port=0):
+        """Open the socket and join the DHT."""
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self,
+                                            local_addr=(host, port))
+        self.address = self.transport.get_extra_info('sockname')[:2]
+        self.maintenance = asyncio.ensure_future(self.maintain())
+        await self.bootstrap()
+        logger.info('DHT node on port {} knows {} nodes'.format(
+            self.address[1], len(self.table)))
+        return self
+
+    def close(self):
+        if self.maintenance is not None:
+            self.maintenance.cancel()
+            self.maintenance = None
+        if self.transport is not None:
+            self.save()
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        for _, future in self.transactions.values():
+            if not future.done():
+                future.set_exception(DHTError('Socket closed'))
+
+    def error_received(self, exc):
+        logger.debug('DHT socket error: {}'.format(exc))
+
+    # Persistence
+
+    def load(self):
+        """Read the saved node id and nodes, None without a saved state."""
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = bencodepy.decode(f.read())
+        except (OSError, bencodepy.DecodingError) as e:
+            logger.debug('No DHT state loaded: {}'.format(e))
+            return None
+        if not isinstance(state, dict):
+            logger.debug('Invalid DHT state')
+            return None
+        nodes = state.get(b'nodes')
+        if isinstance(nodes, bytes):
+            self.saved_nodes = decode_nodes(nodes)
+        node_id = state.get(b'id')
+        return node_id if is_id(node_id) else None
+
+    def save(self):
+        if self.state_path is None:
+            return
+        nodes = sorted(self.table, key=lambda node: node.failures)
+        state = bencodepy.encode({b'id': self.id,
+                                  b'nodes': encode_nodes(nodes)})
+        temporary = self.state_path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(state)
+        os.replace(temporary, self.state_path)
+
+    # KRPC
+
+    def send(self, message, address):
+        if self.transport is not None:
+            self.transport.sendto(bencodepy.encode(message), address)
+
+    async def query(self, address, method, args=None):
+        """Send a query and return the arguments of the response."""
+        if self.transport is None:
+            raise DHTError('Node is closed')
+        self.next_transaction = (self.next_transaction + 1) & 0xffff
+        transaction_id = self.next_transaction.to_bytes(2, 'big')
+        future = asyncio.get_event_loop().create_future()
+        self.transactions[transaction_id] = (address, future)
+        arguments = dict(args or {})
+        arguments[b'id'] = self.id
+        self.send({b't': transaction_id, b'y': b'q', b'q': method,
+                   b'a': arguments}, address)
+        try:
+            return await asyncio.wait_for(future, self.QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise DHTError('{} timed out'.format(address))
+        finally:
+            self.transactions.pop(transaction_id, None)
+
+    def datagram_received(self, data, addr):
+        address = addr[:2]
+        try:
+            message = bencodepy.decode(data)
+        except (bencodepy.DecodingError, ValueError, TypeError):
+            logger.debug('Invalid DHT message from {}'.format(address))
+            return
+        if not isinstance(message, dict):
+            return
+        kind = message.get(b'y')
+        transaction_id = message.get(b't', b'')
+        if kind == b'q':
+            self.query_received(message, transaction_id, address)
+        elif kind in (b'r', b'e'):
+            self.response_received(message, transaction_id, address)
+
+    def response_received(self, message, transaction_id, address):
+        expected, future = self.transactions.get(transaction_id,
+                                                 (None, None))
+        if future is None or future.done() or expected != address:
+            return
+        if message[b'y'] == b'e':
+            future.set_exception(DHTError(message.get(b'e')))
+            return
+        response = message.get(b'r')
+        if not isinstance(response, dict) or not is_id(response.get(b'id')):
+            future.set_exception(DHTError('Invalid response'))
+            return
+        self.node_seen(response[b'id'], address)
+        future.set_result(response)
+
+    def query_received(self, message, transaction_id, address):
+        handler = self.handlers.get(message.get(b'q'))
+        args = message.get(b'a')
+        if handler is None:
+            error = [METHOD_UNKNOWN, b'Method Unknown']
+        elif not isinstance(args, dict) or not is_id(args.get(b'id')):
+            error = [PROTOCOL_ERROR, b'Protocol Error']
+        else:
+            try:
+                response = handler(args, address)
+            except (KeyError, TypeError, ValueError, OSError, struct.error):
+                error = [PROTOCOL_ERROR, b'Protocol Error']
+            else:
+                self.node_seen(args[b'id'], address)
+                response[b'id'] = self.id
+                self.send({b't': transaction_id, b'y': b'r',
+                           b'r': response}, address)
+                return
+        self.send({b't': transaction_id, b'y': b'e', b'e': error}, address)
+
+    def node_seen(self, node_id, address):
+        """Add a node which talked to us, making room for it by pinging
+        a questionable node of its bucket.
+        """
+        if self.table.add(node_id, address):
+            return
+        stale = self.table.questionable(node_id)
+        if stale is not None and stale.id not in self.checking:
+            self.checking.add(stale.id)
+            asyncio.ensure_future(self.replace(stale, node_id, address))
+
+    async def replace(self, stale, node_id, address):
+        try:
+            await self.query(stale.address, b'ping')
+        except DHTError:
+            self.table.remove(stale.id)
+            self.table.add(node_id, address)
+        finally:
+            self.checking.discard(stale.id)
+
+    # Queries we answer
+
+    def token(self, host, secret=None):
+        secret = secret or self.secrets[0]
+        return hashlib.sha1(secret + socket.inet_aton(host)).digest()[:8]
+
+    def on_ping(self, args, address):
+        return {}
+
+    def on_find_node(self, args, address):
+        target = args[b'target']
+        return {b'nodes': encode_nodes(self.table.closest(target))}
+
+    def on_get_peers(self, args, address):
+        info_hash = args[b'info_hash']
+        response = {b'token': self.token(address[0])}
+        now = time.monotonic()
+        peers = [peer for peer, expires in
+                 self.storage.get(info_hash, {}).items() if expires > now]
+        if peers:
+            random.shuffle(peers)
+            response[b'values'] = [encode_compact([peer])
+                                   for peer in peers[:MAX_VALUES]]
+        else:
+            response[b'nodes'] = encode_nodes(self.table.closest(info_hash))
+        return response
+
+    def on_announce_peer(self, args, address):
+        token = args[b'token']
+        if not any(token == self.token(address[0], secret)
+                   for secret in self.secrets):
+            raise ValueError('Bad token')
+        info_hash = args[b'info_hash']
+        port = address[1] if args.get(b'implied_port') else args[b'port']
+        if not is_id(info_hash):
+            raise ValueError('Bad info hash')
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError('Bad port')
+        self.store(info_hash, (address[0], port))
+        return {}
+
+    def store(self, info_hash, peer):
+        """Keep an announced peer for `PEER_LIFETIME` seconds."""
+        peers = self.storage.get(info_hash)
+        if peers is None:
+            if len(self.storage) >= MAX_STORED_HASHES:
+                oldest = min(self.storage,
+                             key=lambda key: max(self.storage[key].values()))
+                del self.storage[oldest]
+            peers = self.storage[info_hash] = {}
+        if peer not in peers and len(peers) >= MAX_STORED_PEERS:
+            del peers[min(peers, key=peers.get)]
+        peers[peer] = time.monotonic() + PEER_LIFETIME
+
+    # Lookups
+
+    async def bootstrap(self):
+        """Ask the saved nodes and the bootstrap nodes for the nodes
+        closest to us.
+        """
+        addresses = [node.address for node in self.saved_nodes]
+        loop = asyncio.get_event_loop()
+        for host, port in self.bootstrap_nodes:
+            try:
+                infos = await loop.getaddrinfo(host, port,
+                                               family=socket.AF_INET,
+                                               type=socket.SOCK_DGRAM)
+            except OSError as e:
+                logger.debug("Can't resolve {}: {}".format(host, e))
+                continue
+            addresses.extend(info[4][:2] for info in infos[:1])
+        responses = await asyncio.gather(
+            *(self.query(address, b'find_node', {b'target': self.id})
+              for address in addresses), return_exceptions=True)
+        seeds = [node for response in responses
+                 if isinstance(response, dict) and
+                 isinstance(response.get(b'nodes', b''), bytes)
+                 for node in decode_nodes(response.get(b'nodes', b''))]
+        await self.lookup(self.id, seeds=seeds)
+
+    async def lookup(self, target, method=b'find_node', seeds=(),
+                     on_peers=None):
+        """Iterative lookup of the `K` nodes closest to `target`.
+
+        :param method: `find_node`, or `get_peers` with an info hash.
+        :param on_peers: Callable receiving lists of new peers found by
+                         `get_peers`, as they arrive.
+        :return The closest nodes which answered as `(node, token)` pairs
+                and the peers found.
+        """
+        key = int.from_bytes(target, 'big')
+
+        def distance(node):
+            return node.key ^ key
+
+        argument = b'target' if method == b'find_node' else b'info_hash'
+        candidates = {node.id: node for node in self.table.closest(target)}
+        for node in seeds:
+            candidates.setdefault(node.id, node)
+        queried = set()
+        answered = []
+        peers = set()
+        running = {}
+        try:
+            while True:
+                closest = heapq.nsmallest(K, answered,
+                                          key=lambda pair: distance(pair[0]))
+                bound = distance(closest[-1][0]) if len(closest) == K \
+                    else ID_SPACE
+                waiting = heapq.nsmallest(
+                    ALPHA - len(running),
+                    (node for node in candidates.values()
+                     if node.id not in queried and node.id != self.id and
+                     distance(node) < bound),
+                    key=distance)
+                for node in waiting:
+                    queried.add(node.id)
+                    task = asyncio.ensure_future(self.query(
+                        node.address, method, {argument: target}))
+                    running[task] = node
+                if not running:
+                    return closest, peers
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node = running.pop(task)
+                    try:
+                        response = task.result()
+                    except DHTError:
+                        self.table.failed(node.id)
+                        continue
+                    nodes = response.get(b'nodes', b'')
+                    values = response.get(b'values', [])
+                    if not isinstance(nodes, bytes) or \
+                            not isinstance(values, list) or \
+                            not all(isinstance(value, bytes)
+                                    for value in values):
+                        logger.debug('Invalid {} response from {}'.format(
+                            method, node.address))
+                        continue
+                    node = Node(response[b'id'], node.address)
+                    for found in decode_nodes(nodes):
+                        candidates.setdefault(found.id, found)
+                    new = [peer for value in values
+                           for peer in decode_compact(value)
+                           if peer not in peers]
+                    peers.update(new)
+                    if new and on_peers is not None:
+                        on_peers(new)
+                    answered.append((node, response.get(b'token')))
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def get_peers(self, info_hash, on_peers=None):
+        """Peers of `info_hash` stored on the DHT."""
+        _, peers = await self.lookup(info_hash, b'get_peers',
+                                     on_peers=on_peers)
+        return list(peers)
+
+    async def announce(self, info_hash, port=None, on_peers=None):
+        """Look up the peers of `info_hash` and, with a `port`, store our
+        address on the closest nodes which gave us a token.
+
+        :param port: Port peers connect to, None to only look up peers.
+        :return The peers found.
+        """
+        closest, peers = await self.lookup(info_hash, b'get_peers',
+                                           on_peers=on_peers)
+        if port is not None:
+            announces = [self.query(node.address, b'announce_peer',
+                                    {b'info_hash': info_hash,
+                                     b'port': port,
+                                     b'token': token})
+                         for node, token in closest if token]
+            results = await asyncio.gather(*announces,
+                                           return_exceptions=True)
+            stored = sum(1 for result in results
+                         if not isinstance(result, Exception))
+            logger.debug('Announced to {} DHT nodes'.format(stored))
+        return list(peers)
+
+    # Maintenance
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            self.expire()
+            for bucket in self.table.stale_buckets():
+                target = random.randrange(bucket.low, bucket.high)
+                bucket.changed = time.monotonic()
+                try:
+                    await self.lookup(target.to_bytes(ID_SIZE, 'big'))
+                except DHTError as e:
+                    logger.debug('Bucket refresh failed: {}'.format(e))
+            self.save()
+
+    def expire(self):
+        now = time.monotonic()
+        if now - self.secret_changed >= TOKEN_INTERVAL:
+            self.secrets = [os.urandom(8), self.secrets[0]]
+            self.secret_changed = now
+        for info_hash in list(self.storage):
+            peers = self.storage[info_hash]
+            for peer in [peer for peer, expires in peers.items()
+                         if expires <= now]:
+                del peers[peer]
+            if not peers:
+                del self.storage[info_hash]
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Local Service Discovery (BEP 14), finding peers on the same network
+segment through multicast announces.
+
+Every client announces the info hashes it downloads in `BT-SEARCH`
+messages to a multicast group, together with its listen port, when it
+starts a download and every `ANNOUNCE_INTERVAL` seconds. Peers of
+announces for our torrents are handed to the torrent's callback.
+
+Announces go out from a socket of their own rather than the one bound to
+the group port, so a client hearing a new announce for one of its
+torrents answers it by unicast to that socket. A client joining the
+segment learns about the others within a round trip instead of after
+`ANNOUNCE_INTERVAL`, and the answers of a whole fleet starting the same
+download add no multicast traffic.
+"""
+
+import os
+import socket
+import time
+import asyncio
+import binascii
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+LSD_GROUP = ('239.192.152.143', 6771)
+# Seconds between two periodic announces
+ANNOUNCE_INTERVAL = 5 * 60
+# Info hashes per message, keeps the datagram below 1400 bytes
+MAX_INFOHASHES = 20
+# Seconds an announcing peer is remembered after its last announce, and
+# the most remembered per torrent
+SEEN_LIFETIME = 2 * ANNOUNCE_INTERVAL
+MAX_SEEN = 1000
+
+
+def build_search(host, port, info_hashes, cookie):
+    lines = [b'BT-SEARCH * HTTP/1.1',
+             'Host: {}:{}'.format(*host).encode(),
+             'Port: {}'.format(port).encode()]
+    lines.extend(b'Infohash: ' + binascii.hexlify(info_hash)
+                 for info_hash in info_hashes)
+    lines.append(b'cookie: ' + cookie)
+    return b'\r\n'.join(lines) + b'\r\n\r\n\r\n'
+
+
+def parse_search(data):
+    """Port, info hashes and cookie of a `BT-SEARCH` message.
+
+    :raises ValueError: If it isn't a valid one.
+    """
+    lines = data.split(b'\r\n')
+    if lines[0] != b'BT-SEARCH * HTTP/1.1':
+        raise ValueError('Not a BT-SEARCH message')
+    port = None
+    info_hashes = []
+    cookie = None
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == b'port':
+            port = int(value)
+        elif name == b'infohash' and len(value) == 40:
+            info_hashes.append(binascii.unhexlify(value))
+        elif name == b'cookie':
+            cookie = value
+    if not 0 < (port or 0) < 65536:
+        raise ValueError('Invalid port')
+    return port, info_hashes, cookie
+
+
+class _Torrent:
+    __slots__ = ('port', 'on_peers', 'seen')
+
+    def __init__(self, port, on_peers):
+        self.port = port
+        self.on_peers = on_peers
+        # (peer, cookie) of the announces received -> time.monotonic() of
+        # the last one, oldest first. A client restarting on the same port
+        # has a new cookie
+        self.seen = {}
+
+    def seen_before(self, key, now):
+        """Remember an announce, True if the peer announced recently."""
+        recent = self.seen.pop(key, None) is not None
+        self.seen[key] = now
+        while len(self.seen) > MAX_SEEN or \
+                self.seen[next(iter(self.seen))] + SEEN_LIFETIME < now:
+            del self.seen[next(iter(self.seen))]
+        return recent
+
+
+class _Receiver(asyncio.DatagramProtocol):
+    def __init__(self, discovery, answers):
+        self.discovery = discovery
+        self.answers = answers
+
+    def datagram_received(self, data, addr):
+        self.discovery.search_received(data, addr, self.answers)
+
+    def error_received(self, exc):
+        logger.debug('LSD socket error: {}'.format(exc))
+
+
+class LocalServiceDiscovery:
+    """
+    LSD announcer and listener for any number of torrents.
+
+    :param group: Multicast group address and port.
+    :param interface: Address of the interface to join the group on.
+    """
+
+    def __init__(self, group=LSD_GROUP, interface='0.0.0.0'):
+        self.group = group
+        self.interface = interface
+        # Tells our own announces apart, multicast loops them back
+        self.cookie = binascii.hexlify(os.urandom(8))
+        # info hash -> _Torrent
+        self.torrents = {}
+        # Joined to the group, receives the announces of the segment
+        self.listener = None
+        # Sends our announces and receives the answers to them
+        self.transport = None
+        self.announcing = None
+        self.announce_handle = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        group = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Every client on the host listens on the group port
+            group.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                group.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            group.bind(('', self.group[1]))
+            group.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             socket.inet_aton(self.group[0]) +
+                             socket.inet_aton(self.interface))
+            sender.bind((self.interface, 0))
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                              socket.inet_aton(self.interface))
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except OSError:
+            group.close()
+            sender.close()
+            raise
+        self.listener, _ = await loop.create_datagram_endpoint(
+            lambda: _Receiver(self, answers=False), sock=group)
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _Receiver(self, answers=True), sock=sender)
+        self.announcing = asyncio.ensure_future(self.announce_forever())
+        logger.info('Local service discovery on {}:{}'.format(*self.group))
+        return self
+
+    def close(self):
+        if self.announcing is not None:
+            self.announcing.cancel()
+            self.announcing = None
+        if self.announce_handle is not None:
+            self.announce_handle.cancel()
+            self.announce_handle = None
+        for transport in (self.listener, self.transport):
+            if transport is not None:
+                transport.close()
+        self.listener = self.transport = None
+
+    def add(self, info_hash, port, on_peers):
+        """Announce a torrent and pass the `(host, port)` lists of the
+        local peers found for it to `on_peers`.
+
+        :param port: Our listen port, None to only listen for peers.
+        """
+        self.torrents[info_hash] = _Torrent(port, on_peers)
+        # All torrents added in this loop iteration go out together
+        if self.announce_handle is None:
+            self.announce_handle = asyncio.get_event_loop().call_soon(
+                self.announce)
+
+    def remove(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    def announce(self):
+        self.announce_handle = None
+        by_port = {}
+        for info_hash, torrent in self.torrents.items():
+            if torrent.port is not None:
+                by_port.setdefault(torrent.port, []).append(info_hash)
+        for port, info_hashes in by_port.items():
+            self.send(port, info_hashes, self.group)
+
+    def send(self, port, info_hashes, address):
+        if self.transport is None:
+            return
+        for start in range(0, len(info_hashes), MAX_INFOHASHES):
+            self.transport.sendto(build_search(
+                self.group, port, info_hashes[start:start + MAX_INFOHASHES],
+                self.cookie), address)
+
+    async def announce_forever(self):
+        while True:
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+            self.announce()
+
+    def search_received(self, data, addr, answers):
+        """Queue the peer of an announce and answer it, unless it is an
+        answer itself.
+        """
+        try:
+            port, info_hashes, cookie = parse_search(data)
+        except ValueError as e:
+            logger.debug('Invalid LSD message from {}: {}'.format(addr, e))
+            return
+        if cookie == self.cookie:
+            return
+        peer = (addr[0], port)
+        now = time.monotonic()
+        # Answers carry the port of each torrent
+        answer = {}
+        for info_hash in info_hashes:
+            torrent = self.torrents.get(info_hash)
+            if torrent is None:
+                continue
+            logger.debug('LSD peer {} for {}'.format(
+                peer, binascii.hexlify(info_hash)))
+            torrent.on_peers([peer])
+            if answers or torrent.seen_before((peer, cookie), now):
+                continue
+            if torrent.port is not None:
+                answer.setdefault(torrent.port, []).append(info_hash)
+        for port, matched in answer.items():
+            self.send(port, matched, addr[:2])
@@ -3,8 +3,9 @@
 import struct
 from enum import Enum
 
-import bitstring
+import bencodepy
 
+from .bitfield import Bitfield
 from .logger import get_logger
 from .mixins import ReprMixin
 
@@ -13,6 +14,35 @@ logger = get_logger()
 
 REQUEST_SIZE = 2 ** 14
 
+# Reserved handshake bits of the Extension Protocol (BEP 10) in the sixth
+# byte and of the Fast Extension (BEP 6) in the last byte
+EXTENSION_PROTOCOL = 0x10
+FAST_EXTENSION = 0x04
+RESERVED = bytes([0, 0, 0, 0, 0, EXTENSION_PROTOCOL, 0, FAST_EXTENSION])
+
+# Formats are compiled once instead of on every encode/decode
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>Ib')
+HANDSHAKE = struct.Struct('>B19s8s20s20s')
+HAVE = struct.Struct('>IbI')
+REQUEST = struct.Struct('>IbIII')
+PIECE_HEADER = struct.Struct('>IbII')
+PORT = struct.Struct('>IbH')
+
+# Longest block peers may request from us or send us, our own requests
+# are of `REQUEST_SIZE`
+MAX_BLOCK_LENGTH = 2 ** 17
+# Longest length prefix of any message but the bitfield
+MAX_MESSAGE_LENGTH = PIECE_HEADER.size - LENGTH.size + MAX_BLOCK_LENGTH
+
+
+def max_message_length(pieces):
+    """Longest length prefix accepted from the peers of a torrent with
+    `pieces` pieces, its bitfield may be longer than any other message.
+    """
+    return max(MAX_MESSAGE_LENGTH,
+               HEADER.size - LENGTH.size + (pieces + 7) // 8)
+
 
 class MessageID(Enum):
     Choke = 0
@@ -25,11 +55,48 @@ class MessageID(Enum):
     Piece = 7
     Cancel = 8
     Port = 9
+    # Fast Extension (BEP 6)
+    SuggestPiece = 13
+    HaveAll = 14
+    HaveNone = 15
+    RejectRequest = 16
+    AllowedFast = 17
+    # Extension Protocol (BEP 10)
+    Extended = 20
+
+
+# Message id -> message class, filled by `register`
+MESSAGE_TYPES = {}
+
+
+def register(cls):
+    """Class decorator adding the message class to the dispatch table of
+    `decode_message`.
+    """
+    MESSAGE_TYPES[cls.message_id] = cls
+    return cls
+
+
+def decode_message(data):
+    """Decode a single length prefixed message.
+
+    :param data: The whole message, including the 4 byte length prefix.
+    :return The decoded message, or None if the message id is unknown.
+    """
+    if len(data) == LENGTH.size:
+        return KeepAliveMessage()
+    cls = MESSAGE_TYPES.get(data[4])
+    if cls is None:
+        logger.debug('Unsupported message!')
+        return None
+    return cls.decode(data)
 
 
 class BasePeerMessage:
     """Base class of all message received and sent to peers
     """
+    __slots__ = ()
+
     def encode(self):
         raise NotImplementedError
 
@@ -37,6 +104,20 @@ class BasePeerMessage:
         raise NotImplementedError
 
 
+class EmptyMessage(BasePeerMessage):
+    """Base class of the messages without payload, which are always
+    encoded to the same five bytes.
+    """
+    __slots__ = ()
+
+    def encode(self):
+        return self.encoded
+
+    @classmethod
+    def decode(cls, data):
+        return cls()
+
+
 class HandshakeMessage(BasePeerMessage, ReprMixin):
     """
     Format:
@@ -46,12 +127,27 @@ class HandshakeMessage(BasePeerMessage, ReprMixin):
         pstr = "BitTorrent protocol".
     Thus length is:
         49 + len(pstr) = 68 bytes long.
+
+    The reserved bytes advertise protocol extensions, we always set the
+    Extension Protocol and Fast Extension bits.
     """
+    __slots__ = ('info_hash', 'peer_id', 'reserved')
     __repr_fields__ = ['info_hash', 'peer_id']
 
-    def __init__(self, info_hash, peer_id):
+    def __init__(self, info_hash, peer_id, reserved=RESERVED):
         self.info_hash = info_hash
         self.peer_id = peer_id
+        self.reserved = reserved
+
+    @property
+    def fast(self):
+        """True if the sender supports the Fast Extension."""
+        return bool(self.reserved[7] & FAST_EXTENSION)
+
+    @property
+    def extended(self):
+        """True if the sender supports the Extension Protocol."""
+        return bool(self.reserved[5] & EXTENSION_PROTOCOL)
 
     def encode(self):
         """
@@ -59,11 +155,10 @@ class HandshakeMessage(BasePeerMessage, ReprMixin):
         :param peer_id: Unique ID of the peer.
         """
         # Single Byte, 19 character string, 8 byte padding, 20 byte info _hash, 20 byte peer_id  # NOQA
-        format = '>B19s8x20s20s'
-        return struct.pack(
-            format,
+        return HANDSHAKE.pack(
             19,
             b'BitTorrent protocol',
+            self.reserved,
             self.info_hash,
             self.peer_id)
 
@@ -73,98 +168,110 @@ class HandshakeMessage(BasePeerMessage, ReprMixin):
         """
         logger.debug('Decoding Handshake of length: {length}'.format(
             length=len(data)))
-        if len(data) < (49 + 19):
+        if len(data) < HANDSHAKE.size:
             return None
-        parts = struct.unpack('>B19s8x20s20s', data)
-        return cls(info_hash=parts[2], peer_id=parts[3])
+        parts = HANDSHAKE.unpack_from(data)
+        return cls(info_hash=parts[3], peer_id=parts[4], reserved=parts[2])
 
 
-class InterestedMessage(BasePeerMessage):
+@register
+class InterestedMessage(EmptyMessage):
     """
     Format:
        <len=0001><id=2>
     """
-    def encode(self):
-        return struct.pack('>Ib', 1, MessageID.Interested.value)
+    __slots__ = ()
+    message_id = MessageID.Interested.value
+    encoded = HEADER.pack(1, message_id)
 
 
+@register
 class BitFieldMessage(BasePeerMessage, ReprMixin):
     """
     Format: <len=0001+X><id=5><bitfield>
     """
+    __slots__ = ('bitfield',)
     __repr_fields__ = ['bitfield']
+    message_id = MessageID.BitField.value
 
-    def __init__(self, data=None, val=None):
-        if val:
-            self.bitfield = bitstring.BitArray(val)
-        else:
-            self.bitfield = bitstring.BitArray(bytes=data)
+    def __init__(self, bitfield):
+        self.bitfield = bitfield
 
     def encode(self):
-        bit_length = len(self.bitfield)
-        return struct.pack('>Ib'+ str(bit_length) + 's',
-                           1 + bit_length,
-                           MessageID.BitField.value,
-                           self.bitfield.bytes)
+        data = self.bitfield.tobytes()
+        return HEADER.pack(1 + len(data), self.message_id) + data
 
     @classmethod
     def decode(cls, data):
-        length = struct.unpack('>I', data[:4])[0]
+        length = LENGTH.unpack_from(data)[0]
         logger.debug('Decoding bitfield message of length: {}'.format(length))
+        return cls(Bitfield.from_bytes(data[HEADER.size:LENGTH.size + length]))
 
-        parts = struct.unpack('>Ib' + str(length - 1) + 's',
-                              data)
-        return cls(parts[2])
 
-
-class NotInterestedMessage(BasePeerMessage):
+@register
+class NotInterestedMessage(EmptyMessage):
     """
     Format: <len=0001><id=3>
     """
+    __slots__ = ()
+    message_id = MessageID.NotInterested.value
+    encoded = HEADER.pack(1, message_id)
 
 
-class ChokeMessage(BasePeerMessage):
+@register
+class ChokeMessage(EmptyMessage):
     """
     Format: <len=0001><id=0>
     """
+    __slots__ = ()
+    message_id = MessageID.Choke.value
+    encoded = HEADER.pack(1, message_id)
 
 
-class UnchokeMessage(BasePeerMessage):
+@register
+class UnchokeMessage(EmptyMessage):
     """
     Format: <len=0001><id=1>
     """
+    __slots__ = ()
+    message_id = MessageID.Unchoke.value
+    encoded = HEADER.pack(1, message_id)
 
 
+@register
 class HaveMessage(BasePeerMessage, ReprMixin):
     """
     Format: <len=0005><id=4><pieceindex>
 
     Message represents client successfully downloaded a piece.
     """
+    __slots__ = ('index',)
     __repr_fields__ = ['index']
+    message_id = MessageID.Have.value
 
     def __init__(self, index):
         self.index = index
 
     def encode(self):
-        return struct.pack('>IbI',
-                           5, MessageID.Have.value, self.index)
+        return HAVE.pack(5, self.message_id, self.index)
 
     @classmethod
     def decode(cls, data):
         logger.debug("Decoding have message of length: {}".format(len(data)))
-        parts = struct.unpack('>IbI', data)
-        return cls(index=parts[-1])
+        return cls(index=HAVE.unpack_from(data)[2])
 
 
+@register
 class RequestMessage(BasePeerMessage, ReprMixin):
     """This message is used to request partial data from remote peer.
-    
+
     Format: <len=0013><id=6><index><begin><length>
-    
+
     All the requested pieces is of equal size except last one. Last piece will be smaller than rest of the request size.
     """
+    __slots__ = ('index', 'begin', 'length')
     __repr_fields__ = ['index', 'begin', 'length']
+    message_id = MessageID.Request.value
 
     def __init__(self, index, begin, length=REQUEST_SIZE):
         self.index = index
@@ -172,28 +279,30 @@ class RequestMessage(BasePeerMessage, ReprMixin):
         self.length = length
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           MessageID.Request.value,
-                           self.index,
-                           self.begin,
-                           self.length)
+        return REQUEST.pack(13,
+                            self.message_id,
+                            self.index,
+                            self.begin,
+                            self.length)
 
     @classmethod
     def decode(cls, data):
         logger.debug("Decoding request message of length: {}".format(
             len(data)))
-        parts = struct.unpack('>IbIII', data)
+        parts = REQUEST.unpack_from(data)
         return cls(parts[2], parts[3], parts[4])
 
 
+@register
 class PieceMessage(BasePeerMessage, ReprMixin):
     """This is the message which carries actual data :D
 
     Format: <len=0009+X><id=7><index><begin><block>
     X: length of the block
     """
-    __repr_fields__ = ['index', 'begin', 'block']
+    __slots__ = ('index', 'begin', 'block')
+    __repr_fields__ = ['index', 'begin']
+    message_id = MessageID.Piece.value
 
     def __init__(self, index, begin, block):
         self.index = index
@@ -201,32 +310,32 @@ class PieceMessage(BasePeerMessage, ReprMixin):
         self.block = block
 
     def encode(self):
-        length = 9 + len(self.block)
-        format = '>IbII' + str(len(self.block)) + 's'
-        return struct.pack(format, length,
-                           MessageID.Piece.value,
-                           self.index,
-                           self.begin,
-                           self.block)
+        return self.header(self.index, self.begin, len(self.block)) + \
+            self.block
+
+    @classmethod
+    def header(cls, index, begin, length):
+        """Everything of the message up to the block."""
+        return PIECE_HEADER.pack(9 + length, cls.message_id, index, begin)
 
     @classmethod
     def decode(cls, data):
         logger.debug("Decoding PieceMessage of length: {}".format(len(data)))
-        length = struct.unpack('>I', data[:4])[0]
-        try:
-            parts = struct.unpack(
-                '>IbII' + str(length - 9) + 's',
-                data[:length+4])
-            return cls(parts[2], parts[3], parts[4])
-        except struct.error:
-             return None
+        length, _, index, begin = PIECE_HEADER.unpack_from(data)
+        if len(data) < LENGTH.size + length:
+            return None
+        return cls(index, begin,
+                   data[PIECE_HEADER.size:LENGTH.size + length])
 
 
+@register
 class CancelMessage(BasePeerMessage, ReprMixin):
     """
     Format: <len=0013><id=8><index><begin><length>
     """
+    __slots__ = ('index', 'begin', 'block')
     __repr_fields__ = ['index', 'begin', 'block']
+    message_id = MessageID.Cancel.value
 
     def __init__(self, index, begin, block):
         self.index = index
@@ -234,18 +343,16 @@ class CancelMessage(BasePeerMessage, ReprMixin):
         self.block = block
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           MessageID.Cancel.value,
-                           self.index,
-                           self.begin,
-                           self.block)
+        return REQUEST.pack(13,
+                            self.message_id,
+                            self.index,
+                            self.begin,
+                            self.block)
 
     @classmethod
     def decode(cls, data):
         logger.debug('Decoding cancel message of length:{}'.format(len(data)))
-        part = struct.unpack('>IbIII',
-                             data)
+        parts = REQUEST.unpack_from(data)
         return cls(parts[2], parts[3], parts[4])
 
 
@@ -253,9 +360,169 @@ class KeepAliveMessage(BasePeerMessage):
     """
     Format: <len=0000>
     """
-    pass
+    __slots__ = ()
+    encoded = LENGTH.pack(0)
+
+    def encode(self):
+        return self.encoded
+
+    @classmethod
+    def decode(cls, data):
+        return cls()
+
+
+@register
+class PortMessage(BasePeerMessage, ReprMixin):
+    """
+    Format: <len=0003><id=9><listen-port>
+    """
+    __slots__ = ('port',)
+    __repr_fields__ = ['port']
+    message_id = MessageID.Port.value
+
+    def __init__(self, port):
+        self.port = port
+
+    def encode(self):
+        return PORT.pack(3, self.message_id, self.port)
+
+    @classmethod
+    def decode(cls, data):
+        return cls(PORT.unpack_from(data)[2])
+
+
+@register
+class SuggestPieceMessage(BasePeerMessage, ReprMixin):
+    """
+    Format: <len=0005><id=13><pieceindex>
 
+    Hint that downloading the piece would be cheap for the sender, e.g.
+    because it is in its cache.
+    """
+    __slots__ = ('index',)
+    __repr_fields__ = ['index']
+    message_id = MessageID.SuggestPiece.value
 
+    def __init__(self, index):
+        self.index = index
 
-class PortMessage(BasePeerMessage):
-    pass
+    def encode(self):
+        return HAVE.pack(5, self.message_id, self.index)
+
+    @classmethod
+    def decode(cls, data):
+        return cls(HAVE.unpack_from(data)[2])
+
+
+@register
+class HaveAllMessage(EmptyMessage):
+    """
+    Format: <len=0001><id=14>
+
+    Replaces the BitField message of a peer which has every piece.
+    """
+    __slots__ = ()
+    message_id = MessageID.HaveAll.value
+    encoded = HEADER.pack(1, message_id)
+
+
+@register
+class HaveNoneMessage(EmptyMessage):
+    """
+    Format: <len=0001><id=15>
+
+    Replaces the BitField message of a peer which has no piece.
+    """
+    __slots__ = ()
+    message_id = MessageID.HaveNone.value
+    encoded = HEADER.pack(1, message_id)
+
+
+@register
+class RejectRequestMessage(BasePeerMessage, ReprMixin):
+    """
+    Format: <len=0013><id=16><index><begin><length>
+
+    Tells the peer its request will not be served, so the block can be
+    requested elsewhere right away.
+    """
+    __slots__ = ('index', 'begin', 'length')
+    __repr_fields__ = ['index', 'begin', 'length']
+    message_id = MessageID.RejectRequest.value
+
+    def __init__(self, index, begin, length):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def encode(self):
+        return REQUEST.pack(13,
+                            self.message_id,
+                            self.index,
+                            self.begin,
+                            self.length)
+
+    @classmethod
+    def decode(cls, data):
+        parts = REQUEST.unpack_from(data)
+        return cls(parts[2], parts[3], parts[4])
+
+
+@register
+class AllowedFastMessage(BasePeerMessage, ReprMixin):
+    """
+    Format: <len=0005><id=17><pieceindex>
+
+    The piece may be requested even while the sender chokes us.
+    """
+    __slots__ = ('index',)
+    __repr_fields__ = ['index']
+    message_id = MessageID.AllowedFast.value
+
+    def __init__(self, index):
+        self.index = index
+
+    def encode(self):
+        return HAVE.pack(5, self.message_id, self.index)
+
+    @classmethod
+    def decode(cls, data):
+        return cls(HAVE.unpack_from(data)[2])
+
+
+@register
+class ExtendedMessage(BasePeerMessage, ReprMixin):
+    """
+    Format: <len=0002+X><id=20><extended message id><payload>
+
+    Extended message id 0 is the extension handshake, other ids are the
+    ones the receiver assigned to the extension in its handshake. Every
+    payload we support is a bencoded dictionary.
+    """
+    __slots__ = ('extended_id', 'payload')
+    __repr_fields__ = ['extended_id', 'payload']
+    message_id = MessageID.Extended.value
+
+    def __init__(self, extended_id, payload):
+        self.extended_id = extended_id
+        self.payload = payload
+
+    def encode(self):
+        data = bencodepy.encode(self.payload)
+        return HEADER.pack(2 + len(data), self.message_id) + \
+            bytes([self.extended_id]) + data
+
+    @classmethod
+    def decode(cls, data):
+        length = LENGTH.unpack_from(data)[0]
+        if length < 2:
+            return None
+        try:
+            payload = bencodepy.decode(
+                bytes(data[HEADER.size + 1:LENGTH.size + length]))
+        except bencodepy.DecodingError:
+            logger.debug('Invalid extended message payload')
+            return None
+        if not isinstance(payload, dict):
+            return None
+        return cls(data[HEADER.size], payload)
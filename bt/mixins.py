@@ -7,6 +7,7 @@ class ReprMixin:
        fields mentioned in `__repr_fields__`. Output format is:
        <ModelName(field1=value,.., fieldN=value)>
     """
+    __slots__ = ()
 
     def __repr__(self):
         model_name = self.__class__.__name__
@@ -18,3 +19,24 @@ class ReprMixin:
             return "<{}({})>".format(model_name, message)
         else:
             return super().__repr__()
+
+
+class DispatchMixin:
+
+    """Routes messages to the handler registered for their exact type,
+       a single dict lookup instead of a chain of `isinstance` checks.
+       Messages without a handler are ignored, extra arguments of
+       `dispatch` are passed on to the handler.
+    """
+
+    # Replaced by a per instance dict on the first registration
+    _handlers = {}
+
+    def register_handler(self, message_type, handler):
+        self.__dict__.setdefault('_handlers', {})[message_type] = handler
+
+    def dispatch(self, message, *args):
+        handler = self._handlers.get(type(message))
+        if handler is not None:
+            return handler(message, *args)
+        return None
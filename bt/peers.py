@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import asyncio
+import struct
+from functools import partial
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+COMPACT_PEER = struct.Struct('>4sH')
+COMPACT_PEER6 = struct.Struct('>16sH')
+
+
+def _decode(data, peer_format, size, ntoa):
+    # One struct call unpacks every peer and `map` converts the
+    # addresses, no Python code runs per peer
+    count = len(data) // size
+    values = struct.unpack('>' + peer_format * count, data[:count * size])
+    return list(zip(map(ntoa, values[0::2]), values[1::2]))
+
+
+def decode_compact(data):
+    """Decode peers in compact format, 4 byte IPv4 address followed by
+    the port, into `(host, port)` tuples.
+    """
+    return _decode(data, '4sH', COMPACT_PEER.size, socket.inet_ntoa)
+
+
+def decode_compact6(data):
+    """Decode peers in compact IPv6 format, 16 byte address followed by
+    the port.
+    """
+    return _decode(data, '16sH', COMPACT_PEER6.size,
+                   partial(socket.inet_ntop, socket.AF_INET6))
+
+
+def decode_peers(peers):
+    """Decode the `peers` of a tracker response, either a compact string
+    or a list of dicts with `ip` and `port`. Invalid entries are skipped.
+    """
+    if isinstance(peers, bytes):
+        return decode_compact(peers)
+    result = []
+    for peer in peers if isinstance(peers, list) else []:
+        if not isinstance(peer, dict):
+            continue
+        ip, port = peer.get(b'ip'), peer.get(b'port')
+        if not isinstance(ip, bytes) or not isinstance(port, int) or \
+                not 0 < port < 65536:
+            continue
+        try:
+            result.append((ip.decode('ascii'), port))
+        except UnicodeDecodeError:
+            continue
+    return result
+
+
+def is_ipv6(host):
+    return ':' in host
+
+
+def encode_compact(peers):
+    return b''.join(COMPACT_PEER.pack(socket.inet_aton(host), port)
+                    for host, port in peers)
+
+
+def encode_compact6(peers):
+    return b''.join(COMPACT_PEER6.pack(
+        socket.inet_pton(socket.AF_INET6, host), port)
+        for host, port in peers)
+
+
+class PeerQueue(asyncio.Queue):
+    """
+    Addresses of the peers to connect to.
+
+    An address which is already queued or connected is dropped, so the
+    tracker, peer exchange and any later source can feed the queue without
+    coordinating. Connections report back with `connection_made` and
+    `connection_lost`, after which the address may be queued again.
+    Preferred peers, e.g. the ones on the local network, are dialed before
+    all others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.known = set()
+        self.connected = set()
+        self.preferred = set()
+
+    def _put(self, peer):
+        if peer in self.preferred:
+            self._queue.appendleft(peer)
+        else:
+            self._queue.append(peer)
+
+    def put_nowait(self, peer):
+        peer = tuple(peer)
+        if peer in self.known:
+            return
+        self.known.add(peer)
+        super().put_nowait(peer)
+
+    def add(self, peers, preferred=False):
+        """Queue all new addresses in `peers`.
+        :param preferred: Put them in front of the queue, addresses
+                          already queued are moved there.
+        :return Number of addresses queued
+        """
+        queued = len(self.known)
+        for peer in peers:
+            peer = tuple(peer)
+            if preferred:
+                self.preferred.add(peer)
+                if peer in self._queue:
+                    self._queue.remove(peer)
+                    self._queue.appendleft(peer)
+            self.put_nowait(peer)
+        return len(self.known) - queued
+
+    def get_alternate(self, peer):
+        """Take the first queued address of the other address family than
+        `peer`, the first one if there is none.
+        """
+        family = is_ipv6(peer[0])
+        for index, queued in enumerate(self._queue):
+            if is_ipv6(queued[0]) != family:
+                del self._queue[index]
+                return queued
+        return self.get_nowait()
+
+    def connection_made(self, peer):
+        self.connected.add(peer)
+
+    def connection_lost(self, peer):
+        self.connected.discard(peer)
+        self.known.discard(peer)
+
+    def clear(self):
+        """Drop the queued addresses, connected peers are kept."""
+        while not self.empty():
+            self.known.discard(self.get_nowait())
+            self.task_done()
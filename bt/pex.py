@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Peer Exchange (BEP 11) on top of the Extension Protocol (BEP 10)."""
+
+import time
+
+from .logger import get_logger
+from .message import ExtendedMessage
+from .peers import (decode_compact, decode_compact6, encode_compact,
+                    encode_compact6, is_ipv6)
+
+
+logger = get_logger()
+
+# Extended message id we assign to ut_pex in our extension handshake
+UT_PEX = 1
+CLIENT_NAME = b'bt'
+
+# Seconds between two PEX messages on one connection
+PEX_INTERVAL = 60
+# Messages arriving faster than this are ignored
+MIN_RECEIVE_INTERVAL = PEX_INTERVAL / 2
+# Most peers added or dropped in one message
+MAX_PEERS = 50
+
+
+def extension_handshake(port=None):
+    """Payload of the extension handshake we send.
+
+    :param port: Our listen port, if we accept connections.
+    """
+    payload = {b'm': {b'ut_pex': UT_PEX}, b'v': CLIENT_NAME}
+    if port:
+        payload[b'p'] = port
+    return ExtendedMessage(0, payload)
+
+
+class PeerExchange:
+    """
+    ut_pex state of a single connection.
+
+    Peers received are fed into the shared `PeerQueue`, which drops the
+    ones already queued or connected. Outgoing messages advertise a set of
+    peers as changes since the previous message.
+
+    :param peers: `PeerQueue` receiving the peers, None to ignore them.
+    """
+
+    def __init__(self, peers=None):
+        self.peers = peers
+        # Id the remote peer assigned to ut_pex, None if unsupported
+        self.remote_id = None
+        self.advertised = set()
+        self.last_sent = None
+        self.last_received = None
+
+    def handshake_received(self, payload):
+        """
+        :raises ValueError: If the id assigned to ut_pex isn't one byte.
+        """
+        extensions = payload.get(b'm')
+        if not isinstance(extensions, dict):
+            return
+        remote_id = extensions.get(b'ut_pex')
+        if remote_id is None or remote_id == 0:
+            # Not supported or disabled
+            self.remote_id = None
+        elif isinstance(remote_id, int) and 0 < remote_id < 256:
+            self.remote_id = remote_id
+        else:
+            raise ValueError('Invalid ut_pex id {!r}'.format(remote_id))
+
+    def received(self, payload, now=None):
+        """Queue the peers added in a ut_pex message.
+        :return Number of new peers queued
+        :raises ValueError: If the added peers aren't compact strings.
+        """
+        if self.peers is None:
+            return 0
+        added = payload.get(b'added', b'')
+        added6 = payload.get(b'added6', b'')
+        if not isinstance(added, bytes) or not isinstance(added6, bytes):
+            raise ValueError('Invalid ut_pex message')
+        now = time.monotonic() if now is None else now
+        if self.last_received is not None and \
+                now - self.last_received < MIN_RECEIVE_INTERVAL:
+            logger.debug('Ignoring PEX message received too early')
+            return 0
+        self.last_received = now
+        added = decode_compact(added) + decode_compact6(added6)
+        queued = self.peers.add(added[:MAX_PEERS])
+        logger.debug('PEX added {} new peers'.format(queued))
+        return queued
+
+    def next_message(self, peers, now=None):
+        """The ut_pex message due on this connection, if any.
+
+        :param peers: Addresses to advertise, without the remote peer.
+        """
+        if self.remote_id is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if self.last_sent is not None and \
+                now - self.last_sent < PEX_INTERVAL:
+            return None
+        peers = set(peers)
+        added = list(peers - self.advertised)[:MAX_PEERS]
+        dropped = list(self.advertised - peers)[:MAX_PEERS]
+        if not added and not dropped and self.last_sent is not None:
+            return None
+        self.last_sent = now
+        self.advertised.update(added)
+        self.advertised.difference_update(dropped)
+        added6 = [peer for peer in added if is_ipv6(peer[0])]
+        dropped6 = [peer for peer in dropped if is_ipv6(peer[0])]
+        added = [peer for peer in added if not is_ipv6(peer[0])]
+        dropped = [peer for peer in dropped if not is_ipv6(peer[0])]
+        payload = {b'added': encode_compact(added),
+                   b'added.f': bytes(len(added)),
+                   b'dropped': encode_compact(dropped)}
+        if added6 or dropped6:
+            payload[b'added6'] = encode_compact6(added6)
+            payload[b'added6.f'] = bytes(len(added6))
+            payload[b'dropped6'] = encode_compact6(dropped6)
+        return ExtendedMessage(self.remote_id, payload)
@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 
 from enum import Enum
+from collections import deque
 
+import time
 import struct
 import asyncio
 
 from concurrent.futures import CancelledError
 
 from .logger import get_logger
-from .message import (MessageID,
+from .bitfield import Bitfield
+from .mixins import DispatchMixin
+from .writer import MessageWriter
+from .timer import SNUB_TIMEOUT, ConnectionTimersMixin
+from .choker import UploadStateMixin
+from .pex import UT_PEX, PeerExchange, extension_handshake
+from .message import (HANDSHAKE,
+                      MAX_MESSAGE_LENGTH,
+                      decode_message,
+                      max_message_length,
                       InterestedMessage,
                       HandshakeMessage,
                       BitFieldMessage,
@@ -17,9 +28,14 @@ from .message import (MessageID,
                       UnchokeMessage,
                       HaveMessage,
                       RequestMessage,
-                      PieceMessage,
                       CancelMessage,
-                      KeepAliveMessage)
+                      PieceMessage,
+                      SuggestPieceMessage,
+                      HaveAllMessage,
+                      HaveNoneMessage,
+                      RejectRequestMessage,
+                      AllowedFastMessage,
+                      ExtendedMessage)
 
 
 logger = get_logger()
@@ -40,6 +56,96 @@ class PeerState(Enum):
     PendingRequest = 'pending_request'
 
 
+class MessageBuffer:
+    """
+    Receive buffer of a peer connection.
+
+    Incoming data is appended to a growable `bytearray` and messages are
+    consumed by advancing a read offset, so neither appending nor consuming
+    copies the rest of the buffer. The consumed prefix is dropped once it is
+    at least half of the buffer, which keeps the total cost linear in the
+    number of bytes received.
+
+    A length prefix above `max_length`, or a message which can't be
+    decoded, raises `ProtocolError`, the peer is to be dropped.
+    """
+    # Each message is structured as:
+    #     <length prefix><message ID><payload>
+    #
+    # The `length prefix` is a four byte big-endian value
+    # The `message ID` is a decimal byte
+    # The `payload` is the value of `length prefix`
+    #
+    # The message length is not part of the actual length. So another
+    # 4 bytes needs to be included when slicing the buffer.
+    HEADER_LENGTH = 4
+
+    def __init__(self, initial=None, max_length=MAX_MESSAGE_LENGTH):
+        self.data = bytearray(initial if initial else b'')
+        self.offset = 0
+        self.max_length = max_length
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def feed(self, data):
+        self.data += data
+
+    def parse_handshake(self):
+        """Consume the handshake at the start of the buffer.
+
+        :return The `HandshakeMessage`, None until all of it arrived.
+        """
+        if len(self) < HANDSHAKE.size:
+            return None
+        end = self.offset + HANDSHAKE.size
+        message = HandshakeMessage.decode(self.data[self.offset:end])
+        self.offset = end
+        self._compact()
+        return message
+
+    def parse(self):
+        """
+        Parse every complete message available in the buffer.
+        :return List of parsed messages, empty if there is no complete one
+        """
+        messages = []
+        data = self.data
+        offset = self.offset
+        available = len(data)
+        header_length = MessageBuffer.HEADER_LENGTH
+
+        while available - offset >= header_length:
+            message_length = struct.unpack_from('>I', data, offset)[0]
+            if message_length > self.max_length:
+                raise ProtocolError('Message of {} bytes'.format(
+                    message_length))
+            end = offset + header_length + message_length
+            if end > available:
+                logger.debug('Not enough in buffer in order to parse')
+                break
+
+            try:
+                message = decode_message(data[offset:end])
+            except struct.error as e:
+                raise ProtocolError('Invalid message: {}'.format(e))
+            offset = end
+            if message:
+                messages.append(message)
+
+        self.offset = offset
+        self._compact()
+        return messages
+
+    def _compact(self):
+        if self.offset == len(self.data):
+            del self.data[:]
+            self.offset = 0
+        elif self.offset >= len(self.data) // 2:
+            del self.data[:self.offset]
+            self.offset = 0
+
+
 class PeerStreamIterator:
     """
     The `PeerStreamIterator` is an async iterator that continuously reads from
@@ -47,36 +153,53 @@ class PeerStreamIterator:
     off that stream of bytes.
     If the connection is dropped, something fails the iterator will abort by
     raising the `StopAsyncIteration` error ending the calling iteration.
+
+    All complete messages of a read are parsed in one pass. Iterate over
+    `batches()` to receive them as lists instead of one by one.
     """
-    CHUNK_SIZE = 10*1024
+    CHUNK_SIZE = 64*1024
 
-    def __init__(self, reader, initial=None):
+    def __init__(self, reader, initial=None, max_length=MAX_MESSAGE_LENGTH):
         self.reader = reader
-        self.buffer = initial if initial else b''
-        self.i = 0
+        self.buffer = MessageBuffer(initial, max_length)
+        self.messages = deque()
 
-    async def __aiter__(self):
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
+        if not self.messages:
+            self.messages.extend(await self.next_batch())
+        return self.messages.popleft()
+
+    def batches(self):
+        return _BatchIterator(self)
+
+    async def next_batch(self):
+        """Return all messages which can be parsed from the data available,
+        reading from the stream until there is at least one.
+        """
+        if self.messages:
+            messages = list(self.messages)
+            self.messages.clear()
+            return messages
+
         # Read data from the socket. When we have enough data to parse, parse
-        # it and return the message. Until then keep reading from stream
+        # it and return the messages. Until then keep reading from stream
         while True:
             try:
-                if self.buffer:
-                    message = self.parse()
-                    if message:
-                        return message
-                logger.debug('I m stuck at reading from socket')
+                messages = self.buffer.parse()
+                if messages:
+                    return messages
                 data = await self.reader.read(
                     PeerStreamIterator.CHUNK_SIZE)
                 if data:
-                    self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
+                    self.buffer.feed(data)
+                else:
+                    logger.debug('Connection closed by peer')
+                    raise StopAsyncIteration()
             except ConnectionResetError:
-                logging.debug('Connection closed by peer')
+                logger.debug('Connection closed by peer')
                 raise StopAsyncIteration()
             except CancelledError:
                 raise StopAsyncIteration()
@@ -84,127 +207,174 @@ class PeerStreamIterator:
                 # Cath to stop logging
                 raise e
             except Exception:
-                logging.exception('Error when iterating over stream!')
+                logger.exception('Error when iterating over stream!')
                 raise StopAsyncIteration()
-        raise StopAsyncIteration()
 
-    def parse(self):
-        """
-        Tries to parse protocol messages if there is enough bytes read in the
-        buffer.
-        :return The parsed message, or None if no message could be parsed
-        """
-        # Each message is structured as:
-        #     <length prefix><message ID><payload>
-        #
-        # The `length prefix` is a four byte big-endian value
-        # The `message ID` is a decimal byte
-        # The `payload` is the value of `length prefix`
-        #
-        # The message length is not part of the actual length. So another
-        # 4 bytes needs to be included when slicing the buffer.
-        header_length = 4
-
-        if len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0]
-
-            if message_length == 0:
-                return KeepAliveMessage()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack('>b', self.buffer[4:5])[0]
-
-                def _consume():
-                    """Consume the current message from the read buffer"""
-                    self.buffer = self.buffer[header_length + message_length:]
-
-                def _data():
-                    """"Extract the current message from the read buffer"""
-                    return self.buffer[:header_length + message_length]
-
-                if message_id is MessageID.BitField.value:
-                    data = _data()
-                    _consume()
-                    return BitFieldMessage.decode(data)
-                elif message_id is MessageID.Interested.value:
-                    _consume()
-                    return InterestedMessage()
-                elif message_id is MessageID.NotInterested.value:
-                    _consume()
-                    return NotInterestedMessage()
-                elif message_id is MessageID.Choke.value:
-                    _consume()
-                    return ChokeMessage()
-                elif message_id is MessageID.Unchoke.value:
-                    _consume()
-                    return UnchokeMessage()
-                elif message_id is MessageID.Have.value:
-                    data = _data()
-                    _consume()
-                    return HaveMessage.decode(data)
-                elif message_id is MessageID.Piece.value:
-                    data = _data()
-                    _consume()
-                    return PieceMessage.decode(data)
-                elif message_id is MessageID.Request.value:
-                    data = _data()
-                    _consume()
-                    return RequestMessage.decode(data)
-                elif message_id is MessageID.Cancel.value:
-                    data = _data()
-                    _consume()
-                    return CancelMessage.decode(data)
-                else:
-                    logger.debug('Unsupported message!')
-            else:
-                return None
-                logger.debug('Not enough in buffer in order to parse')
-        return None
 
+class _BatchIterator:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.stream.next_batch()
+
+
+class PeerConnection(ConnectionTimersMixin, UploadStateMixin,
+                     DispatchMixin):
+    SNUB_TIMEOUT = SNUB_TIMEOUT
+    CONNECT_TIMEOUT = 3
+    # Seconds a connection attempt gets before the next queued peer is
+    # dialed alongside it
+    DIAL_DELAY = 0.25
 
-class PeerConnection:
     def __init__(self, info_hash, peer_id, available_peers, download_manager,
-                 on_block_complete):
+                 on_block_complete, pex=True, uploader=None):
         """
-        :param peer: (source_ip, port)
+        :param available_peers: `PeerQueue` of the addresses to connect to
+        :param pex: Exchange peers with the remote peer (BEP 11)
+        :param uploader: `TorrentServer` serving the pieces we downloaded,
+                         its request handler and choker take care of the
+                         peer's requests. Without it requests are ignored.
         """
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.available_peers = available_peers
         self.download_manager = download_manager
         self.on_block_complete = on_block_complete
-        self.peer = None
         self.current_state = []
+        self.use_pex = pex
+        self.request_handler = uploader.request_handler if uploader else None
+        self.choker = uploader.choker if uploader else None
+        # Task sending the blocks of queued requests
+        self.serving = None
+        self.reset_connection_state()
+
+        if self.request_handler is not None:
+            for message_type in (InterestedMessage, NotInterestedMessage,
+                                 RequestMessage, CancelMessage):
+                self.register_handler(message_type, self.on_upload_message)
+        self.register_handler(ChokeMessage, self.on_choke)
+        self.register_handler(UnchokeMessage, self.on_unchoke)
+        self.register_handler(HaveMessage, self.on_have)
+        self.register_handler(BitFieldMessage, self.on_bitfield)
+        self.register_handler(PieceMessage, self.on_piece)
+        self.register_handler(HaveAllMessage, self.on_have_all)
+        self.register_handler(HaveNoneMessage, self.on_have_none)
+        self.register_handler(RejectRequestMessage, self.on_reject_request)
+        self.register_handler(AllowedFastMessage, self.on_allowed_fast)
+        self.register_handler(SuggestPieceMessage, self.on_suggest_piece)
+        self.register_handler(ExtendedMessage, self.on_extended)
+        self.future = asyncio.ensure_future(self.start())
+
+    def reset_connection_state(self):
+        """Forget everything about the current peer, the next one dialed
+        starts from scratch.
+        """
+        self.peer = None
         self.remote_id = None
         self.writer = None
         self.reader = None
-
+        self.outgoing = None
+        self.current_state = [state for state in self.current_state
+                              if state == PeerState.Stopped.value]
+        # Fast Extension (BEP 6) negotiated in the handshake, and the pieces
+        # the peer lets us request while choked
+        self.fast = False
+        self.allowed_fast = None
+        self.pex = PeerExchange(self.available_peers) if self.use_pex \
+            else None
+        # Outstanding request, released when the peer snubs us by not
+        # sending it for `SNUB_TIMEOUT` seconds
+        self.pending_block = None
+        self.requested_at = 0
+        self.snubbed = False
+        self.reset_upload_state()
         self.is_interested_msg_sent = False
-        self.future = asyncio.ensure_future(self.start())
+
+    async def dial(self):
+        """Connect to the next reachable peer of the queue.
+
+        Happy eyeballs (RFC 8305) across peers: an attempt which didn't
+        connect within `DIAL_DELAY` seconds is raced by the next queued
+        peer, of the other address family if one is queued, so unreachable
+        addresses don't hold up the connection. The first attempt to
+        connect wins, the others are cancelled and their peers queued
+        again.
+
+        :return The peer and the result of `open_connection`.
+        """
+        attempts = {}
+        peer = None
+        try:
+            while True:
+                if not attempts:
+                    peer = await self.available_peers.get()
+                elif not self.available_peers.empty():
+                    peer = self.available_peers.get_alternate(peer)
+                else:
+                    peer = None
+                if peer is not None:
+                    logger.info('got peer {}'.format(peer))
+                    attempts[asyncio.ensure_future(asyncio.wait_for(
+                        self.open_connection(peer),
+                        self.CONNECT_TIMEOUT))] = peer
+                done, _ = await asyncio.wait(
+                    attempts, timeout=self.DIAL_DELAY,
+                    return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for attempt in done:
+                    failed = attempts.pop(attempt)
+                    try:
+                        connection = attempt.result()
+                    except (asyncio.TimeoutError, OSError) as e:
+                        logger.info("Can't connect to {}: {!r}".format(
+                            failed, e))
+                        self.available_peers.connection_lost(failed)
+                        continue
+                    if winner is None:
+                        winner = (failed, connection)
+                    else:
+                        self.close_connection(connection)
+                        self.requeue(failed)
+                if winner is not None:
+                    return winner
+        finally:
+            for attempt, peer in attempts.items():
+                attempt.cancel()
+                self.requeue(peer)
+
+    def requeue(self, peer):
+        self.available_peers.connection_lost(peer)
+        self.available_peers.add([peer])
+
+    async def open_connection(self, peer):
+        return await asyncio.open_connection(peer[0], peer[1])
+
+    def close_connection(self, connection):
+        """Close a connection `dial` didn't use."""
+        _, writer = connection
+        writer.close()
 
     async def start(self):
+        """Download from one queued peer after the other, a peer which
+        fails the handshake, is dropped or goes away makes room for the
+        next.
+        """
         while PeerState.Stopped.value not in self.current_state:
             try:
-                self.peer = await self.available_peers.get()
-                logger.info('got peer {}'.format(self.peer))
-                fut = asyncio.open_connection(
-                    self.peer[0], self.peer[1])
-                try:
-                    self.reader, self.writer = await asyncio.wait_for(
-                        fut, timeout=3)
-                except asyncio.TimeoutError:
-                    logger.info("Remote peer {} didn't respond".format(
-                        self.peer))
-                    continue
-                except ConnectionRefusedError:
-                    logger.info('Connection refused {}'.format(self.peer))
-                    continue
-
+                self.peer, (self.reader, self.writer) = await self.dial()
+                self.available_peers.connection_made(self.peer)
                 logger.debug('Remote connection with peer {}:{}'.format(
                 *self.peer))
+                self.outgoing = MessageWriter(self.writer)
+                self.start_timers()
 
                 logger.debug('Adding client to choke state')
-                self.current_state.append(PeerState.Choked.value)
+                if PeerState.Choked.value not in self.current_state:
+                    self.current_state.append(PeerState.Choked.value)
 
                 # Do handshake and react accordingly
                 buffer = await self.send_handshake()
@@ -212,146 +382,374 @@ class PeerConnection:
                 # buffer = await self.send_interested()
 
                 # Parse the rest of the message and decide next step.
-                return await self.handle_message(buffer)
-            except (asyncio.TimeoutError, ProtocolError) as e:
+                await self.handle_message(buffer)
+            except (asyncio.TimeoutError, ProtocolError, OSError) as e:
                 logger.debug(e)
+            except Exception:
+                logger.exception('Dropping peer {}'.format(self.peer))
+            finally:
+                self.connection_closed()
 
     async def handle_message(self, buffer):
         if not buffer:
             await self.send_interested()
 
-        async for message in PeerStreamIterator(self.reader, buffer):
+        # Everything that arrived in one read is handled before deciding on
+        # the next request.
+        stream = PeerStreamIterator(
+            self.reader, buffer,
+            max_message_length(self.download_manager.total_pieces))
+        async for messages in stream.batches():
             if PeerState.Stopped.value in self.current_state:
                 break
 
-            if isinstance(message, NotInterestedMessage):
-                try:
-                    logger.debug('Remove interested state')
-                    self.current_state.remove(PeerState.Interested.value)
-                except ValueError:
-                    pass
-            elif isinstance(message, ChokeMessage):
-                logger.debug('Received choke message')
-                self.current_state.append(PeerState.Choked.value)
-            elif isinstance(message, UnchokeMessage):
-                logger.debug('Received unchoke message')
-                try:
-                    logger.debug('Remove choked state')
-                    self.current_state.remove(PeerState.Choked.value)
-                except ValueError:
-                    pass
-            elif isinstance(message, HaveMessage):
-                self.download_manager.update_peer(self.remote_id,
-                                               message.index)
-                logger.debug('Received have message')
-            elif isinstance(message, BitFieldMessage):
-                logger.info('Received bit field message: {}'.format(message))
-                if PeerState.Interested.value not in self.current_state:
-                    await self.send_interested()
-                    logger.debug('Sending interested')
-                self.download_manager.add_peer(peer_id=self.remote_id,
-                                               bitfield=message.bitfield)
-            elif isinstance(message, PieceMessage):
-                logger.debug('Received piece message')
+            self.last_received = time.monotonic()
+            for message in messages:
+                await self.process_message(message)
+            await self.send_next_message()
+
+    async def process_message(self, message):
+        # Handlers which need to send a reply are coroutines
+        result = self.dispatch(message)
+        if result is not None:
+            await result
+
+    def on_choke(self, message):
+        logger.debug('Received choke message')
+        if PeerState.Choked.value not in self.current_state:
+            self.current_state.append(PeerState.Choked.value)
+        # Peers without the Fast Extension drop our requests silently, the
+        # others reject them
+        if not self.fast and self.pending_block is not None:
+            block = self.pending_block
+            self.pending_block = None
+            self.download_manager.block_rejected(
+                peer_id=self.remote_id, piece_index=block.piece,
+                block_offset=block.offset)
+            try:
                 self.current_state.remove(PeerState.PendingRequest.value)
-                self.on_block_complete(peer_id=self.remote_id,
-                                       piece_index=message.index,
-                                       block_offset=message.begin,
-                                       data=message.block)
-            elif isinstance(message, RequestMessage):
-                # TODO: Implement uploading data
-                pass
-            elif isinstance(message, CancelMessage):
-                # TODO: Implement cancel data
+            except ValueError:
                 pass
 
-            await self.send_next_message()
-        self.cancel()
+    def on_unchoke(self, message):
+        logger.debug('Received unchoke message')
+        try:
+            logger.debug('Remove choked state')
+            self.current_state.remove(PeerState.Choked.value)
+        except ValueError:
+            pass
+
+    def on_have(self, message):
+        self.download_manager.update_peer(self.remote_id, message.index)
+        logger.debug('Received have message')
+
+    async def on_bitfield(self, message):
+        logger.info('Received bit field message: {}'.format(message))
+        await self.add_peer(message.bitfield)
+
+    async def on_have_all(self, message):
+        logger.info('Received have all message')
+        await self.add_peer(
+            Bitfield.full(self.download_manager.total_pieces))
+
+    async def on_have_none(self, message):
+        logger.info('Received have none message')
+        await self.add_peer(Bitfield(self.download_manager.total_pieces))
+
+    async def add_peer(self, bitfield):
+        if PeerState.Interested.value not in self.current_state:
+            await self.send_interested()
+            logger.debug('Sending interested')
+        self.download_manager.add_peer(peer_id=self.remote_id,
+                                       bitfield=bitfield)
+
+    def on_reject_request(self, message):
+        logger.debug('Request rejected {}'.format(message))
+        self.download_manager.block_rejected(peer_id=self.remote_id,
+                                             piece_index=message.index,
+                                             block_offset=message.begin)
+        self.pending_block = None
+        try:
+            self.current_state.remove(PeerState.PendingRequest.value)
+        except ValueError:
+            pass
+
+    def on_allowed_fast(self, message):
+        total_pieces = self.download_manager.total_pieces
+        if message.index >= total_pieces:
+            return
+        if self.allowed_fast is None:
+            self.allowed_fast = Bitfield(total_pieces)
+        self.allowed_fast[message.index] = 1
+
+    def on_suggest_piece(self, message):
+        self.download_manager.suggest_piece(peer_id=self.remote_id,
+                                            piece_index=message.index)
+
+    def on_extended(self, message):
+        if self.pex is None:
+            return
+        try:
+            if message.extended_id == 0:
+                logger.debug('Received extension handshake')
+                self.pex.handshake_received(message.payload)
+                self.send_pex()
+            elif message.extended_id == UT_PEX:
+                self.pex.received(message.payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+
+    def send_pex(self):
+        """Advertise our other connections if a PEX message is due."""
+        message = self.pex.next_message(
+            self.available_peers.connected - {self.peer})
+        if message:
+            self.outgoing.send(message)
+
+    def on_piece(self, message):
+        logger.debug('Received piece message')
+        self.pending_block = None
+        self.snubbed = False
+        self.downloaded += len(message.block)
+        try:
+            self.current_state.remove(PeerState.PendingRequest.value)
+        except ValueError:
+            # The request was released when the peer was snubbed
+            pass
+        self.on_block_complete(peer_id=self.remote_id,
+                               piece_index=message.index,
+                               block_offset=message.begin,
+                               data=message.block)
+
+    def cancel_request(self, piece_index, block_offset):
+        """Cancel our request of the block if it is outstanding, another
+        peer sent it first.
+        """
+        block = self.pending_block
+        if block is None or block.piece != piece_index or \
+                block.offset != block_offset:
+            return
+        logger.debug('Cancelling request of block {} of piece {}'.format(
+            block_offset, piece_index))
+        self.pending_block = None
+        self.outgoing.send(CancelMessage(block.piece, block.offset,
+                                         block.length))
+        try:
+            self.current_state.remove(PeerState.PendingRequest.value)
+        except ValueError:
+            pass
+
+    def on_upload_message(self, message):
+        """Interested, NotInterested, Request and Cancel are about our
+        uploads, the request handler shared with the server answers them.
+        """
+        for reply in self.request_handler.handle_message(message, self):
+            self.outgoing.send(reply)
+        if self.requests and self.serving is None:
+            self.serving = asyncio.ensure_future(self.serve_requests())
+
+    async def serve_requests(self):
+        """Send the blocks of the queued requests in order, waiting
+        whenever the write buffer is full.
+        """
+        try:
+            while self.requests and self.outgoing is not None:
+                self.request_handler.send_piece(self.requests.popleft(),
+                                                self)
+                await self.outgoing.drain()
+        finally:
+            self.serving = None
+
+    def start_uploading(self):
+        """Tell the peer which pieces we have and let the choker decide
+        whether we upload to it.
+        """
+        if self.request_handler is None:
+            return
+        self.reset_upload_state()
+        for message in self.request_handler.get_availability(self):
+            self.outgoing.send(message)
+        self.choker.add(self)
+        self.download_manager.connections.add(self)
+
+    def send_haves(self, indexes):
+        # Pieces the peer has already, e.g. all of them for a seed, are not
+        # worth announcing
+        pieces = self.download_manager.peers.get(self.remote_id)
+        if pieces is not None:
+            indexes = [index for index in indexes if not pieces[index]]
+        super().send_haves(indexes)
+
+    def stop_uploading(self):
+        if self.request_handler is None:
+            return
+        self.choker.remove(self)
+        self.download_manager.connections.discard(self)
+        self.requests.clear()
+        if self.serving is not None:
+            self.serving.cancel()
+            self.serving = None
 
     def can_request(self):
         return PeerState.Choked.value not in self.current_state \
           and PeerState.Interested.value in self.current_state  # NOQA
 
+    def can_request_fast(self):
+        """While choked only the allowed fast pieces can be requested."""
+        return self.allowed_fast is not None \
+          and PeerState.Interested.value in self.current_state
+
     def can_send_interested(self):
         return PeerState.Stopped.value not in self.current_state \
           and PeerState.Interested.value not in self.current_state
 
     async def send_next_message(self):
+        if self.pex is not None:
+            self.send_pex()
         if self.can_request():
-            if PeerState.PendingRequest.value not in self.current_state:
-                logger.debug('Sending download request {}'.format(
-                    self.peer))
-                self.current_state.append(PeerState.PendingRequest.value)
-                await self.send_request()
+            allowed = None
+        elif self.can_request_fast():
+            allowed = self.allowed_fast
+        else:
+            return
+        if PeerState.PendingRequest.value not in self.current_state:
+            logger.debug('Sending download request {}'.format(
+                self.peer))
+            self.current_state.append(PeerState.PendingRequest.value)
+            await self.send_request(allowed)
 
     async def send_handshake(self):
         """
         Send the initial handshake to the remote peer and wait for the peer
         to respond with its handshake.
         """
-        self.writer.write(
-            HandshakeMessage(self.info_hash, self.peer_id).encode())
-        await self.writer.drain()
+        self.outgoing.send(HandshakeMessage(self.info_hash, self.peer_id))
+        await self.outgoing.drain()
 
         buf = b''
         while len(buf) < MessageLength.handshake.value:
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+            data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+            if not data:
+                raise ProtocolError('Connection closed during handshake')
+            buf += data
+
+        self.handshake_received(
+            HandshakeMessage.decode(buf[:MessageLength.handshake.value]))
 
-        response = HandshakeMessage.decode(buf[:MessageLength.handshake.value])
+        # We need to return the remaining buffer data, since we might have
+        # read more bytes then the size of the handshake message and we need
+        # those bytes to parse the next message.
+        return buf[MessageLength.handshake.value:]
 
+    def handshake_received(self, response):
+        """Validate the handshake of the remote peer."""
         if not response:
-            raise ProtocolError('Unable receive and parse a handshake. Received buffer: {}'.format(buf))
+            raise ProtocolError('Unable receive and parse a handshake')
         if not response.info_hash == self.info_hash:
             raise ProtocolError('Handshake with invalid info_hash')
 
         # TODO: According to spec we should validate that the peer_id received
         # from the peer match the peer_id received from the tracker.
         self.remote_id = response.peer_id
+        self.download_manager.peer_connections[self.remote_id] = self
+        # We always advertise the Fast Extension
+        self.fast = response.fast
+        if response.extended and self.pex is not None:
+            self.outgoing.send(extension_handshake())
+        self.start_uploading()
         logger.info('Handshake with peer was successful {}'.format(
             self.peer))
 
-        # We need to return the remaining buffer data, since we might have
-        # read more bytes then the size of the handshake message and we need
-        # those bytes to parse the next message.
-        try:
-            logger.debug('Remove choked state')
-            self.current_state.remove(PeerState.Choked.value)
-        except ValueError as e:
-            pass
-
-        return buf[MessageLength.handshake.value:]
-
     async def send_interested(self):
         self.current_state.append(PeerState.Interested.value)
-        message = InterestedMessage()
         logger.debug('Sending interested message')
-        self.writer.write(message.encode())
-        await self.writer.drain()
+        self.outgoing.send(InterestedMessage())
+        await self.outgoing.drain()
 
-    async def send_request(self):
+    async def send_request(self, allowed=None):
         """Request peer to transfer the pieces.
+
+        :param allowed: `Bitfield` limiting the pieces to request from.
         """
-        block = self.download_manager.next_request(self.remote_id)
-        if block:
+        block = self.download_manager.next_request(self.remote_id, allowed)
+        if not block:
+            # Nothing to ask for, try again on the next message
+            self.current_state.remove(PeerState.PendingRequest.value)
+        else:
             message = RequestMessage(block.piece, block.offset,
-                                     block.length).encode()
+                                     block.length)
 
             logger.debug('Requesting block {block} for {piece} of length '
                          '{length} byte from peer {peer}'.format(
                              piece=block.piece, block=block.offset,
                              length=block.length, peer=self.remote_id))
-            self.writer.write(message)
-            await self.writer.drain()
+            self.pending_block = block
+            self.requested_at = time.monotonic()
+            self.outgoing.send(message)
+            await self.outgoing.drain()
+
+    def start_timers(self):
+        super().start_timers()
+        self.schedule_timer('snub', self.SNUB_TIMEOUT, self.on_snub_timeout)
+
+    def on_snub_timeout(self):
+        """Release the request of a peer which didn't answer it for
+        `SNUB_TIMEOUT` seconds, so the block can be fetched from another
+        peer. The next request goes out with the next received message.
+        """
+        delay = self.SNUB_TIMEOUT
+        block = self.pending_block
+        if block is not None:
+            elapsed = time.monotonic() - self.requested_at
+            if elapsed >= self.SNUB_TIMEOUT:
+                logger.info('Snubbed by peer {}'.format(self.peer))
+                self.snubbed = True
+                self.pending_block = None
+                self.download_manager.block_rejected(
+                    peer_id=self.remote_id, piece_index=block.piece,
+                    block_offset=block.offset)
+                try:
+                    self.current_state.remove(
+                        PeerState.PendingRequest.value)
+                except ValueError:
+                    pass
+            else:
+                delay -= elapsed
+        self.schedule_timer('snub', delay, self.on_snub_timeout)
 
-    def cancel(self):
-        if not self.future.done():
-            self.future.cancel()
-        if self.writer:
-            self.writer.close()
+    def handshake_done(self):
+        return self.remote_id is not None
 
-        self.available_peers.task_done()
+    def drop(self, reason):
+        """Close the connection, the read loop then cleans up."""
+        logger.info('Dropping peer {}: {}'.format(self.peer, reason))
+        if self.outgoing:
+            self.outgoing.close()
+
+    def connection_closed(self):
+        """Clean up after the connection to the current peer ended, its
+        outstanding request goes back to the others.
+        """
+        self.stop_timers()
+        self.stop_uploading()
+        if self.outgoing:
+            self.outgoing.close()
+        elif self.writer:
+            self.writer.close()
+        connections = self.download_manager.peer_connections
+        if connections.get(self.remote_id) is self:
+            del connections[self.remote_id]
+        block = self.pending_block
+        if block is not None and self.remote_id is not None:
+            self.download_manager.block_rejected(
+                peer_id=self.remote_id, piece_index=block.piece,
+                block_offset=block.offset)
+        if self.peer:
+            self.available_peers.connection_lost(self.peer)
+            self.available_peers.task_done()
+        self.reset_connection_state()
 
     def stop(self):
-        self.current_state.append(PeerState.Stopped)
+        self.current_state.append(PeerState.Stopped.value)
         if not self.future.done():
             self.future.cancel()
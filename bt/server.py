@@ -1,37 +1,87 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
+import time
 import asyncio
-import struct
+from enum import Enum
+from hashlib import sha1
+from collections import deque
 
+from . import utp
 from .logger import get_logger
-from .protocol import PeerStreamIterator
-
-from .message import (MessageID,
+from .utils import generate_peer_id
+from .bitfield import Bitfield
+from .cache import PieceCache
+from .choker import Choker, UploadStateMixin
+from .mixins import DispatchMixin
+from .writer import MessageWriter
+from .protocol import MessageBuffer, ProtocolError
+from .timer import ConnectionTimersMixin
+from .pex import PeerExchange, extension_handshake
+from .message import (MAX_BLOCK_LENGTH,
+                      max_message_length,
                       InterestedMessage,
                       HandshakeMessage,
+                      UnchokeMessage,
                       BitFieldMessage,
                       NotInterestedMessage,
-                      ChokeMessage,
-                      UnchokeMessage,
-                      HaveMessage,
                       RequestMessage,
-                      PieceMessage,
                       CancelMessage,
-                      KeepAliveMessage)
+                      PieceMessage,
+                      HaveAllMessage,
+                      HaveNoneMessage,
+                      RejectRequestMessage,
+                      SuggestPieceMessage,
+                      ExtendedMessage)
 
 logger = get_logger()
 
 
 class SourceFileReader:
-    def __init__(self, torrent):
+    """
+    :param use_mmap: Map the payload into memory, whole pieces are then
+                     views of the page cache which processes seeding the
+                     same file share.
+    :param have: `Bitfield` of the verified pieces of a file still being
+                 downloaded, kept up to date by the `DownloadManager`.
+                 Without it the file is expected to be complete.
+    """
+    def __init__(self, torrent, path=None, use_mmap=False, have=None):
         self.torrent = torrent
-        self.fd = os.open(self.torrent.name, os.O_RDONLY)
+        self.path = path if path else self.torrent.name
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.have = have
+        self.map = None
+        if use_mmap:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def offset(self, index, begin):
+        return index * self.torrent.info.piece_length + begin
+
+    def piece_extent(self, index):
+        """Offset and length of piece `index` in the file."""
+        offset = self.offset(index, 0)
+        length = min(self.torrent.info.piece_length,
+                     self.torrent.info.length - offset)
+        return offset, length
 
     def read(self, begin, index, length):
-        pos = index * self.torrent.info.piece_length
-        os.lseek(self.fd, pos, os.SEEK_SET)
-        return os.read(self.fd, length)
+        return os.pread(self.fd, length, self.offset(index, begin))
+
+    def read_piece(self, index):
+        """Read all of piece `index`, a `memoryview` of the mapping with
+        `use_mmap`.
+        """
+        offset, length = self.piece_extent(index)
+        if self.map is None:
+            return os.pread(self.fd, length, offset)
+        if hasattr(self.map, 'madvise'):
+            # Read ahead, the range has to start on a page boundary
+            start = offset - offset % mmap.PAGESIZE
+            self.map.madvise(mmap.MADV_WILLNEED, start,
+                             offset + length - start)
+        return memoryview(self.map)[offset:offset + length]
 
     def has_all_pieces(self):
         """Check the size on the disk is equal or greater than 
@@ -41,177 +91,446 @@ class SourceFileReader:
         after checking integrating
         Returns True or False.
         """
-        
+        if self.have is not None:
+            return self.have.all()
         min_length = (len(self.torrent.info.pieces) - 1) * self.torrent.info.piece_length
-        return os.path.getsize(self.torrent.name) > min_length
+        return os.path.getsize(self.path) > min_length
 
     def calculate_have_pieces(self):
-        pass
+        """Hash check the pieces on disk. The result is kept in `have`, the
+        file is checked once and the pieces failing it are not served.
+        """
+        pieces = self.torrent.info.pieces
+        have = Bitfield(len(pieces))
+        size = os.fstat(self.fd).st_size
+        for index, piece_hash in enumerate(pieces):
+            offset, length = self.piece_extent(index)
+            if offset + length > size:
+                # Not written yet
+                break
+            digest = sha1(self.read_piece(index)).hexdigest()
+            if digest.encode('utf-8') == piece_hash:
+                have[index] = 1
+        logger.info('{} of {} pieces on disk'.format(
+            have.count(), len(pieces)))
+        self.have = have
+        return have.copy()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def has_piece(self, index):
+        return self.have is None or bool(self.have[index])
 
     def get_have_pieces(self):
         """Get all have pieces
-        Returns list of all bool values with size of piece+1.
-        The last element in the list is False and other positions contains
-        True or False.
-
-        Available piece is represented as True and missing piece 
-        is represented as False.
+        Returns a `Bitfield` with the available pieces set.
         """
+        if self.have is not None:
+            return self.have.copy()
         if self.has_all_pieces():
-            pieces_availability = [True] * len(self.torrent.info.pieces)
-            pieces_availability.append(False)
-            return pieces_availability
+            return Bitfield.full(len(self.torrent.info.pieces))
         return self.calculate_have_pieces()
 
 
-class RequestHandler:
-    def __init__(self, torrent):
-        self.torrent = torrent
-        self.file_reader = SourceFileReader(torrent=self.torrent)
+class RequestHandler(DispatchMixin):
+    """
+    Replies to the messages of all connections. Handlers receive the message
+    and the `TorrentServer` connection it arrived on, per connection state
+    is kept on the connection.
+    """
+    # Largest block we serve, bigger requests are dropped or rejected
+    MAX_REQUEST_LENGTH = MAX_BLOCK_LENGTH
+    # Recently requested pieces suggested to new Fast Extension peers
+    SUGGESTED_PIECES = 4
+    # Requests queued per connection, more are dropped or rejected
+    MAX_QUEUED_REQUESTS = 250
 
-    def parse(self, buffer):
+    def __init__(self, torrent, path=None, cache_size=PieceCache.CAPACITY,
+                 use_mmap=False, cache=None, peer_id=None):
         """
-        Tries to parse protocol messages if there is enough bytes read in the
-        buffer.
-        :return The parsed message, or None if no message could be parsed
+        :param cache: `PieceCache` to serve from, e.g. the one a download
+                      adds its verified pieces to. By default one of
+                      `cache_size` bytes over the file at `path`.
+        :param peer_id: Our peer id, the one announced to the trackers.
         """
-        # Each message is structured as:
-        #     <length prefix><message ID><payload>
-        #
-        # The `length prefix` is a four byte big-endian value
-        # The `message ID` is a decimal byte
-        # The `payload` is the value of `length prefix`
-        #
-        # The message length is not part of the actual length. So another
-        # 4 bytes needs to be included when slicing the buffer.
-        self.buffer = buffer
-        header_length = 4
-        if len(self.buffer) == 68:
-            return HandshakeMessage.decode(self.buffer)
-        elif len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0]
-
-            if message_length == 0:
-                return KeepAliveMessage()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack('>b', self.buffer[4:5])[0]
-
-                def _consume():
-                    """Consume the current message from the read buffer"""
-                    self.buffer = self.buffer[header_length + message_length:]
-
-                def _data():
-                    """"Extract the current message from the read buffer"""
-                    return self.buffer[:header_length + message_length]
-
-                if message_id is MessageID.BitField.value:
-                    data = _data()
-                    _consume()
-                    return BitFieldMessage.decode(data)
-                elif message_id is MessageID.Interested.value:
-                    _consume()
-                    return InterestedMessage()
-                elif message_id is MessageID.NotInterested.value:
-                    _consume()
-                    return NotInterestedMessage()
-                elif message_id is MessageID.Choke.value:
-                    _consume()
-                    return ChokeMessage()
-                elif message_id is MessageID.Unchoke.value:
-                    _consume()
-                    return UnchokeMessage()
-                elif message_id is MessageID.Have.value:
-                    data = _data()
-                    _consume()
-                    return HaveMessage.decode(data)
-                elif message_id is MessageID.Piece.value:
-                    data = _data()
-                    _consume()
-                    return PieceMessage.decode(data)
-                elif message_id is MessageID.Request.value:
-                    data = _data()
-                    _consume()
-                    return RequestMessage.decode(data)
-                elif message_id is MessageID.Cancel.value:
-                    data = _data()
-                    _consume()
-                    return CancelMessage.decode(data)
-                else:
-                    logger.debug('Unsupported message!')
-            else:
-                #import ipdb;ipdb.set_trace()
-                return None
-                logger.debug('Not enough in buffer in order to parse')
-        return None
+        self.torrent = torrent
+        self.peer_id = peer_id if peer_id else generate_peer_id()
+        if cache is None:
+            cache = PieceCache(SourceFileReader(torrent=self.torrent,
+                                                path=path, use_mmap=use_mmap),
+                               capacity=cache_size)
+        self.cache = cache
+        self.file_reader = cache.file_reader
+        self.info_hash = torrent.hash
+        # Total bytes served, reported to the tracker
+        self.uploaded = 0
+        self.recent_pieces = deque(maxlen=RequestHandler.SUGGESTED_PIECES)
+        self.register_handler(HandshakeMessage, self.on_handshake)
+        self.register_handler(InterestedMessage, self.on_interested)
+        self.register_handler(NotInterestedMessage, self.on_not_interested)
+        self.register_handler(RequestMessage, self.on_request)
+        self.register_handler(CancelMessage, self.on_cancel)
+        self.register_handler(ExtendedMessage, self.on_extended)
 
     def get_piece(self, begin, index, length):
         data = self.file_reader.read(begin=begin, index=index, length=length)
         return PieceMessage(begin=begin, index=index, block=data)
 
-    def handle_message(self, buffer):
-        message = self.parse(buffer)
-        if isinstance(message, NotInterestedMessage):
-            logger.debug('Remove interested state')
-        elif isinstance(message, HandshakeMessage):
-            logger.debug('Received Handshake')
-        elif isinstance(message, ChokeMessage):
-            logger.debug('Received choke message')
-            self.current_state.append(PeerState.Choked.value)
-        elif isinstance(message, UnchokeMessage):
-            logger.debug('Received unchoke message')
-        elif isinstance(message, HaveMessage):
-            logger.debug('Received have message')
-        elif isinstance(message, BitFieldMessage):
-            logger.debug('Received bit field message: {}'.format(message))
-        elif isinstance(message, PieceMessage):
-            pass
-        elif isinstance(message, InterestedMessage):
-            return BitFieldMessage(val=self.file_reader.get_have_pieces())
-        elif isinstance(message, RequestMessage):
-            return self.get_piece(begin=message.begin, index=message.index,
-                           length=message.length)
-        elif isinstance(message, CancelMessage):
-            # TODO: Implement cancel data
-            pass
-        return message
-
-
-class TorrentServer(asyncio.Protocol):
-    def __init__(self, torrent):
+    def send_piece(self, message, connection):
+        """Send the block of a queued `RequestMessage`.
+
+        Blocks of cached pieces are sent from memory. Otherwise they go
+        straight from the file with `sendfile` where the connection allows
+        it, the page cache does the read-ahead, or the piece is read into
+        the cache.
+        """
+        index, begin, length = message.index, message.begin, message.length
+        connection.uploaded += length
+        self.uploaded += length
+        header = PieceMessage.header(index, begin, length)
+        outgoing = connection.outgoing
+        if outgoing.socket is not None and index not in self.cache:
+            outgoing.sendfile(header, self.file_reader.fd,
+                              self.file_reader.offset(index, begin), length)
+        else:
+            outgoing.write(header)
+            outgoing.write(self.cache.read(index, begin, length))
+
+    def handle_message(self, message, connection):
+        """Return the list of replies to `message`. Handlers return a
+        reply, a list of replies or None.
+        """
+        reply = self.dispatch(message, connection)
+        if reply is None:
+            return []
+        if isinstance(reply, list):
+            return reply
+        return [reply]
+
+    def on_handshake(self, message, connection):
+        logger.debug('Received Handshake')
+        if message is None or message.info_hash != self.info_hash:
+            connection.drop('Invalid handshake')
+            return None
+        connection.fast = message.fast
+        connection.remote_id = message.peer_id
+        # The handshake is answered with the same info hash and our peer
+        # id, followed by the pieces we have
+        return [HandshakeMessage(message.info_hash, self.peer_id)] + \
+            self.get_availability(connection)
+
+    def on_interested(self, message, connection):
+        replies = []
+        connection.interested = True
+        # The peer doesn't have to wait for the next choker round if an
+        # upload slot is free
+        choker = connection.choker
+        if connection.choked and choker is not None and choker.free_slot():
+            connection.choked = False
+            replies.append(UnchokeMessage())
+        return replies
+
+    def get_availability(self, connection):
+        """Messages announcing our pieces to `connection`."""
+        pieces = self.file_reader.get_have_pieces()
+        if not pieces.any():
+            # The BitField message is optional without any pieces
+            return [HaveNoneMessage()] if connection.fast else []
+        if not connection.fast:
+            return [BitFieldMessage(pieces)]
+        if not pieces.all():
+            return [BitFieldMessage(pieces)]
+        return [HaveAllMessage()] + [SuggestPieceMessage(index)
+                                     for index in self.recent_pieces]
+
+    def on_not_interested(self, message, connection):
+        logger.debug('Remove interested state')
+        connection.interested = False
+        # Free the upload slot right away
+        if not connection.choked:
+            connection.choke()
+
+    def on_request(self, message, connection):
+        """Queue the request, `TorrentServer.serve_requests` reads the
+        queued blocks in order as the transport keeps up.
+        """
+        if connection.choked or not self.is_valid_request(message) or \
+                len(connection.requests) >= \
+                RequestHandler.MAX_QUEUED_REQUESTS:
+            logger.debug('Refusing request {}'.format(message))
+            if connection.fast:
+                return RejectRequestMessage(message.index, message.begin,
+                                            message.length)
+            return None
+        if message.index not in self.recent_pieces:
+            self.recent_pieces.append(message.index)
+        connection.requests.append(message)
+        return None
+
+    def on_cancel(self, message, connection):
+        for request in connection.requests:
+            if request.index == message.index and \
+                    request.begin == message.begin and \
+                    request.length == message.block:
+                connection.requests.remove(request)
+                # Fast Extension peers get a reply to every request
+                if connection.fast:
+                    return RejectRequestMessage(request.index, request.begin,
+                                                request.length)
+                return None
+        return None
+
+    def on_extended(self, message, connection):
+        # We never dial out, so peers received through PEX are ignored
+        if message.extended_id != 0:
+            return None
+        try:
+            connection.pex.handshake_received(message.payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        remote = None
+        port = message.payload.get(b'p')
+        if isinstance(port, int) and connection.peer:
+            remote = (connection.peer[0], port)
+            connection.known_peers.add(remote)
+        replies = [extension_handshake(port=connection.port)]
+        pex = connection.pex.next_message(connection.known_peers - {remote})
+        if pex:
+            replies.append(pex)
+        return replies
+
+    def is_valid_request(self, message):
+        info = self.torrent.info
+        if message.index >= len(info.pieces) or \
+                not self.file_reader.has_piece(message.index):
+            return False
+        if message.length > RequestHandler.MAX_REQUEST_LENGTH:
+            return False
+        end = message.index * info.piece_length + message.begin + \
+            message.length
+        return message.begin + message.length <= info.piece_length and \
+            end <= info.length
+
+
+class ConnectionState(Enum):
+    Handshake = 'handshake'
+    Connected = 'connected'
+    Closed = 'closed'
+
+
+class TorrentServer(ConnectionTimersMixin, UploadStateMixin,
+                    asyncio.Protocol):
+    """
+    Connections without a handshake in time or silent for too long are
+    closed, quiet ones are kept alive. Peers start choked, the `Choker`
+    shared by all connections decides which ones we upload to.
+
+    Every connection buffers its input, so messages split over reads or
+    pipelined into one are all handled. Requests are queued and served in
+    order while the transport keeps up, a Cancel removes a request which
+    wasn't read from disk yet.
+
+    :param peers: Listen addresses of other peers in the swarm, advertised
+                  through PEX. Addresses learned from extension handshakes
+                  are added to it.
+    :param sendfile: Send blocks with `os.sendfile` instead of reading them.
+    :param cache_size: Bytes of the `PieceCache` shared by the connections.
+    :param use_mmap: Cache pieces as views of a memory map of the payload.
+    :param download_manager: `DownloadManager` of a download in progress,
+                             its verified pieces are served from its cache
+                             and connections announce the pieces it
+                             completes.
+    :param peer_id: Our peer id, sent in the handshake.
+    """
+    def __init__(self, torrent, path=None, peers=None,
+                 slots=Choker.UPLOAD_SLOTS, sendfile=True,
+                 cache_size=PieceCache.CAPACITY, use_mmap=False,
+                 download_manager=None, peer_id=None):
         self.torrent = torrent
+        self.peer_id = peer_id
+        self.download_manager = download_manager
+        self.slots = slots
+        self.sendfile = sendfile
+        self.cache_size = cache_size
+        self.use_mmap = use_mmap
+        self.path = path
+        self.connections = set([])
+        self.known_peers = peers if peers is not None else set()
+        self.request_handler = None
+        self.choker = None
+        self.transport = None
+        self.outgoing = None
+        self.peer = None
+        self.port = None
+        # Set from the handshake of the peer
+        self.remote_id = None
+        self.fast = False
+        self.pex = PeerExchange()
+        self.reset_upload_state()
+        self.state = ConnectionState.Handshake
+        self.buffer = MessageBuffer(
+            max_length=max_message_length(len(torrent.info.pieces)))
+        self.writing_paused = False
+        self.serve_handle = None
         super().__init__()
 
     def __call__(self):
-        self.connections = set([])
-        self.request_handler = RequestHandler(torrent=self.torrent)
+        """Protocol factory, the event loop calls it for every accepted
+        connection. Connections share the request handler and the set of
+        connected peers but have their own transport and write queue.
+        """
+        self.setup()
+        connection = TorrentServer(self.torrent, path=self.path,
+                                   sendfile=self.sendfile,
+                                   download_manager=self.download_manager)
+        connection.connections = self.connections
+        connection.known_peers = self.known_peers
+        connection.request_handler = self.request_handler
+        connection.choker = self.choker
+        return connection
+
+    def setup(self):
+        """Create the request handler and choker shared by the
+        connections, a download's own connections use them too.
+        """
+        if self.request_handler is not None:
+            return self
+        cache = None
+        if self.download_manager is not None:
+            cache = self.download_manager.cache
+        self.request_handler = RequestHandler(
+            torrent=self.torrent, path=self.path, cache_size=self.cache_size,
+            use_mmap=self.use_mmap, cache=cache, peer_id=self.peer_id)
+        self.choker = Choker(
+            slots=self.slots,
+            seeding=self.request_handler.file_reader.has_all_pieces)
         logger.debug('Init server')
         return self
 
     def connection_made(self, transport):
         self.transport = transport
-        peer = transport.get_extra_info('peername')
-        self.connections.add(peer)
+        self.outgoing = MessageWriter(transport, sendfile=self.sendfile)
+        self.peer = transport.get_extra_info('peername')
+        self.port = transport.get_extra_info('sockname')[1]
+        self.connections.add(self.peer)
+        self.choker.add(self)
+        if self.download_manager is not None:
+            self.download_manager.connections.add(self)
+        self.start_timers()
 
     def data_received(self, data):
-        message = self.request_handler.handle_message(data)
-        logger.debug(message)
-        if message:
-            logger.info('Serving {}'.format(message))
-            self.transport.write(message.encode())
+        if self.state is ConnectionState.Closed:
+            return
+        self.last_received = time.monotonic()
+        self.buffer.feed(data)
+        if self.state is ConnectionState.Handshake:
+            handshake = self.buffer.parse_handshake()
+            if handshake is None:
+                return
+            self.state = ConnectionState.Connected
+            self.reply(handshake)
+        try:
+            for message in self.buffer.parse():
+                if self.state is not ConnectionState.Connected:
+                    return
+                self.reply(message)
+        except ProtocolError as e:
+            self.drop(e)
+            return
+        self.serve_requests()
+
+    def reply(self, message):
+        for reply in self.request_handler.handle_message(message, self):
+            logger.debug('Replying {}'.format(reply))
+            self.outgoing.send(reply)
+
+    def serve_requests(self):
+        """Read queued requests from disk and send them until the write
+        buffer is full, `resume_writing` continues.
+        """
+        self.serve_handle = None
+        if not self.requests:
+            return
+        with self.outgoing.corked():
+            while self.requests and not self.writing_paused:
+                if self.outgoing.buffered() > self.outgoing.high_water:
+                    # Check again once the queued messages are written
+                    self.serve_handle = asyncio.get_event_loop().call_soon(
+                        self.serve_requests)
+                    return
+                self.request_handler.send_piece(self.requests.popleft(),
+                                                self)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.serve_handle is None:
+            self.serve_requests()
 
     def eof_received(self):
         logger.debug('eof received')
 
     def connection_lost(self, exc):
         logger.debug('connectin lost')
+        self.state = ConnectionState.Closed
+        self.requests.clear()
+        if self.serve_handle is not None:
+            self.serve_handle.cancel()
+            self.serve_handle = None
+        self.stop_timers()
+        self.choker.remove(self)
+        self.connections.discard(self.peer)
+        if self.download_manager is not None:
+            self.download_manager.connections.discard(self)
 
+    def handshake_done(self):
+        return self.remote_id is not None
 
-async def run_server(port, torrent):
+    def drop(self, reason):
+        logger.info('Dropping peer {}: {}'.format(self.peer, reason))
+        self.state = ConnectionState.Closed
+        self.transport.close()
+
+
+async def run_server(port, torrent, path=None, peers=None,
+                     slots=Choker.UPLOAD_SLOTS, sendfile=True,
+                     cache_size=PieceCache.CAPACITY, host='127.0.0.1',
+                     peer_id=None):
     """Run a server to respond to all clients
+
+    :param path: Location of the payload on disk, defaults to the name
+                 stored in the torrent.
+    :param peers: Set of peer addresses to advertise through PEX.
+    :param slots: Number of peers unchoked by the choker.
+    :param sendfile: Serve blocks with `os.sendfile`.
+    :param cache_size: Memory cap of the piece cache in bytes.
+    :param host: Address to listen on.
+    :param peer_id: Our peer id, a random one by default.
     """
-    logger.info('Starting server in port {}'.format(port))
+    logger.info('Starting server on {}:{}'.format(host, port))
     loop = asyncio.get_event_loop()
     server = await loop.create_server(
-        TorrentServer(torrent), host='127.0.0.1', port=port)
+        TorrentServer(torrent, path=path, peers=peers, slots=slots,
+                      sendfile=sendfile, cache_size=cache_size,
+                      peer_id=peer_id),
+        host=host, port=port)
     return server
+
+
+async def run_utp_server(port, torrent, path=None, peers=None,
+                         slots=Choker.UPLOAD_SLOTS,
+                         cache_size=PieceCache.CAPACITY):
+    """Run a server accepting uTP connections, see `run_server`.
+
+    :return The listening `UTPSocket`, stopped with `close()`.
+    """
+    logger.info('Starting uTP server in port {}'.format(port))
+    return await utp.create_server(
+        TorrentServer(torrent, path=path, peers=peers, slots=slots,
+                      cache_size=cache_size),
+        host='127.0.0.1', port=port)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming downloads, reading the payload in order while it downloads.
+
+`DownloadManager.stream` turns the piece picker sequential from a playback
+position and gives every piece ahead of it a deadline, the time playback
+at `rate` bytes/s reaches it. Pieces due within `DEADLINE_WINDOW` seconds
+are only requested from the fastest peers, and once one is due within
+`DUPLICATE_TIME` its outstanding blocks are requested a second time from
+another fast peer. `PieceStream` reads the verified bytes in order.
+"""
+
+import time
+import asyncio
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+# Playback rate assumed when none is given, bytes per second
+STREAM_RATE = 2 ** 20
+# Seconds of playback ahead of the position which pieces are fetched from
+# fast peers only
+DEADLINE_WINDOW = 4
+# Seconds of playback ahead of the position within which a piece's pending
+# blocks are duplicated
+DUPLICATE_TIME = 1
+# Peers at this share of the best rate or above are fast ones
+FAST_PEER_SHARE = 0.5
+# Seconds a rate measurement is trusted, a peer without one counts as fast
+RATE_TIMEOUT = 5
+# Weight of the latest block in the rate of a peer
+RATE_WEIGHT = 0.25
+
+
+class PeerRates:
+    """
+    Download rate of every peer, measured on the time it took to answer
+    each request.
+    """
+    def __init__(self):
+        # peer id -> (bytes/s, time of the last block)
+        self.rates = {}
+
+    def update(self, peer_id, length, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        sample = length / max(seconds, 1e-3)
+        rate, at = self.rates.get(peer_id, (None, None))
+        if rate is None or now - at >= RATE_TIMEOUT:
+            rate = sample
+        else:
+            rate += RATE_WEIGHT * (sample - rate)
+        self.rates[peer_id] = (rate, now)
+
+    def is_fast(self, peer_id, now=None):
+        now = time.monotonic() if now is None else now
+        recent = {peer: rate for peer, (rate, at) in self.rates.items()
+                  if now - at < RATE_TIMEOUT}
+        if peer_id not in recent:
+            return True
+        return recent[peer_id] >= FAST_PEER_SHARE * max(recent.values())
+
+
+class PieceStream:
+    """
+    Reader of the verified bytes of a download in payload order, waiting
+    for each piece to be verified. `async for` yields the rest of the
+    current piece at a time.
+
+    :param follow: Reads and seeks move the playback position of the
+                   download manager.
+    """
+    def __init__(self, download_manager, position=0, follow=False):
+        self.download_manager = download_manager
+        self.position = position
+        self.follow = follow
+        self.waiter = None
+        self.closed = False
+        self.started = time.monotonic()
+        self.first_byte_at = None
+        # Seconds spent waiting for pieces after the first byte
+        self.stalled = 0.0
+
+    @property
+    def time_to_first_byte(self):
+        if self.first_byte_at is None:
+            return None
+        return self.first_byte_at - self.started
+
+    def seek(self, position):
+        self.position = position
+        if self.follow:
+            self.download_manager.set_position(position)
+        self.wake()
+
+    def piece_done(self, index):
+        if self.waiter is not None and self.waiter[0] == index:
+            self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter[1].done():
+            self.waiter[1].set_result(None)
+
+    async def wait(self, index):
+        future = asyncio.get_event_loop().create_future()
+        self.waiter = (index, future)
+        waiting = time.monotonic()
+        try:
+            await future
+        finally:
+            self.waiter = None
+            if self.first_byte_at is not None:
+                self.stalled += time.monotonic() - waiting
+
+    async def read(self, size=-1):
+        """Read up to `size` bytes, the rest of the current piece with -1,
+        as soon as the piece is verified.
+
+        :return Empty bytes at the end of the payload.
+        :raises EOFError: If the download stops first.
+        """
+        manager = self.download_manager
+        piece_length = manager.torrent.info.piece_length
+        while True:
+            if self.closed:
+                raise EOFError('Stream closed')
+            if self.position >= manager.torrent.info.length:
+                return b''
+            index, begin = divmod(self.position, piece_length)
+            if manager.have[index]:
+                break
+            await self.wait(index)
+        _, length = manager.file_reader.piece_extent(index)
+        length -= begin
+        if size >= 0:
+            length = min(length, size)
+        data = bytes(manager.cache.read(index, begin, length))
+        self.position += len(data)
+        if self.follow:
+            manager.set_position(self.position)
+        if self.first_byte_at is None:
+            self.first_byte_at = time.monotonic()
+            logger.info('First byte after {:.3f}s'.format(
+                self.time_to_first_byte))
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read()
+        if not data:
+            raise StopAsyncIteration()
+        return data
+
+    def close(self):
+        self.closed = True
+        self.wake()
+        self.download_manager.streams.discard(self)
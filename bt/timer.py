@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+import asyncio
+import weakref
+
+from .logger import get_logger
+from .message import KeepAliveMessage
+
+
+logger = get_logger()
+
+# Connection timeouts in seconds. Peers drop connections which were silent
+# for two minutes, so keep-alives go out well before that.
+HANDSHAKE_TIMEOUT = 10
+KEEPALIVE_INTERVAL = 90
+IDLE_TIMEOUT = 180
+# No piece for this long while a request is outstanding marks a peer snubbed
+SNUB_TIMEOUT = 60
+
+
+class Timer:
+    """Handle of a callback scheduled on a `TimerWheel`."""
+    __slots__ = ('wheel', 'callback', 'args', 'slot', 'rounds')
+
+    def __init__(self, wheel, callback, args):
+        self.wheel = wheel
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.rounds = 0
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel._remove(self)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel shared by all connections of an event loop.
+
+    Timers are hashed into one of `slots` buckets by their expiry tick, a
+    timer further away than one revolution carries the number of rounds it
+    has to wait. Scheduling and cancelling are set operations, O(1) whatever
+    the number of timers, and a single `call_at` advances the wheel one
+    bucket per `tick` seconds. It only runs while timers are pending.
+    Timers fire up to one tick late, never early.
+    """
+    TICK = 1.0
+    SLOTS = 512
+
+    def __init__(self, tick=TICK, slots=SLOTS, loop=None):
+        self.tick = tick
+        self.loop = loop or asyncio.get_event_loop()
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.count = 0
+        self.handle = None
+        self.next_tick = None
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Call `callback(*args)` in `delay` seconds.
+
+        :return `Timer` which can be cancelled.
+        """
+        now = self.loop.time()
+        if self.handle is None:
+            self.next_tick = now + self.tick
+            self.handle = self.loop.call_at(self.next_tick, self._advance)
+        # Counted from the last tick, the current one is partly over
+        last_tick = self.next_tick - self.tick
+        ticks = max(1, math.ceil((now + delay - last_tick) / self.tick))
+        timer = Timer(self, callback, args)
+        timer.slot = (self.position + ticks) % len(self.slots)
+        timer.rounds = (ticks - 1) // len(self.slots)
+        self.slots[timer.slot].add(timer)
+        self.count += 1
+        return timer
+
+    def _remove(self, timer):
+        self.slots[timer.slot].discard(timer)
+        timer.slot = None
+        self.count -= 1
+
+    def _advance(self):
+        self.handle = None
+        self.position = (self.position + 1) % len(self.slots)
+        bucket = self.slots[self.position]
+        expired = []
+        for timer in bucket:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                expired.append(timer)
+        for timer in expired:
+            self._remove(timer)
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception('Timer callback failed')
+        if self.count and self.handle is None:
+            # Scheduled from the previous tick, so slow callbacks don't make
+            # the wheel drift
+            self.next_tick = max(self.next_tick + self.tick,
+                                 self.loop.time())
+            self.handle = self.loop.call_at(self.next_tick, self._advance)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_wheel():
+    """Return the `TimerWheel` of the current event loop."""
+    loop = asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(loop=loop)
+    return wheel
+
+
+class ConnectionTimersMixin:
+
+    """Handshake timeout, keep-alives and idle timeout of a connection on
+       the shared `TimerWheel`.
+
+       Users have an `outgoing` `MessageWriter`, stamp `last_received`
+       with `time.monotonic()` whenever data arrives, and implement
+       `handshake_done()` and `drop(reason)`. Timers are not moved on
+       every message, they check the timestamps when they fire and are
+       rescheduled for the remaining time.
+    """
+
+    HANDSHAKE_TIMEOUT = HANDSHAKE_TIMEOUT
+    KEEPALIVE_INTERVAL = KEEPALIVE_INTERVAL
+    IDLE_TIMEOUT = IDLE_TIMEOUT
+
+    timers = None
+    last_received = 0
+
+    def start_timers(self):
+        self.timers = {}
+        self.last_received = time.monotonic()
+        self.schedule_timer('handshake', self.HANDSHAKE_TIMEOUT,
+                            self.on_handshake_timeout)
+        self.schedule_timer('keepalive', self.KEEPALIVE_INTERVAL,
+                            self.on_keepalive)
+        self.schedule_timer('idle', self.IDLE_TIMEOUT, self.on_idle)
+
+    def schedule_timer(self, name, delay, callback):
+        timer = self.timers.get(name)
+        if timer is not None:
+            timer.cancel()
+        self.timers[name] = get_wheel().schedule(delay, callback)
+
+    def stop_timers(self):
+        if self.timers:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+
+    def on_handshake_timeout(self):
+        if not self.handshake_done():
+            self.drop('No handshake in {}s'.format(self.HANDSHAKE_TIMEOUT))
+
+    def on_keepalive(self):
+        elapsed = time.monotonic() - self.outgoing.last_write
+        if elapsed >= self.KEEPALIVE_INTERVAL:
+            self.outgoing.write(KeepAliveMessage.encoded)
+            elapsed = 0
+        self.schedule_timer('keepalive', self.KEEPALIVE_INTERVAL - elapsed,
+                            self.on_keepalive)
+
+    def on_idle(self):
+        elapsed = time.monotonic() - self.last_received
+        if elapsed >= self.IDLE_TIMEOUT:
+            self.drop('Nothing received in {}s'.format(self.IDLE_TIMEOUT))
+        else:
+            self.schedule_timer('idle', self.IDLE_TIMEOUT - elapsed,
+                                self.on_idle)
+
+    def handshake_done(self):
+        raise NotImplementedError()
+
+    def drop(self, reason):
+        raise NotImplementedError()
@@ -3,6 +3,7 @@
 import sys
 import hashlib
 from collections import namedtuple
+from urllib.parse import quote
 
 import bencodepy
 import binascii
@@ -51,6 +52,33 @@ class Torrent:
     def files(self):
         return self.info.files
     
+    @property
+    def tiers(self):
+        """Tiers of tracker URLs (BEP 12), just the announce URL for
+        torrents without an announce-list.
+        """
+        tiers = [list(tier) for tier in self.announce_list if tier]
+        return tiers or [[self.announce]]
+
+    @property
+    def web_seeds(self):
+        """HTTP URLs of the payload from `url-list` (BEP 19), a URL ending
+        with a slash names the directory of the file.
+        """
+        urls = self.url_list or []
+        if isinstance(urls, bytes):
+            urls = [urls]
+        seeds = []
+        for url in urls:
+            if not isinstance(url, bytes) or \
+                    not url.startswith((b'http://', b'https://')):
+                continue
+            url = url.decode('utf-8')
+            if url.endswith('/'):
+                url += quote(self.name.decode('utf-8'))
+            seeds.append(url)
+        return seeds
+
     @property
     def hash(self):
         m = hashlib.sha1()
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import time
+import random
 import socket
+import struct
+import asyncio
+import inspect
+import weakref
 from collections import namedtuple
-from struct import unpack
+from urllib.parse import quote, urlencode, urlsplit
 
 import bencodepy
 import aiohttp
-import requests
 
 from .utils import generate_peer_id
 from .logger import get_logger
+from .peers import decode_compact, decode_compact6, decode_peers
 
 
 logger = get_logger()
@@ -17,13 +23,47 @@ logger = get_logger()
 TrackerResponse = namedtuple('TrackerResponse',
                              ['complete', 'crypto_flags', 'incomplete',
                               'interval', 'peers'])
+ScrapeResponse = namedtuple('ScrapeResponse',
+                            ['complete', 'downloaded', 'incomplete'])
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+# connection id, action, transaction id
+UDP_REQUEST = struct.Struct('>QII')
+# action, transaction id
+UDP_RESPONSE = struct.Struct('>II')
+CONNECT_RESPONSE = struct.Struct('>Q')
+ANNOUNCE_REQUEST = struct.Struct('>20s20sQQQIIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('>III')
+SCRAPE_ENTRY = struct.Struct('>III')
+# Info hashes fitting into one scrape request
+MAX_SCRAPE_HASHES = 74
+
+# Connection pool of the HTTP trackers of an event loop
+HTTP_CONNECTIONS = 100
+HTTP_CONNECTIONS_PER_HOST = 4
+# Seconds an idle connection is kept open for the next announce
+HTTP_KEEPALIVE = 60
+HTTP_TIMEOUT = 30
+# Info hashes per HTTP scrape, keeps the URL below the usual 8 KB limit
+MAX_HTTP_SCRAPE_HASHES = 64
+
+
+class TrackerError(Exception):
+    pass
 
 
 class BaseTracker:
-    def __init__(self, url, size, info_hash):
+    # Announced when we don't accept connections, or before we do
+    PORT = 51412
+
+    def __init__(self, url, size, info_hash, port=PORT):
         self.url = url.decode('utf-8')
         self.size = size
         self.info_hash = info_hash
+        self.port = port
         self.peer_id = generate_peer_id()
 
     def announce(self):
@@ -33,53 +73,358 @@ class BaseTracker:
         raise NotImplemented()
 
 
-class UDPTracker:
-    """UDP Tracker. Some sites like piratebay use udp tracker.
+class UDPTrackerEndpoint(asyncio.DatagramProtocol):
     """
+    The UDP socket of all trackers of an event loop.
 
+    Requests of any number of trackers and torrents are in flight at the
+    same time, responses are matched to them by transaction id. Connection
+    ids are cached per tracker address for `CONNECTION_ID_LIFETIME`
+    seconds, concurrent requests to the same tracker share one connect.
+    """
+    CONNECTION_ID_LIFETIME = 60
 
-class HTTPTracker(BaseTracker):
-    def __init__(self, url, size, info_hash):
-        super().__init__(url, size, info_hash)
-        self.client = aiohttp.ClientSession()
+    def __init__(self):
+        self.transport = None
+        self.opening = None
+        # transaction id -> (address, future of the response)
+        self.transactions = {}
+        # address -> (connection id, time.monotonic() it was received)
+        self.connection_ids = {}
+        # address -> future of the connection id being requested
+        self.connecting = {}
+
+    async def open(self):
+        if self.transport is not None and not self.transport.is_closing():
+            return self
+        loop = asyncio.get_event_loop()
+        if self.opening is None or self.opening.done():
+            self.opening = asyncio.ensure_future(
+                loop.create_datagram_endpoint(
+                    lambda: self, local_addr=('0.0.0.0', 0)))
+        await asyncio.shield(self.opening)
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < UDP_RESPONSE.size:
+            return
+        _, transaction_id = UDP_RESPONSE.unpack_from(data)
+        address, future = self.transactions.get(transaction_id,
+                                                (None, None))
+        if future is None or future.done() or address != addr[:2]:
+            logger.debug('Unexpected tracker datagram from {}'.format(addr))
+            return
+        future.set_result(data)
+
+    def error_received(self, exc):
+        logger.debug('UDP tracker socket error: {}'.format(exc))
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.connection_ids.clear()
+        for _, future in self.transactions.values():
+            if not future.done():
+                future.set_exception(TrackerError('Socket closed'))
+
+    def begin(self, address):
+        """Register a transaction with `address`.
+
+        :return The transaction id and the future of the response.
+        """
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.transactions:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_event_loop().create_future()
+        self.transactions[transaction_id] = (address, future)
+        return transaction_id, future
+
+    def end(self, transaction_id):
+        self.transactions.pop(transaction_id, None)
+
+    def sendto(self, data, address):
+        self.transport.sendto(data, address)
+
+    def cached_connection_id(self, address):
+        entry = self.connection_ids.get(address)
+        if entry is None:
+            return None
+        connection_id, received = entry
+        if time.monotonic() - received >= self.CONNECTION_ID_LIFETIME:
+            del self.connection_ids[address]
+            return None
+        return connection_id
 
     def close(self):
-        self.client.close()
+        if self.transport is not None:
+            self.transport.close()
 
-    async def announce(self):
+
+_endpoints = weakref.WeakKeyDictionary()
+
+
+async def get_udp_endpoint():
+    """Return the open `UDPTrackerEndpoint` of the current event loop."""
+    loop = asyncio.get_event_loop()
+    endpoint = _endpoints.get(loop)
+    if endpoint is None:
+        endpoint = _endpoints[loop] = UDPTrackerEndpoint()
+    return await endpoint.open()
+
+
+class UDPTracker(BaseTracker):
+    """
+    Tracker client speaking the UDP tracker protocol (BEP 15), a fraction of
+    the cost of an HTTP announce and what most public torrents list.
+
+    Requests without a response are sent again after `TIMEOUT * 2 ** n`
+    seconds for the n-th attempt, up to `MAX_RETRIES` times, with a fresh
+    connection id once the cached one expired.
+    """
+    TIMEOUT = 15
+    MAX_RETRIES = 8
+
+    def __init__(self, url, size, info_hash, port=BaseTracker.PORT):
+        super().__init__(url, size, info_hash, port=port)
+        parts = urlsplit(self.url)
+        self.host = parts.hostname
+        self.tracker_port = parts.port
+        self.address = None
+        self.key = random.getrandbits(32)
+        self.numwant = 80
+
+    async def resolve(self):
+        if self.address is None:
+            loop = asyncio.get_event_loop()
+            infos = await loop.getaddrinfo(self.host, self.tracker_port,
+                                           family=socket.AF_INET,
+                                           type=socket.SOCK_DGRAM)
+            if not infos:
+                raise TrackerError("Can't resolve {}".format(self.host))
+            self.address = infos[0][4][:2]
+        return self.address
+
+    async def request(self, action, body=b''):
+        """Send a request and return the payload of its response, after
+        the action and transaction id.
         """
+        endpoint = await get_udp_endpoint()
+        address = await self.resolve()
+        transaction_id, future = endpoint.begin(address)
+        try:
+            for attempt in range(self.MAX_RETRIES + 1):
+                if action == CONNECT:
+                    connection_id = UDP_PROTOCOL_ID
+                else:
+                    connection_id = await self.connection_id(endpoint)
+                endpoint.sendto(UDP_REQUEST.pack(connection_id, action,
+                                                 transaction_id) + body,
+                                address)
+                try:
+                    data = await asyncio.wait_for(
+                        asyncio.shield(future), self.TIMEOUT * 2 ** attempt)
+                    break
+                except asyncio.TimeoutError:
+                    logger.debug('No response from tracker {}, attempt '
+                                 '{}'.format(self.url, attempt + 1))
+            else:
+                raise TrackerError('Tracker {} did not respond'.format(
+                    self.url))
+        finally:
+            endpoint.end(transaction_id)
+
+        response_action, _ = UDP_RESPONSE.unpack_from(data)
+        payload = data[UDP_RESPONSE.size:]
+        if response_action == ERROR:
+            # E.g. the tracker restarted and forgot our connection id
+            endpoint.connection_ids.pop(address, None)
+            raise TrackerError(payload.decode('utf-8', 'replace'))
+        if response_action != action:
+            raise TrackerError('Tracker answered action {} with {}'.format(
+                action, response_action))
+        return payload
+
+    async def connection_id(self, endpoint):
+        """The cached connection id of the tracker, connecting if there is
+        none.
         """
-        logger.debug('announce')
-        params = self.build_params_for_announce()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url,
-                                   params=params) as resp:
-                if resp.status == 200:
-                    content = await resp.read()
-                    return self.parse_tracker_response(content)
+        connection_id = endpoint.cached_connection_id(self.address)
+        if connection_id is not None:
+            return connection_id
+        connecting = endpoint.connecting.get(self.address)
+        if connecting is None:
+            connecting = asyncio.ensure_future(self._connect(endpoint))
+            endpoint.connecting[self.address] = connecting
+        return await asyncio.shield(connecting)
+
+    async def _connect(self, endpoint):
+        try:
+            payload = await self.request(CONNECT)
+            if len(payload) < CONNECT_RESPONSE.size:
+                raise TrackerError('Short connect response')
+            connection_id, = CONNECT_RESPONSE.unpack_from(payload)
+            endpoint.connection_ids[self.address] = (connection_id,
+                                                     time.monotonic())
+            return connection_id
+        finally:
+            endpoint.connecting.pop(self.address, None)
+
+    async def announce(self):
+        return await self.connect(first=True, uploaded=0, downloaded=0)
+
+    async def connect(self, first, uploaded, downloaded, event=''):
+        if not event and first:
+            event = 'started'
+        body = ANNOUNCE_REQUEST.pack(
+            self.info_hash, self.peer_id, downloaded,
+            max(self.size - downloaded, 0), uploaded, EVENTS[event], 0,
+            self.key, self.numwant, self.port)
+        payload = await self.request(ANNOUNCE, body)
+        if len(payload) < ANNOUNCE_RESPONSE.size:
+            raise TrackerError('Short announce response')
+        interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(payload)
+        return TrackerResponse(seeders, None, leechers, interval,
+                               decode_compact(
+                                   payload[ANNOUNCE_RESPONSE.size:]))
+
+    async def scrape(self, info_hashes=None):
+        """Swarm statistics of `info_hashes`, the torrent of the tracker
+        by default.
+
+        :return A dict from info hash to `ScrapeResponse`.
+        """
+        info_hashes = list(info_hashes or [self.info_hash])
+        result = {}
+        for start in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            chunk = info_hashes[start:start + MAX_SCRAPE_HASHES]
+            payload = await self.request(SCRAPE, b''.join(chunk))
+            for index, info_hash in enumerate(chunk):
+                offset = index * SCRAPE_ENTRY.size
+                if offset + SCRAPE_ENTRY.size > len(payload):
+                    break
+                result[info_hash] = ScrapeResponse(
+                    *SCRAPE_ENTRY.unpack_from(payload, offset))
+        return result
 
     def bye(self, uploaded, downloaded):
-        params = self.build_params_for_announce(
-            first=False, uploaded=0, downloaded=0, event='stopped')
+        """Announce the stopped event without waiting for the tracker."""
         logger.info('Saying bye to tracker')
-        res = requests.get(self.url, params=params)
-        logger.info('{}'.format(res))
+        return asyncio.ensure_future(self.connect(
+            first=False, uploaded=uploaded, downloaded=downloaded,
+            event='stopped'))
 
-    def parse_tracker_response(self, content):
-        resp = bencodepy.decode(content)
-        split_peers = [resp[b'peers'][i:i+6]
-                       for i in range(0, len(resp[b'peers']), 6)]
+    def close(self):
+        # The socket is shared with the other trackers of the event loop
+        pass
+
+
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_http_session():
+    """Return the `aiohttp.ClientSession` of the current event loop.
+
+    All HTTP trackers of the loop share its connection pool, so announces
+    of many torrents to the same tracker reuse a few kept alive
+    connections instead of opening one per request.
+    """
+    loop = asyncio.get_event_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS, limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE, use_dns_cache=True)
+        session = _sessions[loop] = aiohttp.ClientSession(
+            connector=connector)
+    return session
 
-        peers = [(socket.inet_ntoa(p[:4]), _decode_port(p[4:]))
-                for p in split_peers]
-        return TrackerResponse(resp[b'complete'], resp.get(b'crypto_flags'),
-                               resp.get(b'incomplete'), resp.get(b'interval'),
-                               peers)
+
+async def close_http_session():
+    """Close the pooled connections of the current event loop."""
+    session = _sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None:
+        closing = session.close()
+        # Newer aiohttp releases made closing the session a coroutine
+        if inspect.isawaitable(closing):
+            await closing
+
+
+class HTTPTracker(BaseTracker):
+    """
+    Tracker client speaking HTTP, requests go through the connection pool
+    of `get_http_session`.
+    """
+    def close(self):
+        # The session is shared with the other trackers of the event loop
+        pass
+
+    async def announce(self):
+        return await self.connect(first=True, uploaded=0, downloaded=0)
+
+    def bye(self, uploaded, downloaded):
+        """Announce the stopped event without waiting for the tracker."""
+        logger.info('Saying bye to tracker')
+        return asyncio.ensure_future(self.connect(
+            first=False, uploaded=uploaded, downloaded=downloaded,
+            event='stopped'))
+
+    def build_url(self, params, url=None):
+        """Percent-encode the query parameters ourselves, since
+        `info_hash` and `peer_id` are raw bytes.
+
+        :param params: A dict or a list of pairs, for repeated keys.
+        """
+        url = url or self.url
+        separator = '&' if '?' in url else '?'
+        # A space in a hash must be %20, trackers don't read + as one
+        return url + separator + urlencode(params, quote_via=quote)
+
+    @property
+    def scrape_url(self):
+        """The scrape URL by convention, the announce URL with its last
+        path segment starting with `scrape` instead of `announce`.
+        """
+        parts = urlsplit(self.url)
+        head, _, last = parts.path.rpartition('/')
+        if not last.startswith('announce'):
+            return None
+        path = head + '/scrape' + last[len('announce'):]
+        return parts._replace(path=path).geturl()
+
+    def decode(self, content):
+        """The dictionary of a bencoded response."""
+        try:
+            resp = bencodepy.decode(content)
+        except (bencodepy.DecodingError, ValueError, TypeError) as e:
+            raise TrackerError('Invalid response from {}: {}'.format(
+                self.url, e))
+        if not isinstance(resp, dict):
+            raise TrackerError('Invalid response from {}'.format(self.url))
+        return resp
+
+    def parse_tracker_response(self, content):
+        resp = self.decode(content)
+        if b'failure reason' in resp:
+            reason = resp[b'failure reason']
+            raise TrackerError(reason.decode('utf-8', 'replace')
+                               if isinstance(reason, bytes) else str(reason))
+        peers6 = resp.get(b'peers6', b'')
+        peers = decode_peers(resp.get(b'peers', b'')) + \
+            (decode_compact6(peers6) if isinstance(peers6, bytes) else [])
+        interval = resp.get(b'interval')
+        if not isinstance(interval, int) or interval <= 0:
+            # We keep announcing at the interval we use
+            interval = None
+        return TrackerResponse(resp.get(b'complete'),
+                               resp.get(b'crypto_flags'),
+                               resp.get(b'incomplete'), interval, peers)
 
     def build_params_for_announce(self):
          return {'info_hash': self.info_hash,
                 'peer_id': self.peer_id,
-                'port': '51412',
+                'port': str(self.port),
                 'uploaded': 0,
                 'downloaded': 0,
                 'left': self.size,
@@ -89,11 +434,27 @@ class HTTPTracker(BaseTracker):
                 'supportcrypto': 1,
                 'event': 'started'}
 
+    async def get(self, url):
+        """The body of a successful GET of `url`."""
+        session = get_http_session()
+
+        async def request():
+            async with session.get(url) as response:
+                data = await response.read()
+                if response.status != 200:
+                    raise TrackerError('Failed request; {}'.format(data))
+                return data
+
+        try:
+            return await asyncio.wait_for(request(), HTTP_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TrackerError('Tracker {} did not respond'.format(self.url))
+
     async def connect(self, first, uploaded, downloaded, event=''):
         params = self.build_params_for_announce()
         params['uploaded'] = uploaded
         params['downloaded'] = downloaded
-        params['left'] = self.size
+        params['left'] = max(self.size - downloaded, 0)
 
         if not first:
             params.pop('event')
@@ -102,14 +463,174 @@ class HTTPTracker(BaseTracker):
             params['event'] = event
 
         logger.debug('Connecting tracker')
+        data = await self.get(self.build_url(params))
+        return self.parse_tracker_response(data)
+
+    async def scrape(self, info_hashes=None):
+        """Swarm statistics of `info_hashes`, the torrent of the tracker
+        by default, `MAX_HTTP_SCRAPE_HASHES` of them per request.
 
-        async with self.client.get(self.url, params=params) as response:
-            if not response.status == 200:
-                raise Exception('Failed request; {}'.format(
-                    await response.read()))
-            data = await response.read()
-            return self.parse_tracker_response(data)
+        :return A dict from info hash to `ScrapeResponse`.
+        """
+        url = self.scrape_url
+        if url is None:
+            raise TrackerError('Tracker {} has no scrape URL'.format(
+                self.url))
+        info_hashes = list(info_hashes or [self.info_hash])
+        result = {}
+        for start in range(0, len(info_hashes), MAX_HTTP_SCRAPE_HASHES):
+            chunk = info_hashes[start:start + MAX_HTTP_SCRAPE_HASHES]
+            data = await self.get(self.build_url(
+                [('info_hash', info_hash) for info_hash in chunk], url))
+            files = self.decode(data).get(b'files', {})
+            if not isinstance(files, dict):
+                raise TrackerError('Invalid scrape response from {}'.format(
+                    self.url))
+            for info_hash in chunk:
+                stats = files.get(info_hash)
+                if isinstance(stats, dict):
+                    result[info_hash] = ScrapeResponse(
+                        stats.get(b'complete', 0),
+                        stats.get(b'downloaded', 0),
+                        stats.get(b'incomplete', 0))
+        return result
+
+
+def get_tracker(url, size, info_hash, port=BaseTracker.PORT):
+    """Tracker client for the scheme of `url`, None if there is none."""
+    if url.startswith(b'http'):
+        return HTTPTracker(url=url, size=size, info_hash=info_hash,
+                           port=port)
+    if url.startswith(b'udp'):
+        return UDPTracker(url=url, size=size, info_hash=info_hash,
+                          port=port)
+    return None
+
+
+class MultiTracker:
+    """
+    Announces to all trackers of an announce-list (BEP 12).
+
+    Tiers are tried in order, the trackers of a tier concurrently. The
+    first response is returned right away while the slower trackers are
+    still announcing, their peers are passed to `on_peers` as they arrive,
+    leaving out peers already seen in the same round. Trackers which
+    answer move to the front of their tier. A tracker failing `n` times in
+    a row is skipped for `BACKOFF * 2 ** (n - 1)` seconds, at most
+    `MAX_BACKOFF`, and the next tier is only tried when no tracker of the
+    tier answered.
+
+    Has the `announce`/`connect`/`bye`/`close` interface of a single
+    tracker, all trackers announce the same `peer_id` and `port`.
+
+    :param tiers: Lists of tracker URLs, unsupported schemes are ignored.
+    :param on_peers: Callable receiving lists of new `(host, port)`.
+    :param peer_id: Our peer id, a random one by default.
+    """
+    ANNOUNCE_TIMEOUT = 60
+    BACKOFF = 15
+    MAX_BACKOFF = 30 * 60
+
+    def __init__(self, tiers, size, info_hash, port=BaseTracker.PORT,
+                 on_peers=None, peer_id=None):
+        self.peer_id = peer_id if peer_id else generate_peer_id()
+        self.on_peers = on_peers
+        self.tiers = []
+        for urls in tiers:
+            tier = [get_tracker(url, size, info_hash, port=port)
+                    for url in urls]
+            tier = [tracker for tracker in tier if tracker is not None]
+            for tracker in tier:
+                tracker.peer_id = self.peer_id
+            random.shuffle(tier)
+            if tier:
+                self.tiers.append(tier)
+        # tracker -> (failures in a row, time.monotonic() to retry at)
+        self.failures = {}
+        # Trackers the started event was delivered to
+        self.started = set()
+        # Peers passed to `on_peers` in the current round
+        self.peers = set()
+        # Announces still running after the first response
+        self.pending = set()
+
+    @property
+    def trackers(self):
+        return [tracker for tier in self.tiers for tracker in tier]
 
+    @property
+    def port(self):
+        return self.trackers[0].port if self.trackers else None
 
-def _decode_port(port):
-    return unpack(">H", port)[0]
+    @port.setter
+    def port(self, port):
+        for tracker in self.trackers:
+            tracker.port = port
+
+    async def announce(self):
+        return await self.announce_round(lambda tracker: tracker.announce())
+
+    async def connect(self, first, uploaded, downloaded, event=''):
+        # Trackers which never answered still get the started event
+        return await self.announce_round(lambda tracker: tracker.connect(
+            first=first or tracker not in self.started, uploaded=uploaded,
+            downloaded=downloaded, event=event))
+
+    async def announce_round(self, announce):
+        """Announce with `announce(tracker)` tier by tier and return the
+        first response.
+        """
+        self.peers = set()
+        now = time.monotonic()
+        for tier in self.tiers:
+            trackers = [tracker for tracker in tier
+                        if self.failures.get(tracker, (0, 0))[1] <= now]
+            tasks = {asyncio.ensure_future(self.announce_one(
+                tier, tracker, announce)) for tracker in trackers}
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                responses = [task.result() for task in done
+                             if task.result() is not None]
+                if responses:
+                    self.pending.update(tasks)
+                    for task in tasks:
+                        task.add_done_callback(self.pending.discard)
+                    return responses[0]
+        raise TrackerError('No tracker responded')
+
+    async def announce_one(self, tier, tracker, announce):
+        try:
+            response = await asyncio.wait_for(announce(tracker),
+                                              self.ANNOUNCE_TIMEOUT)
+            if response is None:
+                raise TrackerError('Empty response')
+        except (TrackerError, OSError, asyncio.TimeoutError,
+                aiohttp.ClientError) as e:
+            failures = self.failures.get(tracker, (0, 0))[0] + 1
+            delay = min(self.BACKOFF * 2 ** (failures - 1), self.MAX_BACKOFF)
+            self.failures[tracker] = (failures, time.monotonic() + delay)
+            logger.info('Tracker {} failed, retrying in {}s: {}'.format(
+                tracker.url, delay, e))
+            return None
+
+        self.failures.pop(tracker, None)
+        self.started.add(tracker)
+        if tier[0] is not tracker:
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+        peers = [peer for peer in response.peers if peer not in self.peers]
+        self.peers.update(peers)
+        if peers and self.on_peers is not None:
+            self.on_peers(peers)
+        return response
+
+    def bye(self, uploaded, downloaded):
+        return [tracker.bye(uploaded=uploaded, downloaded=downloaded)
+                for tracker in self.started]
+
+    def close(self):
+        for task in list(self.pending):
+            task.cancel()
+        for tracker in self.trackers:
+            tracker.close()
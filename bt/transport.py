@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import time
+import struct
+import asyncio
+
+from . import utp
+from .logger import get_logger
+from .message import (HANDSHAKE, LENGTH, HandshakeMessage, decode_message,
+                      max_message_length)
+from .protocol import PeerConnection, PeerState, ProtocolError
+from .writer import MessageWriter
+
+
+logger = get_logger()
+
+# `BufferedProtocol` is only available from Python 3.7, older versions fall
+# back to `data_received` copying into the same preallocated buffer.
+BaseProtocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+class PeerProtocol(BaseProtocol):
+    """
+    Peer wire protocol on top of `asyncio.BufferedProtocol`.
+
+    The event loop receives straight into a preallocated buffer and every
+    complete message is decoded in place and handed to the connection
+    before the buffer is reused. Piece messages carry a `memoryview` of the
+    buffer as their block, so the consumer has to copy it out (once) during
+    the call. The object doubles as the writer of the connection, it has
+    the `write`/`drain`/`close` subset of `asyncio.StreamWriter` used by
+    `PeerConnection`. Messages longer than any the peer may send, or which
+    can't be decoded, close the connection.
+    """
+    BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.max_length = max_message_length(
+            connection.download_manager.total_pieces)
+        self.buffer = bytearray(PeerProtocol.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.transport = None
+        self.expect_handshake = True
+        loop = asyncio.get_event_loop()
+        self.handshake = loop.create_future()
+        self.closed = loop.create_future()
+        self.paused = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buffer):
+            self._make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        try:
+            self._parse()
+        except ProtocolError as e:
+            logger.debug(e)
+            self.close()
+        except Exception:
+            logger.exception('Error handling messages of peer {}'.format(
+                self.connection.peer))
+            self.close()
+
+    def data_received(self, data):
+        # Only used when `BufferedProtocol` is not available
+        while data:
+            target = self.get_buffer(len(data))
+            size = min(len(target), len(data))
+            target[:size] = data[:size]
+            data = data[size:]
+            self.buffer_updated(size)
+
+    def eof_received(self):
+        logger.debug('Connection closed by peer')
+
+    def connection_lost(self, exc):
+        if not self.handshake.done():
+            self.handshake.set_exception(
+                ProtocolError('Connection closed during handshake'))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        if self.paused is not None and not self.paused.done():
+            self.paused.set_result(None)
+
+    def _parse(self):
+        view = self.view
+        start = self.start
+        end = self.end
+
+        if self.expect_handshake:
+            if end - start < HANDSHAKE.size:
+                return
+            message = HandshakeMessage.decode(view[start:start +
+                                                   HANDSHAKE.size])
+            start += HANDSHAKE.size
+            self.start = start
+            self.expect_handshake = False
+            self.connection.handshake_received(message)
+            self.handshake.set_result(message)
+
+        received = False
+        while end - start >= LENGTH.size:
+            message_length = LENGTH.unpack_from(view, start)[0]
+            if message_length > self.max_length:
+                raise ProtocolError('Message of {} bytes'.format(
+                    message_length))
+            if end - start < LENGTH.size + message_length:
+                break
+            try:
+                message = decode_message(view[start:start + LENGTH.size +
+                                              message_length])
+            except struct.error as e:
+                raise ProtocolError('Invalid message: {}'.format(e))
+            start += LENGTH.size + message_length
+            if message:
+                received = True
+                self.connection.message_received(message)
+
+        if start == end:
+            start = end = 0
+        self.start = start
+        self.end = end
+        if received:
+            self.connection.messages_processed()
+
+    def _make_room(self):
+        """Move the partial message at the end of the buffer to the front,
+        or grow the buffer when a single message doesn't fit.
+        """
+        pending = self.end - self.start
+        if self.start > 0:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            buffer = bytearray(len(self.buffer) * 2)
+            buffer[:pending] = self.buffer[:pending]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    # Writer interface
+
+    def write(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    async def drain(self):
+        if self.paused is not None:
+            await self.paused
+
+    def pause_writing(self):
+        self.paused = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        if self.paused is not None and not self.paused.done():
+            self.paused.set_result(None)
+        self.paused = None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class BufferedPeerConnection(PeerConnection):
+    """
+    `PeerConnection` running on `PeerProtocol` instead of stream readers.
+
+    Messages are handled as soon as they are decoded from the receive
+    buffer, handlers returning a coroutine are scheduled as tasks, and the
+    next request is sent once per received batch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.protocol = None
+        super().__init__(*args, **kwargs)
+
+    async def start(self):
+        while PeerState.Stopped.value not in self.current_state:
+            try:
+                self.peer, self.protocol = await self.dial()
+                self.available_peers.connection_made(self.peer)
+                self.writer = self.protocol
+                self.outgoing = MessageWriter(self.writer)
+                self.start_timers()
+                logger.debug('Adding client to choke state')
+                if PeerState.Choked.value not in self.current_state:
+                    self.current_state.append(PeerState.Choked.value)
+
+                await self.send_handshake()
+                await self.send_interested()
+                await self.protocol.closed
+            except (asyncio.TimeoutError, ProtocolError, OSError) as e:
+                logger.debug(e)
+            except Exception:
+                logger.exception('Dropping peer {}'.format(self.peer))
+            finally:
+                self.connection_closed()
+
+    async def open_connection(self, peer):
+        """Connect to `peer` and return the `PeerProtocol` of the
+        connection.
+        """
+        loop = asyncio.get_event_loop()
+        _, protocol = await loop.create_connection(
+            lambda: PeerProtocol(self), peer[0], peer[1])
+        return protocol
+
+    def close_connection(self, protocol):
+        # Nobody waits for the handshake of the unused connection
+        protocol.handshake.cancel()
+        protocol.close()
+
+    async def send_handshake(self):
+        self.outgoing.send(HandshakeMessage(self.info_hash, self.peer_id))
+        await self.outgoing.drain()
+        # Validated by `handshake_received` as soon as it is parsed
+        await self.protocol.handshake
+
+    def message_received(self, message):
+        if PeerState.Stopped.value in self.current_state:
+            return
+        result = self.dispatch(message)
+        if result is not None:
+            asyncio.ensure_future(result)
+
+    def messages_processed(self):
+        self.last_received = time.monotonic()
+        # `send_next_message` checks the request state before its first
+        # await, so a redundant task returns right away.
+        asyncio.ensure_future(self.send_next_message())
+
+
+class UTPPeerConnection(BufferedPeerConnection):
+    """
+    `BufferedPeerConnection` over uTP, falling back to TCP for peers which
+    don't answer on UDP.
+    """
+    CONNECT_TIMEOUT = 1
+
+    async def open_connection(self, peer):
+        try:
+            _, protocol = await asyncio.wait_for(
+                utp.create_connection(lambda: PeerProtocol(self), peer[0],
+                                      peer[1]),
+                timeout=UTPPeerConnection.CONNECT_TIMEOUT)
+            return protocol
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.info('uTP connection to {} failed, using TCP: {}'.format(
+                peer, e))
+        return await super().open_connection(peer)
@@ -0,0 +1,656 @@
+# -*- coding: utf-8 -*-
+"""
+uTP, the Micro Transport Protocol (BEP 29).
+
+Reliable, ordered byte streams over UDP. Congestion control is LEDBAT
+(RFC 6817): the window grows while the queuing delay our packets see on
+the way to the peer stays below `TARGET_DELAY` and shrinks above it, so
+bulk transfers back off before they fill the buffers of the link and
+slow down everything else sharing it.
+
+`UTPConnection` implements the subset of `asyncio.Transport` used by the
+peer protocols, so `PeerProtocol` and `TorrentServer` run over uTP
+unchanged. Selective acks are not implemented, lost packets are recovered
+by fast retransmit after duplicate acks, a tail loss probe after two round
+trips and the retransmission timeout.
+"""
+
+import time
+import random
+import struct
+import asyncio
+from collections import OrderedDict, deque
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+# <type|version><extension><connection_id><timestamp_microseconds>
+# <timestamp_difference_microseconds><wnd_size><seq_nr><ack_nr>
+HEADER = struct.Struct('>BBHIIIHH')
+VERSION = 1
+
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+
+SEQ_MASK = 0xffff
+TIMESTAMP_MASK = 0xffffffff
+
+# Payload bytes per packet, keeps datagrams below a 1500 byte MTU
+PACKET_SIZE = 1400
+# Receive window advertised to the peer, data is handed to the protocol
+# as soon as it is in order so it never fills up
+RECV_WINDOW = 1024 * 1024
+# Writing is paused above and resumed below this many unsent bytes
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+# LEDBAT parameters, delays in microseconds
+TARGET_DELAY = 100000
+MAX_WINDOW_INCREASE = 3000
+MIN_WINDOW = PACKET_SIZE
+INITIAL_WINDOW = 2 * PACKET_SIZE
+
+# Retransmission timeouts in seconds
+INITIAL_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.5
+MAX_TIMEOUT = 16.0
+MAX_RETRANSMITS = 6
+DUPLICATE_ACKS = 3
+# Earliest tail loss probe
+MIN_PROBE_TIMEOUT = 0.01
+
+
+def _timestamp():
+    return int(time.monotonic() * 1000000) & TIMESTAMP_MASK
+
+
+def _seq_after(a, b):
+    """True if sequence number `a` comes after `b`, with wrap around."""
+    return 0 < ((a - b) & SEQ_MASK) < 0x8000
+
+
+class Ledbat:
+    """
+    LEDBAT congestion window in bytes.
+
+    Delays are the one way delays of our packets as reported by the peer,
+    which include the offset between the two clocks. The offset cancels
+    out against the base delay, the lowest delay seen in the last two
+    minutes, leaving the queuing delay. Until the first loss or until the
+    queuing delay reaches half the target the window grows by the bytes
+    acked (slow start).
+    """
+
+    def __init__(self):
+        self.window = INITIAL_WINDOW
+        self.slow_start = True
+        # (minute, lowest delay during that minute)
+        self.base_delays = deque(maxlen=2)
+
+    def base_delay(self, delay, now):
+        minute = int(now // 60)
+        if self.base_delays and self.base_delays[-1][0] == minute:
+            if delay < self.base_delays[-1][1]:
+                self.base_delays[-1] = (minute, delay)
+        else:
+            self.base_delays.append((minute, delay))
+        return min(lowest for _, lowest in self.base_delays)
+
+    def on_ack(self, delay, acked, now):
+        queuing = delay - self.base_delay(delay, now)
+        if self.slow_start:
+            if queuing < TARGET_DELAY // 2:
+                self.window += acked
+                return
+            self.slow_start = False
+        off_target = (TARGET_DELAY - queuing) / TARGET_DELAY
+        window_factor = min(acked, self.window) / max(self.window, acked)
+        self.window = max(MIN_WINDOW, self.window + MAX_WINDOW_INCREASE *
+                          off_target * window_factor)
+
+    def on_loss(self):
+        self.slow_start = False
+        self.window = max(MIN_WINDOW, self.window / 2)
+
+    def on_timeout(self):
+        self.slow_start = False
+        self.window = MIN_WINDOW
+
+
+class _Packet:
+    __slots__ = ('seq_nr', 'type', 'payload', 'sent_at', 'transmissions',
+                 'in_flight')
+
+    def __init__(self, seq_nr, type, payload):
+        self.seq_nr = seq_nr
+        self.type = type
+        self.payload = payload
+        self.sent_at = 0
+        self.transmissions = 0
+        self.in_flight = False
+
+
+class UTPConnection:
+    """
+    A single uTP stream, the transport of `protocol`.
+
+    Writes are packed back to back into full packets, the protocol has to
+    reassemble messages split over packets.
+    """
+
+    def __init__(self, socket, addr, recv_id, send_id, protocol_factory):
+        self.loop = asyncio.get_event_loop()
+        self.socket = socket
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.protocol = protocol_factory()
+        self.buffered_protocol = hasattr(self.protocol, 'buffer_updated')
+        self.connected = self.loop.create_future()
+        self.made = False
+        self.lost = False
+
+        self.seq_nr = 1
+        self.ack_nr = 0
+        self.outgoing = OrderedDict()
+        self.resend = deque()
+        self.flight = 0
+        self.send_queue = deque()
+        self.send_queued = 0
+        self.writing_paused = False
+        self.reorder = {}
+        self.peer_window = RECV_WINDOW
+        self.ledbat = Ledbat()
+        self.reply_micro = 0
+        self.last_ack = None
+        self.duplicate_acks = 0
+        self.rtt = None
+        self.rtt_var = 0.0
+        self.timeout = INITIAL_TIMEOUT
+        self.timer = None
+        self.probed = False
+        self.ack_handle = None
+
+        self.closing = False
+        self.fin_sent = False
+        self.eof = False
+
+    # Transport interface
+
+    def write(self, data):
+        if self.closing or self.lost or not data:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.send_queue.append(memoryview(data))
+        self.send_queued += len(data)
+        self._flush()
+        if not self.writing_paused and self.send_queued > HIGH_WATER:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+
+    def is_closing(self):
+        return self.closing or self.lost
+
+    def close(self):
+        """Send the queued data followed by a FIN. The connection is lost
+        once the FIN is acked and the FIN of the peer received.
+        """
+        if self.closing or self.lost:
+            return
+        self.closing = True
+        self._flush()
+        self._maybe_finish()
+
+    def abort(self):
+        if self.lost:
+            return
+        if self.made:
+            self._send_header(ST_RESET, self.seq_nr)
+        self._lost(None)
+
+    def get_write_buffer_size(self):
+        return self.send_queued
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.addr
+        if name == 'sockname':
+            return self.socket.transport.get_extra_info('sockname')
+        return default
+
+    # Sending
+
+    def send_syn(self):
+        self._queue(ST_SYN, b'')
+
+    def _send_header(self, type, seq_nr, payload=b''):
+        connection_id = self.recv_id if type == ST_SYN else self.send_id
+        self.socket.sendto(HEADER.pack(type << 4 | VERSION, 0, connection_id,
+                                       _timestamp(), self.reply_micro,
+                                       RECV_WINDOW, seq_nr, self.ack_nr) +
+                           payload, self.addr)
+
+    def _send_packet(self, packet):
+        if self.ack_handle is not None:
+            # The packet carries the ack
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        self._send_header(packet.type, packet.seq_nr, packet.payload)
+        packet.sent_at = self.loop.time()
+        packet.transmissions += 1
+        if not packet.in_flight:
+            packet.in_flight = True
+            self.flight += len(packet.payload)
+        self._arm_timer()
+
+    def _queue(self, type, payload):
+        packet = _Packet(self.seq_nr, type, payload)
+        self.outgoing[self.seq_nr] = packet
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self._send_packet(packet)
+
+    def _can_send(self):
+        window = min(self.ledbat.window, self.peer_window)
+        return self.flight == 0 or self.flight + PACKET_SIZE <= window
+
+    def _next_payload(self):
+        queue = self.send_queue
+        head = queue[0]
+        if len(head) >= PACKET_SIZE:
+            payload = head[:PACKET_SIZE]
+            if len(head) > PACKET_SIZE:
+                queue[0] = head[PACKET_SIZE:]
+            else:
+                queue.popleft()
+            payload = bytes(payload)
+        else:
+            parts = []
+            size = 0
+            while queue and size < PACKET_SIZE:
+                part = queue.popleft()
+                room = PACKET_SIZE - size
+                if len(part) > room:
+                    queue.appendleft(part[room:])
+                    part = part[:room]
+                size += len(part)
+                parts.append(part)
+            payload = b''.join(parts)
+        self.send_queued -= len(payload)
+        return payload
+
+    def _flush(self):
+        if not self.made or self.lost:
+            return
+        while self.resend and self._can_send():
+            packet = self.outgoing.get(self.resend.popleft())
+            if packet is not None and not packet.in_flight:
+                self._send_packet(packet)
+        while self.send_queue and self._can_send():
+            self._queue(ST_DATA, self._next_payload())
+        if self.closing and not self.send_queue and not self.fin_sent:
+            self.fin_sent = True
+            self._queue(ST_FIN, b'')
+        if self.writing_paused and self.send_queued <= LOW_WATER:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+
+    def _schedule_ack(self):
+        if self.ack_handle is None:
+            # Everything received during this loop iteration is acked at once
+            self.ack_handle = self.loop.call_soon(self._send_ack)
+
+    def _send_ack(self):
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if not self.lost:
+            self._send_header(ST_STATE, self.seq_nr)
+
+    # Timers
+
+    def _arm_timer(self):
+        if self.timer is not None:
+            return
+        if self.outgoing:
+            timeout = self.timeout
+            if self.made and not self.probed and self.rtt is not None:
+                timeout = min(timeout, max(2 * self.rtt, MIN_PROBE_TIMEOUT))
+            self.timer = self.loop.call_later(timeout, self._on_timeout)
+        elif self.fin_sent and not self.eof:
+            # Our FIN is acked, give the peer some time to send its own
+            self.timer = self.loop.call_later(self.timeout * 2,
+                                              self._on_timeout)
+
+    def _restart_timer(self):
+        self.probed = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self._arm_timer()
+
+    def _on_timeout(self):
+        self.timer = None
+        if not self.outgoing:
+            if self.fin_sent:
+                self._lost(None)
+            return
+        first = next(iter(self.outgoing.values()))
+        if self.made and not self.probed and self.rtt is not None:
+            # Probe first, the oldest packet is the one missing at the peer
+            # unless the acks got lost. Nothing is known about congestion
+            # yet so the window stays.
+            self.probed = True
+            self._send_packet(first)
+            return
+        if first.transmissions > MAX_RETRANSMITS:
+            self._lost(TimeoutError('uTP connection timed out'))
+            return
+        logger.debug('uTP timeout, resending {} packets'.format(
+            len(self.outgoing)))
+        self.ledbat.on_timeout()
+        self.timeout = min(self.timeout * 2, MAX_TIMEOUT)
+        # Everything in flight is considered lost
+        for packet in self.outgoing.values():
+            packet.in_flight = False
+        self.flight = 0
+        self.resend = deque(self.outgoing)
+        if self.made:
+            self._flush()
+        else:
+            self._send_packet(first)
+        self._arm_timer()
+
+    def _sample_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+            self.rtt_var = rtt / 2
+        else:
+            delta = rtt - self.rtt
+            self.rtt_var += (abs(delta) - self.rtt_var) / 4
+            self.rtt += delta / 8
+        self.timeout = min(max(MIN_TIMEOUT, self.rtt + 4 * self.rtt_var),
+                           MAX_TIMEOUT)
+
+    # Receiving
+
+    def packet_received(self, type, timestamp, timestamp_diff, window,
+                        seq_nr, ack_nr, payload):
+        if self.lost:
+            return
+        self.reply_micro = (_timestamp() - timestamp) & TIMESTAMP_MASK
+        self.peer_window = window
+        if type == ST_RESET:
+            self._lost(None if self.closing else
+                       ConnectionResetError('uTP connection reset'))
+            return
+        if type == ST_SYN:
+            # Our answer to the SYN was lost
+            self._send_ack()
+            return
+        if not self.made:
+            if type != ST_STATE:
+                return
+            # The first data packet of the peer will have this seq_nr
+            self.ack_nr = (seq_nr - 1) & SEQ_MASK
+            self._connection_made()
+
+        self._ack_received(ack_nr, timestamp_diff, type == ST_STATE)
+        if type == ST_DATA or type == ST_FIN:
+            self._data_received(type, seq_nr, payload)
+        self._flush()
+        self._maybe_finish()
+
+    def _ack_received(self, ack_nr, timestamp_diff, state):
+        now = self.loop.time()
+        acked = 0
+        progress = False
+        while self.outgoing:
+            seq_nr, packet = next(iter(self.outgoing.items()))
+            if _seq_after(seq_nr, ack_nr):
+                break
+            del self.outgoing[seq_nr]
+            progress = True
+            if packet.in_flight:
+                self.flight -= len(packet.payload)
+            acked += len(packet.payload)
+            if packet.transmissions == 1:
+                self._sample_rtt(now - packet.sent_at)
+
+        if progress:
+            self.duplicate_acks = 0
+            if timestamp_diff and acked:
+                self.ledbat.on_ack(timestamp_diff, acked, now)
+            self._restart_timer()
+        elif state and self.outgoing and ack_nr == self.last_ack:
+            self.duplicate_acks += 1
+            # Early retransmit, fewer packets after the lost one can't
+            # trigger as many duplicates
+            threshold = max(1, min(DUPLICATE_ACKS, len(self.outgoing) - 1))
+            if self.duplicate_acks == threshold:
+                # The packet after the acked one was lost, the later ones
+                # triggered the duplicates
+                self.ledbat.on_loss()
+                self._send_packet(next(iter(self.outgoing.values())))
+        self.last_ack = ack_nr
+
+    def _data_received(self, type, seq_nr, payload):
+        if self.eof or not _seq_after(seq_nr, self.ack_nr):
+            # Retransmission of a packet we already have
+            self._schedule_ack()
+            return
+        self.reorder[seq_nr] = (type, payload)
+        if seq_nr != (self.ack_nr + 1) & SEQ_MASK:
+            # Out of order, ack right away so the sender sees the duplicates
+            self._send_ack()
+            return
+        self._schedule_ack()
+        chunks = []
+        next_nr = (self.ack_nr + 1) & SEQ_MASK
+        while next_nr in self.reorder:
+            type, payload = self.reorder.pop(next_nr)
+            self.ack_nr = next_nr
+            if type == ST_FIN:
+                self.eof = True
+                self.reorder.clear()
+                break
+            chunks.append(payload)
+            next_nr = (next_nr + 1) & SEQ_MASK
+        if chunks:
+            self._deliver(chunks[0] if len(chunks) == 1 else
+                          b''.join(chunks))
+        if self.eof and not self.lost:
+            if not self.protocol.eof_received():
+                self.close()
+
+    def _deliver(self, data):
+        if not self.buffered_protocol:
+            self.protocol.data_received(data)
+            return
+        view = memoryview(data)
+        while view and not self.lost:
+            buffer = self.protocol.get_buffer(len(view))
+            size = min(len(buffer), len(view))
+            buffer[:size] = view[:size]
+            view = view[size:]
+            self.protocol.buffer_updated(size)
+
+    # State changes
+
+    def _connection_made(self):
+        self.made = True
+        if not self.connected.done():
+            self.connected.set_result(None)
+        self.protocol.connection_made(self)
+
+    def _maybe_finish(self):
+        if self.lost or not self.fin_sent or self.outgoing:
+            return
+        if self.eof:
+            if self.ack_handle is not None:
+                self.ack_handle.cancel()
+                self._send_ack()
+            self._lost(None)
+        else:
+            self._arm_timer()
+
+    def _lost(self, exc):
+        if self.lost:
+            return
+        self.lost = True
+        for handle in (self.timer, self.ack_handle):
+            if handle is not None:
+                handle.cancel()
+        self.timer = self.ack_handle = None
+        self.socket.unregister(self)
+        if not self.connected.done():
+            self.connected.set_exception(
+                exc or ConnectionError('uTP connection closed'))
+        elif self.made:
+            self.protocol.connection_lost(exc)
+
+
+class UTPSocket(asyncio.DatagramProtocol):
+    """
+    UDP endpoint multiplexing uTP connections by peer address and
+    connection id.
+
+    :param protocol_factory: Called for every incoming connection, None for
+                             a socket which only dials out.
+    """
+
+    def __init__(self, protocol_factory=None):
+        self.protocol_factory = protocol_factory
+        self.transport = None
+        self.remote = None
+        self.address = None
+        self.close_when_idle = False
+        # (addr, recv_id) -> connection
+        self.connections = {}
+        # (addr, send_id) -> connection, resets and repeated SYNs use it
+        self.by_send_id = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.remote = transport.get_extra_info('peername')
+        self.address = transport.get_extra_info('sockname')[:2]
+
+    def sendto(self, data, addr):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, None if self.remote else addr)
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        (type_version, extension, connection_id, timestamp, timestamp_diff,
+         window, seq_nr, ack_nr) = HEADER.unpack_from(data)
+        if type_version & 0x0f != VERSION:
+            return
+        type = type_version >> 4
+        offset = HEADER.size
+        while extension:
+            # Skip extension headers, <next extension><length><data>
+            if len(data) < offset + 2:
+                return
+            extension, length = data[offset], data[offset + 1]
+            offset += 2 + length
+        payload = data[offset:]
+
+        connection = self.connections.get((addr, connection_id))
+        if connection is None and type in (ST_RESET, ST_SYN):
+            connection = self.by_send_id.get((addr, connection_id))
+        if connection is not None:
+            connection.packet_received(type, timestamp, timestamp_diff,
+                                       window, seq_nr, ack_nr, payload)
+        elif type == ST_SYN and self.protocol_factory is not None:
+            self.accept(addr, connection_id, seq_nr)
+        elif type != ST_RESET:
+            self.sendto(HEADER.pack(ST_RESET << 4 | VERSION, 0,
+                                    connection_id, _timestamp(), 0, 0, 0,
+                                    seq_nr), addr)
+
+    def error_received(self, exc):
+        logger.debug('uTP socket error {}'.format(exc))
+        # ICMP errors of a connected socket, nobody listens on the port
+        for connection in list(self.connections.values()):
+            if not connection.made:
+                connection._lost(ConnectionRefusedError(str(exc)))
+
+    def connection_lost(self, exc):
+        for connection in list(self.connections.values()):
+            connection._lost(exc)
+
+    def register(self, connection):
+        self.connections[(connection.addr, connection.recv_id)] = connection
+        self.by_send_id[(connection.addr, connection.send_id)] = connection
+
+    def unregister(self, connection):
+        self.connections.pop((connection.addr, connection.recv_id), None)
+        self.by_send_id.pop((connection.addr, connection.send_id), None)
+        if self.close_when_idle and not self.connections:
+            self.transport.close()
+
+    def accept(self, addr, connection_id, seq_nr):
+        connection = UTPConnection(self, addr, (connection_id + 1) & SEQ_MASK,
+                                   connection_id, self.protocol_factory)
+        connection.seq_nr = random.getrandbits(16)
+        connection.ack_nr = seq_nr
+        self.register(connection)
+        connection._send_ack()
+        connection._connection_made()
+
+    async def connect(self, addr, protocol_factory):
+        recv_id = random.getrandbits(16)
+        while (addr, recv_id) in self.connections:
+            recv_id = random.getrandbits(16)
+        connection = UTPConnection(self, addr, recv_id,
+                                   (recv_id + 1) & SEQ_MASK, protocol_factory)
+        self.register(connection)
+        connection.send_syn()
+        try:
+            await connection.connected
+        except asyncio.CancelledError:
+            connection.abort()
+            raise
+        return connection, connection.protocol
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            connection.abort()
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def create_connection(protocol_factory, host, port):
+    """Open a uTP connection from a new UDP socket, the uTP version of
+    `loop.create_connection`.
+
+    :return (transport, protocol)
+    """
+    loop = asyncio.get_event_loop()
+    transport, socket = await loop.create_datagram_endpoint(
+        UTPSocket, remote_addr=(host, port))
+    socket.close_when_idle = True
+    try:
+        return await socket.connect(transport.get_extra_info('peername'),
+                                    protocol_factory)
+    except BaseException:
+        transport.close()
+        raise
+
+
+async def create_server(protocol_factory, host, port):
+    """Accept uTP connections on a UDP port.
+
+    :return The `UTPSocket`, `address` is where it listens and `close()`
+            resets every connection and stops listening.
+    """
+    loop = asyncio.get_event_loop()
+    _, socket = await loop.create_datagram_endpoint(
+        lambda: UTPSocket(protocol_factory), local_addr=(host, port))
+    return socket
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Web seeds (BEP 19), downloading pieces from plain HTTP servers hosting the
+payload.
+
+A web seed has every piece. Its workers take runs of missing pieces from
+the same picker the peer connections use and fetch each run with one
+`Range` request, handing the blocks to the same callback as the peers as
+they arrive, so pieces are verified and written like any other. Requests
+go through the pooled session of the HTTP trackers.
+"""
+
+import asyncio
+
+import aiohttp
+
+from .bitfield import Bitfield
+from .logger import get_logger
+from .tracker import HTTP_CONNECTIONS_PER_HOST, HTTP_TIMEOUT, get_http_session
+
+
+logger = get_logger()
+
+
+class WebSeedError(Exception):
+    pass
+
+
+class WebSeed:
+    """
+    Downloads pieces of a single file torrent from `url`.
+
+    :param download_manager: `DownloadManager` of the download, the web
+                             seed is one of its peers with `url` as id.
+    :param on_block_complete: Called like the one of the peer connections.
+    """
+    # Concurrent range requests, the pool keeps this many connections to a
+    # host open
+    CONNECTIONS = HTTP_CONNECTIONS_PER_HOST
+    # Bytes asked for with one request, at least one piece
+    RANGE_SIZE = 2 ** 20
+    # Seconds to wait for pieces once all are taken, they may be released
+    IDLE_DELAY = 0.1
+    # Seconds before retrying a failed server, doubled on every failure
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+    # Corrupt pieces after which the server is dropped
+    MAX_CORRUPT = 3
+
+    def __init__(self, url, download_manager, on_block_complete):
+        self.url = url
+        self.download_manager = download_manager
+        self.on_block_complete = on_block_complete
+        self.piece_length = download_manager.torrent.info.piece_length
+        self.downloaded = 0
+        self.failures = 0
+        self.corrupt = 0
+        self.workers = []
+
+    def start(self):
+        manager = self.download_manager
+        manager.add_peer(self.url, Bitfield.full(manager.total_pieces))
+        self.workers = [asyncio.ensure_future(self.work())
+                        for _ in range(self.CONNECTIONS)]
+        logger.info('Web seed {}'.format(self.url))
+        return self
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        self.download_manager.peers.pop(self.url, None)
+
+    async def work(self):
+        manager = self.download_manager
+        while self.url in manager.peers:
+            blocks = manager.next_range(self.url, self.RANGE_SIZE)
+            if not blocks:
+                await asyncio.sleep(self.IDLE_DELAY)
+                continue
+            try:
+                await asyncio.wait_for(self.fetch(blocks), HTTP_TIMEOUT)
+            except (WebSeedError, aiohttp.ClientError, asyncio.TimeoutError,
+                    OSError) as e:
+                # Nothing is held back while we wait
+                self.release(blocks)
+                if self.url not in manager.peers:
+                    # Stopped, `wait_for` may have swallowed the cancel
+                    return
+                self.failures += 1
+                delay = min(self.RETRY_DELAY * 2 ** (self.failures - 1),
+                            self.MAX_RETRY_DELAY)
+                logger.info('Web seed {} failed, retrying in {}s: {}'.format(
+                    self.url, delay, e))
+                await asyncio.sleep(delay)
+            else:
+                self.failures = 0
+            finally:
+                self.release(blocks)
+
+    async def fetch(self, blocks):
+        """Request the bytes of `blocks` and pass each one on as soon as
+        it is read, so pieces of a run complete one after another.
+        """
+        first, last = blocks[0], blocks[-1]
+        start = first.piece * self.piece_length + first.offset
+        end = last.piece * self.piece_length + last.offset + last.length
+        headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        # Pieces we fetch all blocks of, only those tell about the server
+        whole = {block.piece for block in blocks if block.offset == 0}
+        async with get_http_session().get(self.url,
+                                          headers=headers) as response:
+            if response.status == 200:
+                # It would send the whole file for every range
+                self.stop()
+                raise WebSeedError('{} ignores ranges'.format(self.url))
+            if response.status != 206:
+                raise WebSeedError('Status {} for {}'.format(
+                    response.status, headers['Range']))
+            while blocks:
+                block = blocks[0]
+                data = await response.content.readexactly(block.length)
+                del blocks[0]
+                self.downloaded += len(data)
+                self.on_block_complete(peer_id=self.url,
+                                       piece_index=block.piece,
+                                       block_offset=block.offset, data=data)
+                if block.piece in whole and block is \
+                        self.download_manager.pieces[block.piece].blocks[-1]:
+                    self.piece_done(block.piece)
+
+    def piece_done(self, index):
+        """Drop a server whose pieces fail the hash check, the pieces are
+        verified as their last block arrives.
+        """
+        if self.download_manager.have[index]:
+            return
+        self.corrupt += 1
+        logger.info('Web seed {} sent corrupt piece {}'.format(
+            self.url, index))
+        if self.corrupt >= self.MAX_CORRUPT:
+            self.stop()
+
+    def release(self, blocks):
+        """Make the blocks of a failed request available to the others,
+        `blocks` is emptied.
+        """
+        for block in blocks:
+            self.download_manager.block_rejected(
+                peer_id=self.url, piece_index=block.piece,
+                block_offset=block.offset)
+        del blocks[:]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import signal
+import socket
+import asyncio
+import resource
+import multiprocessing
+
+from .logger import get_logger
+from .cache import PieceCache
+from .choker import Choker
+from .writer import MessageWriter
+
+
+logger = get_logger()
+
+# Counters every worker publishes, summed up by `WorkerPool.stats`
+STATS = ('connections', 'bytes', 'writes', 'sendfile', 'cache_hits',
+         'cache_misses', 'cpu_ms')
+
+
+class WorkerPool:
+    """
+    Seed from `workers` processes sharing one listening port.
+
+    Every worker binds `host`/`port` with `SO_REUSEPORT`, so the kernel
+    spreads incoming connections over them, and runs its own event loop,
+    choker and piece cache. Pieces are cached as views of a read only
+    memory map of the payload, the pages are shared by all workers through
+    the page cache. Workers publish their counters to shared memory every
+    `STATS_INTERVAL` seconds and once more when they stop.
+
+    :param torrent_path: Path of the .torrent file, parsed by every worker.
+    :param port: 0 picks a free port, available as `port` after `start`.
+    :param peer_id: Peer id of all workers, a random one by default.
+    """
+    STATS_INTERVAL = 1.0
+    START_TIMEOUT = 30
+
+    def __init__(self, torrent_path, workers, host='0.0.0.0', port=0,
+                 path=None, slots=Choker.UPLOAD_SLOTS, sendfile=True,
+                 cache_size=PieceCache.CAPACITY, peer_id=None):
+        self.torrent_path = torrent_path
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.options = dict(path=path, slots=slots, sendfile=sendfile,
+                            cache_size=cache_size, peer_id=peer_id)
+        self.context = multiprocessing.get_context('spawn')
+        self.counters = self.context.Array('q', workers * len(STATS),
+                                           lock=False)
+        self.processes = []
+
+    def start(self):
+        """Start the workers and wait until all of them listen."""
+        # Hold the port so no other program takes it before the workers
+        # bind, a socket which doesn't listen gets no connections
+        reserved = socket.socket()
+        reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reserved.bind((self.host, self.port))
+        self.port = reserved.getsockname()[1]
+        ready = self.context.Queue()
+        try:
+            for index in range(self.workers):
+                process = self.context.Process(
+                    target=_run_worker, daemon=True,
+                    args=(index, self.torrent_path, self.host, self.port,
+                          self.options, self.counters, ready))
+                process.start()
+                self.processes.append(process)
+            for _ in range(self.workers):
+                ready.get(timeout=WorkerPool.START_TIMEOUT)
+        except Exception:
+            self.stop()
+            raise
+        finally:
+            reserved.close()
+        logger.info('{} workers seeding on {}:{}'.format(
+            self.workers, self.host, self.port))
+        return self
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def stats(self):
+        """Counters of all workers added up."""
+        totals = dict.fromkeys(STATS, 0)
+        for index in range(self.workers):
+            for offset, name in enumerate(STATS):
+                totals[name] += self.counters[index * len(STATS) + offset]
+        return totals
+
+
+def _run_worker(index, torrent_path, host, port, options, counters, ready):
+    from .server import TorrentServer
+    from .torrent_parser import parse
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    factory = TorrentServer(parse(torrent_path), use_mmap=True, **options)
+    server = loop.run_until_complete(loop.create_server(
+        factory, host=host, port=port, reuse_port=True))
+
+    def publish():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        values = {
+            'connections': len(factory.connections),
+            'bytes': MessageWriter.stats['bytes'],
+            'writes': MessageWriter.stats['writes'],
+            'sendfile': MessageWriter.stats['sendfile'],
+            'cache_hits': PieceCache.stats['hits'],
+            'cache_misses': PieceCache.stats['misses'],
+            'cpu_ms': int((usage.ru_utime + usage.ru_stime) * 1000)}
+        for offset, name in enumerate(STATS):
+            counters[index * len(STATS) + offset] = values[name]
+
+    def tick():
+        publish()
+        loop.call_later(WorkerPool.STATS_INTERVAL, tick)
+
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    tick()
+    ready.put(index)
+    try:
+        loop.run_forever()
+    finally:
+        publish()
+        server.close()
+        loop.close()
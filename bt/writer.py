@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+
+from .logger import get_logger
+
+
+logger = get_logger()
+
+
+class MessageWriter:
+    """
+    Outgoing message queue of a single connection.
+
+    `send` only queues the encoded message. All messages queued during one
+    iteration of the event loop are joined and written with a single
+    `transport.write`, so a burst of requests, haves or cancels becomes one
+    syscall and as few TCP segments as possible instead of one each.
+    `drain` returns immediately unless the transport buffer is above the
+    high-water mark, only then it waits for the underlying writer.
+
+    :param writer: `asyncio.StreamWriter`, an object with the same
+                   `transport`/`drain`/`close` attributes, or a bare
+                   transport (which is never waited on).
+    :param sendfile: Let `sendfile` pass file data to the socket of the
+                     transport with `os.sendfile`, if it has one.
+    """
+    HIGH_WATER = 256 * 1024
+
+    # Totals over all connections, read by the benchmarks
+    stats = Counter()
+
+    def __init__(self, writer, high_water=HIGH_WATER, sendfile=False):
+        self.writer = writer
+        self.transport = getattr(writer, 'transport', writer)
+        self.high_water = high_water
+        self.socket = self._get_socket() if sendfile else None
+        self.queue = []
+        self.queued_bytes = 0
+        self.flush_handle = None
+        # Monotonic time of the last write, keep-alives are sent after a
+        # quiet period
+        self.last_write = time.monotonic()
+
+    def send(self, message):
+        self.write(message.encode())
+
+    def write(self, data):
+        self.queue.append(data)
+        self.queued_bytes += len(data)
+        MessageWriter.stats['messages'] += 1
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(
+                self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.queue:
+            return
+        data = self.queue[0] if len(self.queue) == 1 else b''.join(self.queue)
+        self.queue = []
+        self.queued_bytes = 0
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.write(data)
+        self.last_write = time.monotonic()
+        MessageWriter.stats['writes'] += 1
+        MessageWriter.stats['bytes'] += len(data)
+
+    def _get_socket(self):
+        if not hasattr(os, 'sendfile') or self.transport is None:
+            return None
+        sock = self.transport.get_extra_info('socket')
+        if sock is None or sock.type != socket.SOCK_STREAM:
+            return None
+        return sock
+
+    def sendfile(self, header, fd, offset, count):
+        """Send `header` followed by `count` bytes of the file `fd` from
+        `offset`.
+
+        When the transport has nothing buffered the bytes go from the page
+        cache to the socket with `os.sendfile`, without being copied into
+        Python. Otherwise, and for whatever the socket didn't accept, they
+        are read and queued like any other message.
+        """
+        self.write(header)
+        sent = 0
+        if self.socket is not None:
+            self.flush()
+            if self.transport.get_write_buffer_size() == 0 and \
+                    not self.transport.is_closing():
+                try:
+                    sent = os.sendfile(self.socket.fileno(), fd, offset,
+                                       count)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError as e:
+                    logger.debug('sendfile failed, reading instead: '
+                                 '{}'.format(e))
+                    self.socket = None
+                else:
+                    MessageWriter.stats['sendfile'] += 1
+                    MessageWriter.stats['bytes'] += sent
+        if sent < count:
+            self.write(os.pread(fd, count - sent, offset + sent))
+
+    @contextmanager
+    def corked(self):
+        """Hold partial TCP segments while sending several messages
+        with `sendfile`, so the small headers go out with the data.
+        """
+        cork = getattr(socket, 'TCP_CORK', None)
+        if self.socket is None or cork is None:
+            yield
+            return
+        self.socket.setsockopt(socket.IPPROTO_TCP, cork, 1)
+        try:
+            yield
+        finally:
+            self.flush()
+            if self.socket is not None:
+                self.socket.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
+    def buffered(self):
+        """Bytes waiting to be sent, queued here or in the transport."""
+        size = self.queued_bytes
+        if self.transport is not None:
+            size += self.transport.get_write_buffer_size()
+        return size
+
+    async def drain(self):
+        if self.buffered() <= self.high_water:
+            return
+        self.flush()
+        drain = getattr(self.writer, 'drain', None)
+        if drain is not None:
+            MessageWriter.stats['drains'] += 1
+            await drain()
+
+    def close(self):
+        self.flush()
+        if hasattr(self.writer, 'close'):
+            self.writer.close()
@@ -11,6 +11,9 @@ import click
 import bencodepy
 
 from bt import Client, get_logger, run_server
+from bt.dht import DHTNode
+from bt.lsd import LocalServiceDiscovery
+from bt.workers import WorkerPool
 
 
 @click.group()
@@ -23,8 +26,26 @@ def cli():
               help='info or debug. debug is enlightening')
 @click.option('--savedir', default='.',
               help='Destination to save the downloaded file')
+@click.option('--transport', default='stream',
+              type=click.Choice(['stream', 'buffered', 'utp']),
+              help='stream (StreamReader), buffered (BufferedProtocol) or '
+                   'utp (uTP, falling back to TCP)')
+@click.option('--port', default=0,
+              help='Port peers download our completed pieces from, 0 picks '
+                   'a free one')
+@click.option('--dht/--no-dht', default=True,
+              help='Look up peers on the Mainline DHT as well')
+@click.option('--dht-port', default=6881, help='UDP port of the DHT node')
+@click.option('--dht-state', default='~/.bt-dht',
+              help='File the DHT routing table is kept in between runs')
+@click.option('--lsd/--no-lsd', default=True,
+              help='Find peers on the local network with multicast '
+                   'announces, they are preferred')
+@click.option('--web-seeds/--no-web-seeds', default=True,
+              help='Download from the HTTP servers listed in the torrent')
 @click.argument('path')
-def download(loglevel, savedir, path):
+def download(loglevel, savedir, transport, port, dht, dht_port, dht_state,
+             lsd, web_seeds, path):
     try:
         os.environ['loglevel'] = loglevel
         logger = get_logger()
@@ -39,7 +60,24 @@ def download(loglevel, savedir, path):
 
         loop = asyncio.get_event_loop()
         loop.set_debug(True)
-        client = Client()
+        node = None
+        if dht:
+            try:
+                node = loop.run_until_complete(DHTNode(
+                    state_path=os.path.expanduser(dht_state)).start(
+                        port=dht_port))
+            except OSError as e:
+                logger.info('DHT unavailable: {}'.format(e))
+        discovery = None
+        if lsd:
+            try:
+                discovery = loop.run_until_complete(
+                    LocalServiceDiscovery().start())
+            except OSError as e:
+                logger.info('Local service discovery unavailable: '
+                            '{}'.format(e))
+        client = Client(transport=transport, port=port, dht=node,
+                        lsd=discovery, web_seeds=web_seeds)
         task = loop.create_task(client.download(path, savedir))
         try:
             loop.run_until_complete(task)
@@ -51,6 +89,7 @@ def download(loglevel, savedir, path):
                 loop.run_until_complete(task)
             except Exception:
                 pass 
+            loop.run_until_complete(client.close())
             loop.close()
     except (bencodepy.DecodingError,
             FileNotFoundError) as e:
@@ -60,8 +99,16 @@ def download(loglevel, savedir, path):
 @click.command()
 @click.option('--loglevel', default='info',
               help='info or debug. debug is enlightening')
+@click.option('--upload-slots', default=4,
+              help='Number of peers uploaded to at the same time')
+@click.option('--cache-size', default=32,
+              help='Memory for cached pieces in MB')
+@click.option('--host', default='0.0.0.0', help='Address to listen on')
+@click.option('--port', default=51213, help='Port to listen on')
+@click.option('--workers', default=1,
+              help='Processes serving peers, they share the port')
 @click.argument('path')
-def upload(loglevel, path):
+def upload(loglevel, upload_slots, cache_size, host, port, workers, path):
     try:
         os.environ['loglevel'] = loglevel
         logger = get_logger()
@@ -71,8 +118,19 @@ def upload(loglevel, path):
         # warnings.simplefilter('always', ResourceWarning)
         client = Client()
         client.parse(path)
-        task = loop.create_task(client.upload())
-        server = run_server(port=51213, torrent=client.torrent)
+        task = loop.create_task(client.upload(port=port))
+        pool = None
+        if workers > 1:
+            pool = WorkerPool(path, workers, host=host, port=port,
+                              slots=upload_slots,
+                              cache_size=cache_size * 1024 * 1024,
+                              peer_id=client.peer_id).start()
+            server = asyncio.sleep(0)
+        else:
+            server = run_server(port=port, torrent=client.torrent,
+                                slots=upload_slots,
+                                cache_size=cache_size * 1024 * 1024,
+                                host=host, peer_id=client.peer_id)
         server_task = loop.create_task(server)
 
         try:
@@ -88,9 +146,14 @@ def upload(loglevel, path):
         finally:
             task.cancel()
             server_task.cancel()
+            if pool is not None:
+                pool.stop()
+                logger.info('Served {bytes} bytes, {cache_hits} cache hits, '
+                            '{cpu_ms} ms of CPU'
+                            .format(**pool.stats()))
             try:
                 logger.info('Smothly disconnecting')
-                client.close()
+                loop.run_until_complete(client.close())
             except Exception:
                 pass
             loop.close()
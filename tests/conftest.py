@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import asyncio
+from hashlib import sha1
+from collections import namedtuple
+
+import pytest
+import bencodepy
+
+from bt.torrent_parser import parse
+
+
+TorrentFile = namedtuple('TorrentFile', 'torrent path torrent_path payload')
+
+
+@pytest.fixture
+def loop():
+    """A new event loop, the current one during the test."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def run(loop):
+    """Run a coroutine to completion on the loop of the test."""
+    return loop.run_until_complete
+
+
+@pytest.fixture
+def torrent_file(tmpdir):
+    """Factory writing a payload of pseudo random bytes to the test's
+    directory along with the single file .torrent describing it.
+    """
+    def create(size, piece_length, name='payload.bin',
+               announce='http://127.0.0.1/announce'):
+        payload = random.Random(size).getrandbits(size * 8).to_bytes(
+            size, 'little')
+        path = str(tmpdir.join(name))
+        with open(path, 'wb') as f:
+            f.write(payload)
+        pieces = [sha1(payload[start:start + piece_length]).digest()
+                  for start in range(0, size, piece_length)]
+        meta = {b'announce': announce.encode('utf-8'),
+                b'info': {b'name': name.encode('utf-8'),
+                          b'length': size,
+                          b'piece length': piece_length,
+                          b'pieces': b''.join(pieces)}}
+        torrent_path = os.path.splitext(path)[0] + '.torrent'
+        with open(torrent_path, 'wb') as f:
+            f.write(bencodepy.encode(meta))
+        return TorrentFile(parse(torrent_path), path, torrent_path, payload)
+
+    return create
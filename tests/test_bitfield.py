@@ -0,0 +1,61 @@
+from bt.bitfield import Bitfield
+from bt.message import BitFieldMessage, decode_message
+
+
+def test_set_and_get():
+    bitfield = Bitfield(10)
+    bitfield[0] = 1
+    bitfield[9] = 1
+    assert bitfield[0] and bitfield[9]
+    assert not bitfield[1]
+    assert bitfield.tobytes() == b'\x80\x40'
+    bitfield[0] = 0
+    assert not bitfield[0]
+    assert bitfield.count() == 1
+
+
+def test_out_of_range():
+    bitfield = Bitfield(10)
+    for index in (-1, 10):
+        try:
+            bitfield[index]
+        except IndexError:
+            pass
+        else:
+            assert False, index
+
+
+def test_full_clears_spare_bits():
+    bitfield = Bitfield.full(10)
+    assert bitfield.tobytes() == b'\xff\xc0'
+    assert bitfield.count() == 10
+    assert bitfield.all()
+
+
+def test_bulk_operations():
+    theirs = Bitfield(12, b'\xf0\xf0')
+    ours = Bitfield(12, b'\x30\x00')
+    assert list((theirs & ours).indexes()) == [2, 3]
+    assert list((theirs | ours).indexes()) == [0, 1, 2, 3, 8, 9, 10, 11]
+    assert list(theirs.andnot(ours).indexes()) == [0, 1, 8, 9, 10, 11]
+    assert theirs.andnot(ours).first() == 0
+    assert Bitfield(12).first() is None
+    assert not Bitfield(12).any()
+
+
+def test_different_lengths_are_aligned():
+    # A decoded message is padded to whole bytes
+    padded = Bitfield.from_bytes(b'\xff\xff')
+    assert len(padded) == 16
+    assert (Bitfield(12) | padded).count() == 12
+
+
+def test_message_roundtrip():
+    bitfield = Bitfield(20)
+    bitfield[3] = 1
+    bitfield[19] = 1
+    data = BitFieldMessage(bitfield).encode()
+    assert data == b'\x00\x00\x00\x04\x05\x10\x00\x10'
+    message = decode_message(data)
+    assert isinstance(message, BitFieldMessage)
+    assert Bitfield(20, message.bitfield.data) == bitfield
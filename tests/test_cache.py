@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from bt.cache import PieceCache
+from bt.server import SourceFileReader
+
+
+def file_reader(torrent_file):
+    created = torrent_file(5000, piece_length=1024)
+    return (SourceFileReader(created.torrent, path=created.path),
+            created.payload)
+
+
+def test_reads_ahead_whole_pieces(torrent_file):
+    reader, payload = file_reader(torrent_file)
+    cache = PieceCache(reader, capacity=4096)
+
+    blocks = [bytes(cache.read(1, begin, 256)) for begin in range(0, 1024,
+                                                                  256)]
+    assert b''.join(blocks) == payload[1024:2048]
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.hit_rate == 0.75
+
+    # The last piece is shorter
+    assert bytes(cache.read(4, 900, 100)) == payload[4996:5000]
+    assert cache.size == 1024 + 904
+
+
+def test_evicts_least_recently_used_pieces(torrent_file):
+    reader, payload = file_reader(torrent_file)
+    cache = PieceCache(reader, capacity=2048)
+    cache.read(0, 0, 16)
+    cache.read(1, 0, 16)
+    cache.read(0, 16, 16)
+    cache.read(2, 0, 16)
+    assert 1 not in cache
+    assert list(cache.pieces) == [0, 2]
+    assert cache.size <= cache.capacity
+
+    # A cache smaller than a piece reads blocks directly
+    uncached = PieceCache(reader, capacity=0)
+    assert bytes(uncached.read(3, 10, 20)) == payload[3082:3102]
+    assert len(uncached) == 0
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from bt.choker import Choker
+
+
+class Peer:
+    def __init__(self, name, interested=True):
+        self.name = name
+        self.interested = interested
+        self.choked = True
+        self.uploaded = 0
+        self.downloaded = 0
+        self.messages = []
+
+    def choke(self):
+        self.choked = True
+        self.messages.append('choke')
+
+    def unchoke(self):
+        self.choked = False
+        self.messages.append('unchoke')
+
+    def __repr__(self):
+        return self.name
+
+
+def unchoked(choker):
+    return {peer.name for peer in choker.peers if not peer.choked}
+
+
+def test_unchokes_best_uploaders_and_one_optimistic(loop):
+    random.seed(1)
+    choker = Choker(slots=2)
+    peers = [Peer('p{}'.format(i)) for i in range(5)]
+    peers.append(Peer('idle', interested=False))
+    for peer in peers:
+        choker.add(peer)
+    for rate, peer in zip([10, 50, 40, 0, 20], peers):
+        peer.downloaded += rate
+    choker.run()
+
+    optimistic = choker.optimistic
+    assert optimistic is not None and optimistic.name != 'idle'
+    best = sorted((p for p in peers[:5] if p is not optimistic),
+                  key=lambda p: p.downloaded, reverse=True)[:2]
+    assert unchoked(choker) == {p.name for p in best} | {optimistic.name}
+
+    # Rates are per round, the optimistic unchoke is kept for three
+    for peer in peers:
+        peer.downloaded += 5
+    peers[3].downloaded += 100
+    choker.run()
+    assert choker.optimistic is optimistic
+    assert 'p3' in unchoked(choker)
+    assert len(unchoked(choker)) == 3
+    assert peers[3].messages[-1] == 'unchoke'
+    choker.run()
+    choker.run()
+    assert choker.optimistic is not optimistic
+    for peer in list(peers):
+        choker.remove(peer)
+    assert choker.timer is None
+
+
+def test_ranks_by_upload_rate_when_seeding(loop):
+    choker = Choker(slots=1, seeding=lambda: True)
+    fast, slow = Peer('fast'), Peer('slow')
+    choker.add(fast)
+    choker.add(slow)
+    fast.uploaded, slow.downloaded = 100, 1000
+    choker.optimistic = slow
+    choker.rounds = 1
+    choker.run()
+    assert unchoked(choker) == {'fast', 'slow'}
+    assert choker.free_slot() is False
+    choker.remove(fast)
+    assert choker.free_slot() is True
+    choker.remove(slow)
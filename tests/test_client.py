@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from bt.bitfield import Bitfield
+from bt.client import Block, DownloadManager
+from bt.message import REQUEST_SIZE
+
+
+def test_invalid_blocks_are_requested_again(tmpdir, torrent_file, loop):
+    created = torrent_file(4 * REQUEST_SIZE, piece_length=2 * REQUEST_SIZE)
+    manager = DownloadManager(created.torrent,
+                              str(tmpdir.mkdir('leech')).encode('utf-8'))
+    payload = created.payload
+    try:
+        manager.add_peer('peer', Bitfield.full(manager.total_pieces))
+        first = manager.next_request('peer')
+        second = manager.next_request('peer')
+        piece = manager.pieces[0]
+
+        # Too long, at an offset without a block and for a piece too far
+        manager.on_block_complete('peer', 0, 0, payload[:REQUEST_SIZE + 100])
+        manager.on_block_complete('peer', 0, 100, payload[:REQUEST_SIZE])
+        manager.on_block_complete('peer', 7, 0, payload[:REQUEST_SIZE])
+        assert piece.buffer is None
+        assert first.status is Block.Missing
+        assert manager.next_request('peer') is first
+
+        # A corrupt piece doesn't keep its bytes
+        manager.on_block_complete('peer', 0, 0, bytes(REQUEST_SIZE))
+        manager.on_block_complete('peer', 0, REQUEST_SIZE,
+                                  payload[REQUEST_SIZE:2 * REQUEST_SIZE])
+        assert piece.buffer is None
+        assert second.status is Block.Missing
+
+        for block in (manager.next_request('peer'),
+                      manager.next_request('peer')):
+            manager.on_block_complete('peer', 0, block.offset, payload[
+                block.offset:block.offset + REQUEST_SIZE])
+        assert manager.have[0]
+    finally:
+        manager.close()
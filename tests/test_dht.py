@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+import pytest
+import bencodepy
+
+from bt import dht
+from bt.dht import (K,
+                    PROTOCOL_ERROR,
+                    DHTError,
+                    DHTNode,
+                    RoutingTable,
+                    decode_nodes,
+                    encode_nodes)
+
+from benchmarks.swarm import LocalDHT, LocalSwarm
+
+
+INFO_HASH = b'h' * 20
+
+
+def test_routing_table_splits_around_own_id():
+    table = RoutingTable(b'\x00' * 20)
+    for i in range(1000):
+        table.add(os.urandom(20), ('10.0.0.1', i + 1))
+    # Far buckets stay at K nodes, the one holding our id gets split
+    assert len(table.buckets) > 1
+    assert all(len(bucket.nodes) <= K for bucket in table.buckets)
+    assert table.buckets[-1].low == 2 ** 159
+    target = os.urandom(20)
+    closest = table.closest(target)
+    key = int.from_bytes(target, 'big')
+    assert [node.key ^ key for node in closest] == \
+        sorted(node.key ^ key for node in table)[:K]
+    assert [node.id for node in decode_nodes(encode_nodes(closest))] == \
+        [node.id for node in closest]
+
+    node = closest[0]
+    table.failed(node.id)
+    table.failed(node.id)
+    assert table.get(node.id) is None
+
+
+def test_peers_are_found_on_a_local_network(run):
+    async def main():
+        network = await LocalDHT(16).start()
+        seeder = leecher = None
+        try:
+            assert all(len(node.table) >= 3 for node in network.nodes)
+            seeder = await network.node()
+            await seeder.announce(INFO_HASH, port=6881)
+
+            found = []
+            leecher = await network.node()
+            peers = await leecher.get_peers(INFO_HASH, on_peers=found.extend)
+            assert peers == found == [('127.0.0.1', 6881)]
+            assert await leecher.get_peers(b'x' * 20) == []
+
+            # Only a token we handed out lets a node store a peer
+            node = network.nodes[0]
+            with pytest.raises(DHTError):
+                await leecher.query(node.address, b'announce_peer', {
+                    b'info_hash': INFO_HASH, b'port': 1,
+                    b'token': b'forged'})
+            with pytest.raises(DHTError):
+                await leecher.query(node.address, b'vote')
+        finally:
+            for node in (seeder, leecher):
+                if node is not None:
+                    node.close()
+            network.close()
+
+    run(main())
+
+
+def test_malformed_announces_and_responses(run):
+    async def main():
+        network = await LocalDHT(8).start()
+        seeder = leecher = None
+        try:
+            seeder = await network.node()
+            await seeder.announce(INFO_HASH, port=6881)
+            # One node answers lookups with the wrong types
+            network.nodes[0].handlers[b'get_peers'] = \
+                lambda args, address: {b'values': [1, 2], b'nodes': 3}
+
+            leecher = await network.node()
+            assert await leecher.get_peers(INFO_HASH) == [('127.0.0.1', 6881)]
+
+            node = network.nodes[1]
+            response = await leecher.query(node.address, b'get_peers',
+                                           {b'info_hash': INFO_HASH})
+            for port in (0, 65536, b'6881'):
+                with pytest.raises(DHTError) as error:
+                    await leecher.query(node.address, b'announce_peer', {
+                        b'info_hash': INFO_HASH, b'port': port,
+                        b'token': response[b'token']})
+                assert error.value.args[0][0] == PROTOCOL_ERROR
+            assert list(node.storage[INFO_HASH]) == [('127.0.0.1', 6881)]
+        finally:
+            for node in (seeder, leecher):
+                if node is not None:
+                    node.close()
+            network.close()
+
+    run(main())
+
+
+def test_stored_peers_are_bounded(monkeypatch):
+    monkeypatch.setattr(dht, 'MAX_STORED_HASHES', 2)
+    monkeypatch.setattr(dht, 'MAX_STORED_PEERS', 2)
+    node = DHTNode(bootstrap=[])
+    for port in (1, 2, 3):
+        node.store(INFO_HASH, ('10.0.0.1', port))
+    assert list(node.storage[INFO_HASH]) == [('10.0.0.1', 2), ('10.0.0.1', 3)]
+    node.store(b'a' * 20, ('10.0.0.1', 1))
+    node.store(b'b' * 20, ('10.0.0.1', 1))
+    assert sorted(node.storage) == [b'a' * 20, b'b' * 20]
+
+    # Expired peers are not handed out
+    for peers in node.storage.values():
+        for peer in peers:
+            peers[peer] = 0
+    response = node.on_get_peers({b'info_hash': b'a' * 20},
+                                 ('10.0.0.2', 6881))
+    assert b'values' not in response
+
+
+def test_messages_with_invalid_ids_are_dropped(tmpdir, loop):
+    node = DHTNode(bootstrap=[])
+    sent = []
+    node.send = lambda message, address: sent.append(message)
+    address = ('10.0.0.2', 6881)
+    for node_id in (5, [b'x'], b'short'):
+        node.query_received({b'q': b'ping', b'a': {b'id': node_id}}, b'aa',
+                            address)
+        assert sent.pop()[b'e'][0] == PROTOCOL_ERROR
+
+        future = loop.create_future()
+        node.transactions[b'aa'] = (address, future)
+        node.response_received({b'y': b'r', b'r': {b'id': node_id}}, b'aa',
+                               address)
+        assert isinstance(future.exception(), DHTError)
+    assert len(node.table) == 0
+
+    # A saved state which isn't a dictionary is ignored
+    path = str(tmpdir.join('dht.dat'))
+    for state in ([b'nodes'], {b'id': 5, b'nodes': 7}):
+        with open(path, 'wb') as f:
+            f.write(bencodepy.encode(state))
+        node = DHTNode(state_path=path, bootstrap=[])
+        assert len(node.id) == 20 and node.saved_nodes == []
+
+
+def test_routing_table_is_restored(tmpdir, run):
+    path = str(tmpdir.join('dht.dat'))
+
+    async def main():
+        network = await LocalDHT(8).start()
+        try:
+            node = await network.node(state_path=path)
+            node_id, known = node.id, len(node.table)
+            node.close()
+            assert known >= 3
+
+            # No bootstrap nodes, the saved ones are enough
+            restored = await DHTNode(state_path=path, bootstrap=[]).start(
+                host='127.0.0.1')
+            try:
+                assert restored.id == node_id
+                assert len(restored.table) >= known
+            finally:
+                restored.close()
+        finally:
+            network.close()
+
+    run(main())
+
+
+def test_download_with_peers_from_the_dht(tmpdir, run):
+    async def main():
+        swarm = await LocalSwarm(str(tmpdir), size=2 * 2 ** 20,
+                                 seeders=2, dht=8).start()
+        try:
+            assert swarm.tracker.peers == []
+            savedir = str(tmpdir.mkdir('leech'))
+            await asyncio.wait_for(swarm.download(savedir, pex=False), 30)
+        finally:
+            await swarm.stop()
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            assert expected.read() == got.read()
+
+    run(main())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+from collections import deque
+
+from bt.message import (HandshakeMessage,
+                        HaveAllMessage,
+                        HaveNoneMessage,
+                        RejectRequestMessage,
+                        AllowedFastMessage,
+                        SuggestPieceMessage,
+                        RequestMessage,
+                        BitFieldMessage,
+                        PieceMessage,
+                        decode_message)
+from bt.server import RequestHandler
+
+
+def test_handshake_advertises_fast_extension():
+    data = HandshakeMessage(b'i' * 20, b'p' * 20).encode()
+    assert data[27] == 0x04
+    assert HandshakeMessage.decode(data).fast
+    plain = HandshakeMessage(b'i' * 20, b'p' * 20, reserved=bytes(8))
+    assert not HandshakeMessage.decode(plain.encode()).fast
+
+
+def test_fast_messages_roundtrip():
+    for message, fields in [(HaveAllMessage(), ()),
+                            (HaveNoneMessage(), ()),
+                            (SuggestPieceMessage(3), ('index',)),
+                            (AllowedFastMessage(4), ('index',)),
+                            (RejectRequestMessage(1, 2, 3),
+                             ('index', 'begin', 'length'))]:
+        decoded = decode_message(message.encode())
+        assert type(decoded) is type(message)
+        for field in fields:
+            assert getattr(decoded, field) == getattr(message, field)
+
+
+def request_handler(torrent_file):
+    created = torrent_file(5000, piece_length=1024)
+    return RequestHandler(created.torrent, path=created.path)
+
+
+def connection(fast):
+    # An unchoked server connection
+    return SimpleNamespace(fast=fast, choked=False, interested=False,
+                           uploaded=0, choker=None, requests=deque())
+
+
+def test_seeder_sends_have_all_to_fast_peers(torrent_file):
+    handler = request_handler(torrent_file)
+    fast = connection(fast=True)
+    plain = connection(fast=False)
+
+    # Our pieces follow the handshake reply
+    replies = handler.dispatch(HandshakeMessage(handler.info_hash, b'p' * 20,
+                                                reserved=bytes(8)), plain)
+    assert [type(m) for m in replies] == [HandshakeMessage, BitFieldMessage]
+    handler.dispatch(RequestMessage(2, 0, 1024), fast)
+    replies = handler.dispatch(HandshakeMessage(handler.info_hash,
+                                                b'p' * 20), fast)
+    assert isinstance(replies[1], HaveAllMessage)
+    assert [m.index for m in replies[2:]] == [2]
+
+
+def test_seeder_rejects_invalid_requests(torrent_file):
+    handler = request_handler(torrent_file)
+    fast = connection(fast=True)
+    plain = connection(fast=False)
+
+    # The last piece is only 904 bytes long
+    invalid = RequestMessage(4, 0, 1024)
+    assert isinstance(handler.dispatch(invalid, fast), RejectRequestMessage)
+    assert handler.dispatch(invalid, plain) is None
+    assert handler.dispatch(RequestMessage(4, 0, 904), fast) is None
+    request = fast.requests.popleft()
+    piece = handler.get_piece(request.begin, request.index, request.length)
+    assert isinstance(piece, PieceMessage) and len(piece.block) == 904
+
+
+def test_seeder_refuses_requests_of_choked_peers(torrent_file):
+    handler = request_handler(torrent_file)
+    fast = connection(fast=True)
+    fast.choked = True
+    assert isinstance(handler.dispatch(RequestMessage(0, 0, 1024), fast),
+                      RejectRequestMessage)
+    assert fast.uploaded == 0
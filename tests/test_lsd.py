@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+import pytest
+
+from bt import lsd
+from bt.lsd import (MAX_INFOHASHES, SEEN_LIFETIME, build_search,
+                    parse_search)
+from bt.peers import PeerQueue
+
+from benchmarks.swarm import LocalSwarm, free_udp_port, local_discovery
+
+
+INFO_HASH = b'h' * 20
+
+
+def test_search_roundtrip():
+    info_hashes = [bytes([i]) * 20 for i in range(3)]
+    data = build_search(('239.192.152.143', 6771), 6881, info_hashes, b'c1')
+    assert len(build_search(('239.192.152.143', 6771), 65535,
+                            [INFO_HASH] * MAX_INFOHASHES, b'c1')) < 1400
+    assert parse_search(data) == (6881, info_hashes, b'c1')
+    with pytest.raises(ValueError):
+        parse_search(b'GET / HTTP/1.1\r\n\r\n')
+    with pytest.raises(ValueError):
+        parse_search(b'BT-SEARCH * HTTP/1.1\r\nInfohash: ' +
+                     INFO_HASH.hex().encode() + b'\r\n\r\n')
+
+
+def test_announcing_peers_are_forgotten(monkeypatch):
+    monkeypatch.setattr(lsd, 'MAX_SEEN', 3)
+    torrent = lsd._Torrent(6881, on_peers=None)
+    assert not torrent.seen_before(('a', 1), now=0)
+    assert torrent.seen_before(('a', 1), now=1)
+    for host in 'bcd':
+        torrent.seen_before((host, 1), now=2)
+    assert list(torrent.seen) == [('b', 1), ('c', 1), ('d', 1)]
+    # Gone after a while without announces
+    assert not torrent.seen_before(('e', 1), now=2 + SEEN_LIFETIME + 1)
+    assert list(torrent.seen) == [('e', 1)]
+
+
+def test_peers_on_the_segment_find_each_other(run):
+    async def main():
+        port = free_udp_port()
+        first = await local_discovery(port)
+        second = await local_discovery(port)
+        found = {first: [], second: []}
+        try:
+            first.add(INFO_HASH, 1001, on_peers=found[first].extend)
+            await asyncio.sleep(0.05)
+            assert found[first] == []
+
+            # The first one answers the announce of the second one
+            second.add(INFO_HASH, 1002, on_peers=found[second].extend)
+            second.add(b'x' * 20, 1002, on_peers=found[second].extend)
+            await asyncio.sleep(0.05)
+            assert found[first] == [('127.0.0.1', 1002)]
+            assert found[second] == [('127.0.0.1', 1001)]
+
+            # Periodic announces are not answered again
+            second.announce()
+            await asyncio.sleep(0.05)
+            assert len(found[first]) == 2
+            assert len(found[second]) == 1
+        finally:
+            first.close()
+            second.close()
+
+    run(main())
+
+
+def test_local_peers_are_dialed_first(loop):
+    queue = PeerQueue()
+    queue.add([('10.0.0.1', 1), ('10.0.0.2', 2)])
+    queue.add([('10.0.0.2', 2), ('192.168.0.3', 3)], preferred=True)
+    assert queue.qsize() == 3
+    assert [queue.get_nowait() for _ in range(3)] == \
+        [('192.168.0.3', 3), ('10.0.0.2', 2), ('10.0.0.1', 1)]
+
+
+def test_download_from_lan_seeders(tmpdir, run):
+    async def main():
+        # The tracker's seeders are far away, the LAN ones are not
+        swarm = await LocalSwarm(str(tmpdir), size=2 * 2 ** 20, seeders=2,
+                                 latency=0.5, lan_seeders=2).start()
+        try:
+            savedir = str(tmpdir.mkdir('leech'))
+            result = await asyncio.wait_for(
+                swarm.download(savedir, pex=False), 30)
+        finally:
+            await swarm.stop()
+        assert result.lan_connections == 2
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            assert expected.read() == got.read()
+
+    run(main())
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+import pytest
+
+from bt.bitfield import Bitfield
+from bt.message import (MESSAGE_TYPES,
+                        HEADER,
+                        AllowedFastMessage,
+                        BitFieldMessage,
+                        CancelMessage,
+                        ChokeMessage,
+                        ExtendedMessage,
+                        HandshakeMessage,
+                        HaveAllMessage,
+                        HaveMessage,
+                        HaveNoneMessage,
+                        InterestedMessage,
+                        KeepAliveMessage,
+                        NotInterestedMessage,
+                        PieceMessage,
+                        PortMessage,
+                        RejectRequestMessage,
+                        RequestMessage,
+                        SuggestPieceMessage,
+                        UnchokeMessage,
+                        decode_message)
+
+
+bitfield = Bitfield(20)
+bitfield[3] = bitfield[19] = 1
+
+MESSAGES = [
+    ChokeMessage(),
+    UnchokeMessage(),
+    InterestedMessage(),
+    NotInterestedMessage(),
+    HaveMessage(2 ** 32 - 1),
+    BitFieldMessage(bitfield),
+    RequestMessage(7, 2 ** 14, 2 ** 14),
+    PieceMessage(7, 2 ** 14, b'block' * 100),
+    CancelMessage(7, 2 ** 14, 2 ** 14),
+    PortMessage(6881),
+    SuggestPieceMessage(5),
+    HaveAllMessage(),
+    HaveNoneMessage(),
+    RejectRequestMessage(7, 0, 2 ** 14),
+    AllowedFastMessage(9),
+    ExtendedMessage(1, {b'added': b'\x7f\x00\x00\x01\x1a\xe1'}),
+]
+
+
+def test_every_registered_message_is_covered():
+    assert {type(message) for message in MESSAGES} == \
+        set(MESSAGE_TYPES.values())
+
+
+@pytest.mark.parametrize('message', MESSAGES,
+                         ids=lambda message: type(message).__name__)
+def test_round_trip(message):
+    data = message.encode()
+    decoded = decode_message(data)
+    assert type(decoded) is type(message)
+    assert decoded.encode() == data
+    # Decoding doesn't depend on the data being bytes
+    assert decode_message(memoryview(bytearray(data))).encode() == data
+
+
+def test_keep_alive_and_handshake_round_trip():
+    assert isinstance(decode_message(KeepAliveMessage().encode()),
+                      KeepAliveMessage)
+    data = HandshakeMessage(b'i' * 20, b'p' * 20).encode()
+    handshake = HandshakeMessage.decode(data)
+    assert (handshake.info_hash, handshake.peer_id) == (b'i' * 20, b'p' * 20)
+    assert handshake.fast and handshake.extended
+    assert HandshakeMessage.decode(data[:-1]) is None
+
+
+@pytest.mark.parametrize('message', [
+    HaveMessage(1), RequestMessage(1, 0), CancelMessage(1, 0, 2 ** 14),
+    PortMessage(6881), SuggestPieceMessage(1), RejectRequestMessage(1, 0, 1),
+    AllowedFastMessage(1), PieceMessage(1, 0, b'')],
+    ids=lambda message: type(message).__name__)
+def test_truncated_fixed_size_messages(message):
+    with pytest.raises(struct.error):
+        decode_message(message.encode()[:-1])
+
+
+def test_malformed_messages():
+    # A block shorter than the length prefix
+    assert decode_message(PieceMessage(1, 0, b'block').encode()[:-1]) is None
+    # Unknown message id
+    assert decode_message(HEADER.pack(1, 99)) is None
+    # Extended messages without an extended id, with an invalid payload or
+    # one which isn't a dictionary
+    assert decode_message(HEADER.pack(1, ExtendedMessage.message_id)) is None
+    for payload in (b'd5:added', b'i1e'):
+        data = HEADER.pack(2 + len(payload), ExtendedMessage.message_id) + \
+            b'\x01' + payload
+        assert decode_message(data) is None
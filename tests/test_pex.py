@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bt.message import ExtendedMessage, HandshakeMessage, decode_message
+from bt.peers import (PeerQueue, decode_compact, decode_compact6,
+                      decode_peers, encode_compact, encode_compact6)
+from bt.pex import PeerExchange, extension_handshake, MIN_RECEIVE_INTERVAL
+from bt.protocol import PeerConnection, ProtocolError
+from bt.server import TorrentServer
+
+PEERS = [('127.0.0.1', 6881), ('10.0.0.2', 51413)]
+
+
+def test_compact_roundtrip():
+    data = encode_compact(PEERS)
+    assert len(data) == 12
+    assert decode_compact(data) == PEERS
+
+
+def test_compact6_and_dict_peers():
+    peers6 = [('2001:db8::1', 6881), ('::ffff:10.0.0.1', 1)]
+    data = encode_compact6(peers6)
+    assert len(data) == 36
+    assert decode_compact6(data + b'\x00') == peers6
+    assert decode_compact(encode_compact(PEERS) + b'\x00') == PEERS
+    assert decode_peers(encode_compact(PEERS)) == PEERS
+    assert decode_peers([{b'ip': b'10.0.0.3', b'port': 6881,
+                          b'peer id': b'p' * 20},
+                         {b'ip': b'2001:db8::2', b'port': 1},
+                         {b'ip': b'10.0.0.4', b'port': 0},
+                         {b'port': 6881}, b'junk']) == \
+        [('10.0.0.3', 6881), ('2001:db8::2', 1)]
+
+
+def test_extended_message_roundtrip():
+    assert HandshakeMessage(b'i' * 20, b'p' * 20).extended
+    message = decode_message(extension_handshake(port=6881).encode())
+    assert isinstance(message, ExtendedMessage)
+    assert message.extended_id == 0
+    assert message.payload[b'm'] == {b'ut_pex': 1}
+    assert message.payload[b'p'] == 6881
+
+
+def test_peer_queue_drops_known_peers(loop):
+    queue = PeerQueue()
+    assert queue.add(PEERS + PEERS) == 2
+    peer = queue.get_nowait()
+    queue.connection_made(peer)
+    assert queue.add(PEERS) == 0
+    queue.clear()
+    assert queue.empty()
+    # The connected peer stays known, the dropped one can come back
+    assert queue.add(PEERS) == 1
+    queue.connection_lost(peer)
+    assert queue.add(PEERS) == 1
+
+
+def test_pex_is_rate_limited(loop):
+    pex = PeerExchange(PeerQueue())
+    payload = {b'added': encode_compact(PEERS[:1])}
+    assert pex.received(payload, now=0) == 1
+    payload = {b'added': encode_compact(PEERS)}
+    assert pex.received(payload, now=1) == 0
+    assert pex.received(payload, now=MIN_RECEIVE_INTERVAL) == 1
+
+
+def test_pex_advertises_changes():
+    pex = PeerExchange()
+    assert pex.next_message(PEERS, now=0) is None
+
+    pex.handshake_received({b'm': {b'ut_pex': 3}})
+    message = pex.next_message(PEERS, now=0)
+    assert message.extended_id == 3
+    assert sorted(decode_compact(message.payload[b'added'])) == \
+        sorted(PEERS)
+    assert pex.next_message(PEERS[:1], now=1) is None
+
+    message = pex.next_message(PEERS[:1], now=60)
+    assert message.payload[b'added'] == b''
+    assert decode_compact(message.payload[b'dropped']) == PEERS[1:]
+
+
+def test_malformed_pex_payloads(loop):
+    pex = PeerExchange(PeerQueue())
+    pex.handshake_received({b'm': {b'ut_pex': 0}})
+    assert pex.remote_id is None
+    for remote_id in (b'a', 300, -1, [1]):
+        with pytest.raises(ValueError):
+            pex.handshake_received({b'm': {b'ut_pex': remote_id}})
+        assert pex.remote_id is None
+    for payload in ({b'added': 5}, {b'added6': [b'peer']}):
+        with pytest.raises(ValueError):
+            pex.received(payload)
+
+    # The connection drops the peer instead of failing later on
+    connection = SimpleNamespace(pex=pex)
+    with pytest.raises(ProtocolError):
+        PeerConnection.on_extended(connection, ExtendedMessage(
+            0, {b'm': {b'ut_pex': b'a'}}))
+
+
+def test_server_drops_peers_with_malformed_extensions(torrent_file, run,
+                                                      caplog):
+    torrent, path, _, _ = torrent_file(5000, piece_length=1024)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        server = await loop.create_server(TorrentServer(torrent, path=path),
+                                          '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(HandshakeMessage(torrent.hash, b'p' * 20).encode() +
+                         ExtendedMessage(0, {b'm': {b'ut_pex': 300}}).encode())
+            while await asyncio.wait_for(reader.read(65536), 1):
+                pass
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    run(main())
+    assert 'Dropping peer' in caplog.text
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import struct
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bt.client import DownloadManager
+from bt.message import (LENGTH,
+                        MAX_MESSAGE_LENGTH,
+                        max_message_length,
+                        HaveMessage,
+                        PieceMessage,
+                        InterestedMessage,
+                        KeepAliveMessage,
+                        HandshakeMessage,
+                        HaveAllMessage,
+                        UnchokeMessage,
+                        RequestMessage,
+                        HANDSHAKE,
+                        REQUEST_SIZE)
+from bt.peers import PeerQueue
+from bt.protocol import (MessageBuffer,
+                         PeerConnection,
+                         PeerStreamIterator,
+                         ProtocolError)
+from bt.server import TorrentServer
+from bt.transport import BufferedPeerConnection, PeerProtocol
+
+
+def stream():
+    return b''.join([PieceMessage(1, 0, b'x' * 100).encode(),
+                     b'\x00\x00\x00\x00',
+                     HaveMessage(7).encode(),
+                     InterestedMessage().encode()])
+
+
+def test_message_buffer_parses_all_complete_messages():
+    buffer = MessageBuffer(stream())
+    messages = buffer.parse()
+    assert [type(m) for m in messages] == [PieceMessage, KeepAliveMessage,
+                                           HaveMessage, InterestedMessage]
+    assert messages[0].block == b'x' * 100
+    assert messages[2].index == 7
+    assert len(buffer) == 0
+
+
+def test_message_buffer_waits_for_whole_message():
+    data = stream()
+    buffer = MessageBuffer()
+    parsed = []
+    for i in range(len(data)):
+        buffer.feed(data[i:i + 1])
+        parsed.extend(buffer.parse())
+    assert [type(m) for m in parsed] == [PieceMessage, KeepAliveMessage,
+                                         HaveMessage, InterestedMessage]
+
+
+def test_oversized_and_malformed_messages_drop_the_peer(loop):
+    # The longest block we serve, or the bitfield of a million pieces
+    assert max_message_length(8) == MAX_MESSAGE_LENGTH
+    assert max_message_length(8 * 2 ** 20) == 2 ** 20 + 1
+    for data in (LENGTH.pack(MAX_MESSAGE_LENGTH + 1),
+                 # A Have message without its index
+                 LENGTH.pack(2) + b'\x04\x00'):
+        buffer = MessageBuffer(HaveMessage(1).encode() + data)
+        with pytest.raises(ProtocolError):
+            buffer.parse()
+
+        class Transport:
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        connection = SimpleNamespace(
+            download_manager=SimpleNamespace(total_pieces=8),
+            message_received=lambda message: None)
+        protocol = PeerProtocol(connection)
+        protocol.connection_made(Transport())
+        protocol.expect_handshake = False
+        protocol.data_received(data)
+        assert protocol.transport.closed
+
+
+def test_stream_iterator_batches(run):
+    class Reader:
+        def __init__(self, chunks):
+            self.chunks = list(chunks)
+
+        async def read(self, n):
+            return self.chunks.pop(0) if self.chunks else b''
+
+    data = stream()
+    reader = Reader([data[:50], data[50:]])
+
+    async def collect():
+        return [batch async for batch in PeerStreamIterator(reader).batches()]
+
+    batches = run(collect())
+    assert [len(batch) for batch in batches] == [4]
+
+
+class Dialer:
+    """The dialing of `PeerConnection` with connections which take
+    `delays[peer]` seconds, None refuses them.
+    """
+    CONNECT_TIMEOUT = 1
+    DIAL_DELAY = 0.05
+    dial = PeerConnection.dial
+    requeue = PeerConnection.requeue
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.available_peers = PeerQueue()
+        self.available_peers.add(delays)
+        self.dialed = []
+        self.closed = []
+
+    async def open_connection(self, peer):
+        self.dialed.append(peer)
+        if self.delays[peer] is None:
+            raise ConnectionRefusedError()
+        await asyncio.sleep(self.delays[peer])
+        return 'connection to {}'.format(peer[0])
+
+    def close_connection(self, connection):
+        self.closed.append(connection)
+
+
+def test_dial_races_slow_peers(run):
+    slow, refused, v6, v4 = (('10.0.0.1', 1), ('10.0.0.2', 2),
+                             ('2001:db8::1', 3), ('10.0.0.4', 4))
+    dialer = Dialer({slow: 10, refused: None, v6: 0.07, v4: 0})
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        peer, connection = await dialer.dial()
+        return peer, connection, loop.time() - started
+
+    peer, connection, elapsed = run(main())
+    # The IPv6 peer was dialed before the IPv4 one queued ahead of it,
+    # the slow peer didn't hold up the connection
+    assert dialer.dialed[:2] == [slow, v6]
+    assert (peer, connection) in ((v6, 'connection to 2001:db8::1'),
+                                  (v4, 'connection to 10.0.0.4'))
+    assert elapsed < 0.5
+    # The slow attempt was cancelled and its peer queued again
+    queued = set()
+    while not dialer.available_peers.empty():
+        queued.add(dialer.available_peers.get_nowait())
+    assert slow in queued and refused not in queued and peer not in queued
+
+
+@pytest.mark.parametrize('leaving', ['close', 'reset', 'error'])
+@pytest.mark.parametrize('connection_class',
+                         [PeerConnection, BufferedPeerConnection])
+def test_dials_the_next_peer_when_one_goes_away(tmpdir, torrent_file, run,
+                                                connection_class, leaving):
+    torrent, path, _, payload = torrent_file(5 * REQUEST_SIZE,
+                                             piece_length=REQUEST_SIZE)
+    savedir = str(tmpdir.mkdir('leech')).encode()
+    manager = DownloadManager(torrent, savedir)
+
+    def update_peer(peer_id, index):
+        raise RuntimeError('Handler failed')
+
+    async def goes_away(reader, writer):
+        await reader.readexactly(HANDSHAKE.size)
+        if leaving == 'reset':
+            # Aborts the connection right after reading our handshake
+            writer.get_extra_info('socket').setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            writer.transport.abort()
+            return
+        writer.write(HandshakeMessage(torrent.hash, b'l' * 20).encode() +
+                     HaveAllMessage().encode() + UnchokeMessage().encode())
+        if leaving == 'error':
+            # A message our handler chokes on
+            manager.update_peer = update_peer
+            writer.write(HaveMessage(0).encode())
+        # Hangs up on the first request
+        buffer = MessageBuffer()
+        while not any(isinstance(message, RequestMessage)
+                      for message in buffer.parse()):
+            data = await reader.read(1024)
+            if not data:
+                break
+            buffer.feed(data)
+        writer.close()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        servers = [await asyncio.start_server(goes_away, '127.0.0.1', 0),
+                   await loop.create_server(TorrentServer(torrent, path=path),
+                                            '127.0.0.1', 0)]
+        peers = PeerQueue()
+        peers.add([('127.0.0.1', server.sockets[0].getsockname()[1])
+                   for server in servers])
+        connection = connection_class(torrent.hash, b'p' * 20, peers,
+                                      manager, manager.on_block_complete,
+                                      pex=False)
+        try:
+            while not manager.complete:
+                await asyncio.sleep(0.01)
+        finally:
+            connection.stop()
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+            manager.close()
+
+    run(asyncio.wait_for(main(), 10))
+    with open(os.path.join(savedir, torrent.name), 'rb') as f:
+        assert f.read() == payload
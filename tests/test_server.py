@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+import pytest
+
+from bt.client import DownloadManager
+from bt.message import (LENGTH,
+                        HandshakeMessage,
+                        HaveMessage,
+                        HaveNoneMessage,
+                        REQUEST_SIZE,
+                        InterestedMessage,
+                        RequestMessage,
+                        CancelMessage,
+                        HaveAllMessage,
+                        UnchokeMessage,
+                        PieceMessage,
+                        RejectRequestMessage)
+from bt.protocol import MessageBuffer
+from bt.server import SourceFileReader, TorrentServer
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_hash_checks_an_incomplete_file(torrent_file, use_mmap):
+    torrent, path, _, payload = torrent_file(5000, piece_length=1024)
+    # A corrupt first piece and a file cut in the third one
+    with open(path, 'wb') as f:
+        f.write(b'x' + payload[1:3000])
+    reader = SourceFileReader(torrent, path=path, use_mmap=use_mmap)
+    try:
+        assert not reader.has_all_pieces()
+        assert list(reader.get_have_pieces().indexes()) == [1]
+        assert reader.has_piece(1) and not reader.has_piece(2)
+    finally:
+        reader.close()
+
+
+def test_pipelined_and_fragmented_requests(torrent_file, run):
+    torrent, path, _, payload = torrent_file(5000, piece_length=1024)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        server = await loop.create_server(
+            TorrentServer(torrent, path=path, peer_id=b's' * 20),
+            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            data = HandshakeMessage(torrent.hash, b'p' * 20).encode() + \
+                InterestedMessage().encode()
+            # The handshake and the first message split over writes
+            for i in range(0, len(data), 7):
+                writer.write(data[i:i + 7])
+                await writer.drain()
+                await asyncio.sleep(0.001)
+
+            buffer = MessageBuffer()
+            handshakes = []
+            messages = []
+
+            async def receive(count):
+                while len(messages) < count:
+                    buffer.feed(await asyncio.wait_for(reader.read(65536), 1))
+                    if not handshakes:
+                        handshake = buffer.parse_handshake()
+                        if handshake is None:
+                            continue
+                        handshakes.append(handshake)
+                    messages.extend(buffer.parse())
+
+            await receive(2)
+            # The server answers with its own peer id
+            assert handshakes[0].peer_id == b's' * 20
+            assert [type(m) for m in messages] == [HaveAllMessage,
+                                                   UnchokeMessage]
+
+            # Four requests pipelined with a cancel of the third one
+            requests = [RequestMessage(i, 0, 1024) for i in range(4)]
+            data = b''.join(m.encode() for m in requests) + \
+                CancelMessage(2, 0, 1024).encode()
+            writer.write(data[:30])
+            await writer.drain()
+            await asyncio.sleep(0.01)
+            writer.write(data[30:])
+            await receive(6)
+
+            # The first write held a whole request, it was served already
+            replies = messages[2:]
+            assert [type(m) for m in replies] == [
+                PieceMessage, RejectRequestMessage, PieceMessage,
+                PieceMessage]
+            assert replies[1].index == 2
+            pieces = [m for m in replies if isinstance(m, PieceMessage)]
+            assert [m.index for m in pieces] == [0, 1, 3]
+            for piece in pieces:
+                start = piece.index * 1024
+                assert bytes(piece.block) == payload[start:start + 1024]
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    run(main())
+
+
+def test_serves_verified_pieces_while_downloading(tmpdir, torrent_file,
+                                                  run):
+    torrent, _, _, payload = torrent_file(80000,
+                                          piece_length=2 * REQUEST_SIZE)
+    piece = payload[2 * REQUEST_SIZE:4 * REQUEST_SIZE]
+    savedir = str(tmpdir.mkdir('download')).encode()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        manager = DownloadManager(torrent, savedir)
+        uploader = TorrentServer(torrent, download_manager=manager)
+        server = await loop.create_server(uploader, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        buffer = MessageBuffer()
+        messages = []
+
+        async def receive(count):
+            while len(messages) < count:
+                buffer.feed(await asyncio.wait_for(reader.read(65536), 1))
+                if not messages and buffer.parse_handshake() is None:
+                    continue
+                messages.extend(buffer.parse())
+
+        try:
+            writer.write(HandshakeMessage(torrent.hash, b'p' * 20).encode() +
+                         InterestedMessage().encode())
+            await receive(2)
+            assert [type(m) for m in messages] == [HaveNoneMessage,
+                                                   UnchokeMessage]
+
+            # Not verified yet
+            writer.write(RequestMessage(1, 0, REQUEST_SIZE).encode())
+            await receive(3)
+            assert isinstance(messages[2], RejectRequestMessage)
+
+            manager.missing[1] = 0
+            manager.ongoing_pieces.append(manager.pieces[1])
+            for begin in (0, REQUEST_SIZE):
+                manager.on_block_complete(b'x' * 20, 1, begin,
+                                          piece[begin:begin + REQUEST_SIZE])
+            await receive(4)
+            assert isinstance(messages[3], HaveMessage)
+            assert messages[3].index == 1
+
+            # Served from the cache the verified piece was added to
+            writer.write(RequestMessage(1, REQUEST_SIZE,
+                                        REQUEST_SIZE).encode())
+            await receive(5)
+            assert bytes(messages[4].block) == piece[REQUEST_SIZE:]
+            assert 1 in manager.cache and manager.cache.hits == 1
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            manager.close()
+
+    run(main())
+    assert os.path.getsize(os.path.join(savedir, torrent.name)) == 4 * REQUEST_SIZE
+
+
+def test_drops_peers_sending_oversized_messages(torrent_file, run):
+    torrent, path, _, _ = torrent_file(5000, piece_length=1024)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        server = await loop.create_server(TorrentServer(torrent, path=path),
+                                          '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(HandshakeMessage(torrent.hash, b'p' * 20).encode() +
+                         LENGTH.pack(2 ** 30) + b'\x07')
+            # The server hangs up instead of waiting for a gigabyte
+            while await asyncio.wait_for(reader.read(65536), 1):
+                pass
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    run(main())
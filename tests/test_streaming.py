@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+import pytest
+
+from bt.bitfield import Bitfield
+from bt.client import Block, DownloadManager
+from bt.streaming import RATE_TIMEOUT, PeerRates
+
+from benchmarks.swarm import LocalSwarm
+
+
+PIECE_LENGTH = 2 ** 16
+BLOCK = 2 ** 14
+
+
+def manager_of(tmpdir, torrent_file, pieces=8):
+    created = torrent_file(pieces * PIECE_LENGTH, piece_length=PIECE_LENGTH)
+    manager = DownloadManager(created.torrent,
+                              str(tmpdir.mkdir('leech')).encode('utf-8'))
+    return manager, created.payload
+
+
+def test_peer_rates():
+    rates = PeerRates()
+    assert rates.is_fast('new')
+    rates.update('fast', BLOCK, 0.01, now=0)
+    rates.update('slow', BLOCK, 1, now=0)
+    assert rates.is_fast('fast', now=1) and not rates.is_fast('slow', now=1)
+    # Old measurements are not trusted
+    rates.update('fast', BLOCK, 0.01, now=RATE_TIMEOUT)
+    assert rates.is_fast('slow', now=RATE_TIMEOUT)
+
+
+def test_deadline_pieces_go_to_fast_peers(tmpdir, torrent_file):
+    manager, _ = manager_of(tmpdir, torrent_file)
+    try:
+        for peer in ('fast', 'other', 'slow'):
+            manager.add_peer(peer, Bitfield.full(manager.total_pieces))
+        manager.rates.update('fast', BLOCK, 0.01)
+        manager.rates.update('other', BLOCK, 0.01)
+        manager.rates.update('slow', BLOCK, 1)
+        # Two pieces a second, all pieces ahead are due within the window
+        # of four seconds, the ones behind the position have no deadline
+        manager.stream(position=3 * PIECE_LENGTH + 100,
+                       rate=2 * PIECE_LENGTH)
+        now = manager.position_time
+        assert manager.deadline(2) is None
+        assert manager.deadline(3) == now
+        assert manager.deadline(5) == pytest.approx(now + 1, abs=1e-3)
+        assert manager.deadline_pieces() == [3, 4, 5, 6, 7]
+
+        block = manager.next_request('fast')
+        assert (block.piece, block.offset) == (3, 0)
+        # Slow peers get pieces outside the window, none are left ahead
+        block = manager.next_request('slow')
+        assert (block.piece, block.offset) == (0, 0)
+
+        # Blocks of a piece about to be late are requested once more
+        requested = [manager.next_request('fast') for _ in range(19)]
+        assert [(b.piece, b.offset) for b in requested[:3]] == \
+            [(3, BLOCK), (3, 2 * BLOCK), (3, 3 * BLOCK)]
+        assert all(block.status is Block.Pending for block in requested)
+        block = manager.next_request('other')
+        assert (block.piece, block.offset) == (3, 0)
+        assert manager.next_request('other').offset == BLOCK
+    finally:
+        manager.close()
+
+
+def test_deadline_window_slides_with_the_position(tmpdir, torrent_file):
+    manager, _ = manager_of(tmpdir, torrent_file, pieces=64)
+    try:
+        for peer in ('first', 'second'):
+            manager.add_peer(peer, Bitfield.full(manager.total_pieces))
+        manager.stream(rate=PIECE_LENGTH)
+        # Playback waits for the first piece long past its deadline
+        manager.position_time -= 100
+        assert manager.deadline_pieces() == [0, 1, 2, 3]
+
+        requested = [manager.next_request('first') for _ in range(16)]
+        assert {block.piece for block in requested} == {0, 1, 2, 3}
+        # Only the blocks of the piece playback waits for are duplicated
+        duplicated = [manager.next_request('second') for _ in range(5)]
+        assert duplicated[:4] == requested[:4]
+        assert duplicated[4].piece == 4
+        assert len(manager.duplicated) == 4
+
+        manager.set_position(10 * PIECE_LENGTH)
+        assert manager.deadline_pieces() == [10, 11, 12, 13]
+    finally:
+        manager.close()
+
+
+def test_first_copy_of_a_duplicated_block_cancels_the_other(
+        tmpdir, torrent_file, loop):
+    manager, payload = manager_of(tmpdir, torrent_file, pieces=1)
+    cancelled = []
+
+    class Connection:
+        def __init__(self, peer_id):
+            self.peer_id = peer_id
+
+        def cancel_request(self, piece_index, block_offset):
+            cancelled.append((self.peer_id, piece_index, block_offset))
+
+    try:
+        for peer in ('first', 'second'):
+            manager.add_peer(peer, Bitfield.full(manager.total_pieces))
+            manager.peer_connections[peer] = Connection(peer)
+        manager.stream(rate=PIECE_LENGTH)
+        blocks = [manager.next_request('first') for _ in range(4)]
+        # The piece is due, its blocks are asked from the second peer too
+        assert manager.next_request('second') is blocks[0]
+        assert manager.next_request('second') is blocks[1]
+        assert len(manager.pending_blocks) == 6
+
+        manager.on_block_complete('second', 0, 0, payload[:BLOCK])
+        assert cancelled == [('first', 0, 0)]
+        manager.on_block_complete('first', 0, BLOCK, payload[BLOCK:2 * BLOCK])
+        assert cancelled[1:] == [('second', 0, BLOCK)]
+        assert len(manager.pending_blocks) == 2
+        assert not manager.duplicated
+
+        # A rejected copy leaves the block pending on the other peer
+        block = manager.next_request('second')
+        manager.block_rejected('second', block.piece, block.offset)
+        assert block.status is Block.Pending
+        manager.block_rejected('first', block.piece, block.offset)
+        assert block.status is Block.Missing
+
+        # Copies still outstanding are forgotten with the completed piece
+        assert manager.next_request('second') is block
+        assert manager.next_request('first') is block
+        manager.on_block_complete('second', 0, 3 * BLOCK,
+                                  payload[3 * BLOCK:])
+        assert manager.duplicated == {(0, 2 * BLOCK): 'first'}
+        manager.on_block_complete('first', 0, 2 * BLOCK,
+                                  payload[2 * BLOCK:3 * BLOCK])
+        assert manager.have[0] and not manager.duplicated
+        assert cancelled[2:] == [('second', 0, 2 * BLOCK)]
+    finally:
+        manager.close()
+
+
+def test_stream_reads_verified_bytes_in_order(tmpdir, torrent_file, run):
+    manager, payload = manager_of(tmpdir, torrent_file, pieces=4)
+
+    def deliver(index):
+        for offset in range(0, PIECE_LENGTH, BLOCK):
+            start = index * PIECE_LENGTH + offset
+            manager.on_block_complete('peer', index, offset,
+                                      payload[start:start + BLOCK])
+
+    async def main():
+        manager.add_peer('peer', Bitfield.full(manager.total_pieces))
+        for index in range(manager.total_pieces):
+            manager.missing[index] = 0
+            manager.ongoing_pieces.append(manager.pieces[index])
+        stream = manager.stream(position=PIECE_LENGTH + 10)
+        reading = asyncio.ensure_future(stream.read(100))
+        deliver(2)
+        await asyncio.sleep(0)
+        assert not reading.done()
+        assert stream.time_to_first_byte is None
+
+        deliver(1)
+        data = await reading
+        assert data == payload[PIECE_LENGTH + 10:PIECE_LENGTH + 110]
+        assert stream.time_to_first_byte is not None
+        assert manager.position == PIECE_LENGTH + 110
+
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) == 2:
+                # Back to the start, the position follows
+                stream.seek(0)
+                asyncio.get_event_loop().call_soon(deliver, 0)
+                asyncio.get_event_loop().call_soon(deliver, 3)
+        assert chunks == [payload[PIECE_LENGTH + 110:2 * PIECE_LENGTH],
+                          payload[2 * PIECE_LENGTH:3 * PIECE_LENGTH],
+                          payload[:PIECE_LENGTH],
+                          payload[PIECE_LENGTH:2 * PIECE_LENGTH],
+                          payload[2 * PIECE_LENGTH:3 * PIECE_LENGTH],
+                          payload[3 * PIECE_LENGTH:]]
+
+        waiting = manager.reader(0)
+        waiting.seek(len(payload))
+        assert await waiting.read() == b''
+        waiting.seek(0)
+        manager.have[0] = 0
+        reading = asyncio.ensure_future(waiting.read())
+        await asyncio.sleep(0)
+        manager.close()
+        with pytest.raises(EOFError):
+            await reading
+
+    run(main())
+
+
+def test_streaming_download_from_the_middle(tmpdir, run):
+    async def main():
+        swarm = await LocalSwarm(str(tmpdir), size=4 * 2 ** 20,
+                                 seeders=2, latency=0.01).start()
+        try:
+            savedir = str(tmpdir.mkdir('leech'))
+            result = await asyncio.wait_for(swarm.download(
+                savedir, pex=False, stream='deadlines',
+                stream_position=3 * 2 ** 20), 30)
+        finally:
+            await swarm.stop()
+        # Playback didn't wait for the pieces before the position
+        assert result.time_to_first_byte < result.seconds / 2
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            assert expected.read() == got.read()
+
+    run(main())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from benchmarks.swarm import LocalSwarm, MB
+
+
+@pytest.mark.parametrize('transport', ['stream', 'buffered', 'utp'])
+def test_local_swarm_download(tmpdir, run, transport):
+    swarm = LocalSwarm(str(tmpdir), size=MB + 1000, piece_length=2 ** 16,
+                       seeders=2, utp=transport == 'utp')
+    try:
+        run(swarm.start())
+        savedir = str(tmpdir.mkdir('leech'))
+        result = run(swarm.download(savedir, transport=transport))
+    finally:
+        run(swarm.stop())
+
+    with open(swarm.payload, 'rb') as f:
+        expected = f.read()
+    with open(os.path.join(savedir, 'payload.bin'), 'rb') as f:
+        assert f.read() == expected
+    assert result.announces == 1
+    assert result.time_to_first_piece is not None
+
+
+def test_pex_finds_peers_missing_from_announce(tmpdir, run):
+    swarm = LocalSwarm(str(tmpdir), size=MB, piece_length=2 ** 16,
+                       seeders=3, tracker_peers=1)
+    try:
+        run(swarm.start())
+        savedir = str(tmpdir.mkdir('leech'))
+        result = run(swarm.download(savedir))
+    finally:
+        run(swarm.stop())
+
+    assert result.time_to_all_peers is not None
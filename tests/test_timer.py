@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+from types import SimpleNamespace
+
+from bt import timer
+from bt.message import HandshakeMessage, HaveAllMessage
+from bt.peers import PeerQueue
+from bt.protocol import PeerConnection, PeerState
+from bt.server import TorrentServer
+from bt.timer import TimerWheel
+
+
+def test_wheel_fires_in_order_across_rounds(run):
+    async def main():
+        loop = asyncio.get_event_loop()
+        wheel = TimerWheel(tick=0.01, slots=8, loop=loop)
+        fired = []
+        for delay in (0.25, 0.05, 0.12):
+            wheel.schedule(delay, fired.append, delay)
+        cancelled = wheel.schedule(0.03, fired.append, 'cancelled')
+        cancelled.cancel()
+        assert not cancelled.active
+        assert len(wheel) == 3
+        await asyncio.sleep(0.4)
+        assert fired == [0.05, 0.12, 0.25]
+        # Nothing left, the wheel stopped ticking
+        assert len(wheel) == 0
+        assert wheel.handle is None
+
+    run(main())
+
+
+def test_wheel_never_fires_early(run):
+    async def main():
+        loop = asyncio.get_event_loop()
+        wheel = TimerWheel(tick=0.02, slots=4, loop=loop)
+        started = loop.time()
+        done = loop.create_future()
+        wheel.schedule(0.1, lambda: done.set_result(loop.time() - started))
+        # Event loops round timers to the millisecond
+        assert 0.099 <= await done < 0.2
+
+    run(main())
+
+
+def test_server_timeouts(torrent_file, monkeypatch, run):
+    torrent, path, _, _ = torrent_file(5000, piece_length=1024)
+    monkeypatch.setattr(TorrentServer, 'HANDSHAKE_TIMEOUT', 0.1)
+    monkeypatch.setattr(TorrentServer, 'KEEPALIVE_INTERVAL', 0.1)
+    monkeypatch.setattr(TorrentServer, 'IDLE_TIMEOUT', 0.3)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        timer._wheels[loop] = TimerWheel(tick=0.01, loop=loop)
+        server = await loop.create_server(
+            TorrentServer(torrent, path=path), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            # No handshake, dropped by the handshake timeout
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            started = loop.time()
+            assert await asyncio.wait_for(reader.read(), 1) == b''
+            assert loop.time() - started < 0.3
+            writer.close()
+
+            # Handshaken but silent, kept alive and finally dropped
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(HandshakeMessage(torrent.hash, b'p' * 20).encode())
+            data = await asyncio.wait_for(reader.read(), 1)
+            # After the handshake and the pieces we have
+            keepalives = data[68 + len(HaveAllMessage().encode()):]
+            assert keepalives and keepalives == bytes(len(keepalives))
+            assert len(keepalives) % 4 == 0
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    run(main())
+
+
+class DownloadManager:
+    total_pieces = 4
+
+    def __init__(self):
+        self.rejected = []
+
+    def block_rejected(self, peer_id, piece_index, block_offset):
+        self.rejected.append((piece_index, block_offset))
+
+
+def test_snubbing_peer_releases_its_request(run):
+    async def main():
+        manager = DownloadManager()
+        connection = PeerConnection(b'i' * 20, b'p' * 20, PeerQueue(),
+                                    manager, None)
+        connection.timers = {}
+        connection.current_state.append(PeerState.PendingRequest.value)
+        connection.pending_block = SimpleNamespace(piece=1, offset=16384)
+
+        connection.requested_at = time.monotonic()
+        connection.on_snub_timeout()
+        assert not connection.snubbed
+        assert manager.rejected == []
+
+        connection.requested_at -= PeerConnection.SNUB_TIMEOUT
+        connection.on_snub_timeout()
+        assert connection.snubbed
+        assert manager.rejected == [(1, 16384)]
+        assert PeerState.PendingRequest.value not in connection.current_state
+        connection.stop_timers()
+        connection.stop()
+
+    run(main())
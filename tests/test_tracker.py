@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import asyncio
+
+import pytest
+import bencodepy
+
+from bt import tracker
+from bt.client import Client
+from bt.peers import encode_compact, encode_compact6
+from bt.tracker import (EVENTS,
+                        HTTP_CONNECTIONS_PER_HOST,
+                        MAX_HTTP_SCRAPE_HASHES,
+                        HTTPTracker,
+                        MultiTracker,
+                        TrackerError,
+                        UDPTracker,
+                        UDPTrackerEndpoint,
+                        close_http_session,
+                        get_http_session,
+                        get_tracker)
+
+from benchmarks.swarm import MockTracker, MockUDPTracker
+
+
+PEERS = [('10.0.0.1', 6881), ('10.0.0.2', 6882)]
+
+
+def udp_tracker(mock, info_hash=b'i' * 20):
+    return get_tracker(mock.url.encode(), size=1000, info_hash=info_hash,
+                       port=6999)
+
+
+def test_udp_announce_and_scrape(run):
+    async def main():
+        mock = await MockUDPTracker(PEERS, interval=900).start()
+        try:
+            client = udp_tracker(mock)
+            assert isinstance(client, UDPTracker)
+            response = await client.announce()
+            assert response.peers == PEERS
+            assert (response.interval, response.complete) == (900, 2)
+            announce = mock.announces[0]
+            assert announce[b'event'] == EVENTS['started']
+            assert (announce[b'port'], announce[b'left']) == (6999, 1000)
+
+            await client.connect(first=False, uploaded=10, downloaded=1000)
+            assert mock.announces[1][b'event'] == EVENTS['']
+            assert mock.announces[1][b'left'] == 0
+            await client.bye(uploaded=10, downloaded=1000)
+            assert mock.announces[2][b'event'] == EVENTS['stopped']
+
+            stats = await client.scrape([b'i' * 20, b'j' * 20])
+            assert stats[b'j' * 20].complete == 2
+            # The connection id was cached for all of them
+            assert mock.connects == 1
+        finally:
+            mock.close()
+
+    run(main())
+
+
+def test_udp_transactions_share_socket_and_connect(run):
+    async def main():
+        mock = await MockUDPTracker(PEERS).start()
+        try:
+            clients = [udp_tracker(mock, bytes([i]) * 20) for i in range(20)]
+            responses = await asyncio.gather(*(client.announce()
+                                               for client in clients))
+            assert all(response.peers == PEERS for response in responses)
+            assert {a[b'info_hash'] for a in mock.announces} == \
+                {client.info_hash for client in clients}
+            assert mock.connects == 1
+            endpoint = await tracker.get_udp_endpoint()
+            assert endpoint.transactions == {}
+        finally:
+            mock.close()
+
+    run(main())
+
+
+def test_udp_retransmits_and_reconnects(monkeypatch, run):
+    monkeypatch.setattr(UDPTracker, 'TIMEOUT', 0.05)
+
+    async def main():
+        # The first connect and its retransmission are lost
+        mock = await MockUDPTracker(PEERS, drop=2).start()
+        loop = asyncio.get_event_loop()
+        try:
+            client = udp_tracker(mock)
+            started = loop.time()
+            await client.announce()
+            # Waited 0.05 + 0.1 seconds before the third attempt
+            assert loop.time() - started >= 0.15
+            assert mock.connects == 1
+
+            monkeypatch.setattr(UDPTrackerEndpoint,
+                                'CONNECTION_ID_LIFETIME', 0)
+            await client.announce()
+            assert mock.connects == 2
+        finally:
+            mock.close()
+
+    run(main())
+
+
+def test_udp_tracker_errors(monkeypatch, run):
+    monkeypatch.setattr(UDPTracker, 'TIMEOUT', 0.01)
+    monkeypatch.setattr(UDPTracker, 'MAX_RETRIES', 1)
+
+    async def main():
+        mock = await MockUDPTracker(PEERS, drop=2).start()
+        try:
+            with pytest.raises(TrackerError):
+                await udp_tracker(mock).announce()
+
+            # A connection id the tracker doesn't know is dropped
+            client = udp_tracker(mock)
+            endpoint = await tracker.get_udp_endpoint()
+            endpoint.connection_ids[await client.resolve()] = (1, 1e12)
+            with pytest.raises(TrackerError):
+                await client.announce()
+            assert (await client.announce()).peers == PEERS
+        finally:
+            mock.close()
+
+    run(main())
+
+
+def test_multi_tracker_tiers(monkeypatch, run):
+    monkeypatch.setattr(UDPTracker, 'TIMEOUT', 10)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        silent = await MockUDPTracker(PEERS, drop=1000).start()
+        first = await MockUDPTracker(PEERS).start()
+        second = await MockUDPTracker([PEERS[1], ('10.0.0.3', 6883)]).start()
+        # Nothing listens on port 1
+        refused = 'http://127.0.0.1:1/announce'
+        received = []
+        multi = MultiTracker(
+            [[refused.encode()],
+             [url.encode() for url in (silent.url, first.url, second.url)]],
+            size=1000, info_hash=b'i' * 20, on_peers=received.extend)
+        multi.port = 6999
+        try:
+            # The dead first tier is skipped, the silent tracker doesn't
+            # hold up the second one
+            started = loop.time()
+            response = await multi.announce()
+            assert loop.time() - started < 1
+            assert response.peers in (first.peers, second.peers)
+            await asyncio.wait(multi.pending, timeout=0.5)
+            assert sorted(received) == sorted(set(PEERS) | {('10.0.0.3',
+                                                              6883)})
+            assert all(a[b'port'] == 6999 and a[b'peer_id'] == multi.peer_id
+                       for a in first.announces + second.announces)
+
+            # Trackers which answered were promoted
+            tier = multi.tiers[1]
+            assert {tracker.url for tracker in tier[:2]} == {first.url,
+                                                              second.url}
+            assert len(multi.pending) == 1
+
+            # The failed tracker backs off
+            dead = multi.tiers[0][0]
+            failures, retry_at = multi.failures[dead]
+            assert failures == 1 and retry_at > time.monotonic() + 10
+            await multi.connect(first=False, uploaded=0, downloaded=0)
+            assert multi.failures[dead][0] == 1
+            assert len(first.announces) == 2
+            assert first.announces[1][b'event'] == EVENTS['']
+        finally:
+            pending = list(multi.pending)
+            multi.close()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for mock in (silent, first, second):
+                mock.close()
+
+    run(main())
+
+
+def test_multi_tracker_fails_without_any_response(monkeypatch, run):
+    monkeypatch.setattr(UDPTracker, 'TIMEOUT', 0.01)
+    monkeypatch.setattr(UDPTracker, 'MAX_RETRIES', 0)
+
+    async def main():
+        silent = await MockUDPTracker(PEERS, drop=1000).start()
+        multi = MultiTracker([[silent.url.encode()], [b'wss://unsupported']],
+                             size=1000, info_hash=b'i' * 20)
+        try:
+            assert len(multi.trackers) == 1
+            with pytest.raises(TrackerError):
+                await multi.announce()
+            # Backing off, no tracker is left to ask
+            with pytest.raises(TrackerError):
+                await multi.announce()
+            assert multi.failures[multi.trackers[0]][0] == 1
+        finally:
+            multi.close()
+            silent.close()
+
+    run(main())
+
+
+def test_multi_tracker_skips_garbage_responses(run):
+    async def main():
+        garbage = await MockTracker(PEERS).start()
+        garbage.response = lambda params: b'<html>not bencoded</html>'
+        good = await MockTracker(PEERS).start()
+        multi = MultiTracker([[garbage.url.encode()], [good.url.encode()]],
+                             size=1000, info_hash=b'i' * 20)
+        try:
+            response = await multi.announce()
+            assert response.peers == PEERS
+            assert multi.failures[multi.tiers[0][0]][0] == 1
+        finally:
+            multi.close()
+            garbage.close()
+            good.close()
+
+    run(main())
+
+
+def test_seeder_announces_its_listening_port(torrent_file, monkeypatch,
+                                             run):
+    async def main():
+        mock = await MockTracker(PEERS).start()
+        created = torrent_file(5000, piece_length=1024, announce=mock.url)
+        # The payload is looked up in the working directory
+        monkeypatch.chdir(os.path.dirname(created.path))
+        client = Client()
+        client.parse(created.torrent_path)
+        try:
+            await client.upload(port=6999)
+        finally:
+            mock.close()
+        assert [announce[b'port'] for announce in mock.announces] == \
+            [b'6999']
+        assert mock.announces[0][b'peer_id'] == client.peer_id
+
+    run(main())
+
+
+def test_http_trackers_share_kept_alive_connections(run):
+    async def main():
+        mock = await MockTracker(PEERS).start()
+        try:
+            clients = [get_tracker(mock.url.encode(), size=1000,
+                                   info_hash=bytes([i]) * 20, port=6999)
+                       for i in range(40)]
+            assert isinstance(clients[0], HTTPTracker)
+            responses = await asyncio.gather(*(client.announce()
+                                               for client in clients))
+            assert all(response.peers == PEERS for response in responses)
+            assert len(mock.announces) == 40
+            assert mock.connections <= HTTP_CONNECTIONS_PER_HOST
+
+            # The stopped event goes out without blocking the loop
+            bye = clients[0].bye(uploaded=10, downloaded=1000)
+            assert isinstance(bye, asyncio.Future)
+            await bye
+            assert mock.announces[-1][b'event'] == b'stopped'
+            assert mock.announces[-1][b'left'] == b'0'
+            assert mock.connections <= HTTP_CONNECTIONS_PER_HOST
+            assert get_http_session() is get_http_session()
+        finally:
+            await close_http_session()
+            mock.close()
+
+    run(main())
+
+
+def test_http_scrape_batches_info_hashes(run):
+    async def main():
+        mock = await MockTracker(PEERS).start()
+        try:
+            client = get_tracker(mock.url.encode(), size=1000,
+                                 info_hash=b'i' * 20)
+            assert client.scrape_url.endswith('/scrape')
+            info_hashes = [i.to_bytes(20, 'big')
+                           for i in range(MAX_HTTP_SCRAPE_HASHES + 1)]
+            stats = await client.scrape(info_hashes)
+            assert set(stats) == set(info_hashes)
+            assert stats[info_hashes[-1]].complete == 2
+            assert [len(hashes) for hashes in mock.scrapes] == \
+                [MAX_HTTP_SCRAPE_HASHES, 1]
+            assert mock.connections == 1
+
+            other = get_tracker(b'http://127.0.0.1/tracker', size=1000,
+                                info_hash=b'i' * 20)
+            with pytest.raises(TrackerError):
+                await other.scrape()
+        finally:
+            await close_http_session()
+            mock.close()
+
+    run(main())
+
+
+def test_http_scrape_rejects_invalid_responses(run):
+    async def main():
+        mock = await MockTracker(PEERS).start()
+        try:
+            client = get_tracker(mock.url.encode(), size=1000,
+                                 info_hash=b'i' * 20)
+            for body in (b'<html>', b'li1ee', b'd5:filesi1ee'):
+                mock.scrape_response = lambda info_hashes: body
+                with pytest.raises(TrackerError):
+                    await client.scrape()
+            mock.scrape_response = lambda info_hashes: bencodepy.encode(
+                {b'files': {b'i' * 20: 1}})
+            assert await client.scrape() == {}
+        finally:
+            await close_http_session()
+            mock.close()
+
+    run(main())
+
+
+def test_http_response_peer_formats():
+    client = get_tracker(b'http://127.0.0.1/announce', size=1000,
+                         info_hash=b'i' * 20)
+    peers6 = [('2001:db8::1', 6881)]
+    response = client.parse_tracker_response(bencodepy.encode({
+        b'interval': 60, b'peers': encode_compact(PEERS),
+        b'peers6': encode_compact6(peers6)}))
+    assert response.peers == PEERS + peers6
+    response = client.parse_tracker_response(bencodepy.encode({
+        b'interval': 60, b'peers': [
+            {b'ip': host.encode(), b'port': port, b'peer id': b'p' * 20}
+            for host, port in PEERS + peers6]}))
+    assert response.peers == PEERS + peers6
+    with pytest.raises(TrackerError):
+        client.parse_tracker_response(bencodepy.encode({
+            b'failure reason': b'unregistered torrent'}))
+    # Without a usable interval the client keeps its own
+    for interval in ({}, {b'interval': b'60'}, {b'interval': 0}):
+        response = client.parse_tracker_response(bencodepy.encode(
+            {**interval, b'peers': b''}))
+        assert response.interval is None
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+from bt import utp
+from bt.utp import Ledbat, TARGET_DELAY, MIN_WINDOW
+
+from benchmarks.swarm import DatagramShapingProxy
+
+
+class Sink(asyncio.Protocol):
+    def __init__(self):
+        self.data = bytearray()
+        self.transport = None
+        self.closed = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data += data
+
+    def connection_lost(self, exc):
+        self.closed.set_result(exc)
+
+
+async def transfer(payload, **shaping):
+    sinks = []
+
+    def accept():
+        sinks.append(Sink())
+        return sinks[-1]
+
+    server = await utp.create_server(accept, '127.0.0.1', 0)
+    proxy = await DatagramShapingProxy(server.address, **shaping).start()
+    try:
+        transport, client = await utp.create_connection(
+            Sink, *proxy.address)
+        transport.write(payload)
+        transport.close()
+        exc = await asyncio.wait_for(sinks[0].closed, 10)
+        assert exc is None
+        assert await asyncio.wait_for(client.closed, 10) is None
+        return sinks[0].data, transport, proxy
+    finally:
+        await proxy.close()
+        server.close()
+
+
+def test_transfer_recovers_lost_packets(run):
+    payload = os.urandom(256 * 1024)
+    data, _, proxy = run(transfer(payload, latency=0.005, loss=0.05))
+    assert proxy.dropped > 0
+    assert bytes(data) == payload
+
+
+def test_ledbat_keeps_bottleneck_queue_short(run):
+    # 1 MB through a 2 MB/s link which buffers up to a second of data
+    payload = os.urandom(1024 * 1024)
+    data, transport, proxy = run(transfer(
+        payload, latency=0.005, bandwidth=2 * 1024 * 1024, queue=1.0))
+    assert bytes(data) == payload
+    assert proxy.dropped == 0
+    assert proxy.max_queue < 3 * TARGET_DELAY / 1000000
+
+
+def test_connect_to_closed_port_fails(run):
+    async def connect():
+        server = await utp.create_server(Sink, '127.0.0.1', 0)
+        address = server.address
+        server.close()
+        try:
+            await asyncio.wait_for(
+                utp.create_connection(Sink, *address), 5)
+        except ConnectionError:
+            return True
+        return False
+    assert run(connect())
+
+
+def test_ledbat_window():
+    ledbat = Ledbat()
+    ledbat.on_ack(1000, MIN_WINDOW, now=0)
+    assert ledbat.slow_start
+    window = ledbat.window
+
+    # Queuing delay above the target ends slow start and shrinks the window
+    ledbat.on_ack(1000 + 2 * TARGET_DELAY, MIN_WINDOW, now=1)
+    assert not ledbat.slow_start
+    assert ledbat.window < window
+
+    # Below the target it grows again
+    window = ledbat.window
+    ledbat.on_ack(1000 + TARGET_DELAY // 2, MIN_WINDOW, now=2)
+    assert ledbat.window > window
+
+    ledbat.on_timeout()
+    assert ledbat.window == MIN_WINDOW
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+from bt.client import Block, DownloadManager
+from bt.torrent_parser import Torrent
+
+from benchmarks.swarm import LocalSwarm
+
+
+PIECE_LENGTH = 2 ** 16
+
+
+def test_url_list_forms():
+    info = {b'name': b'a file.bin', b'length': 1, b'piece length': 1,
+            b'pieces': b'p' * 20}
+    torrent = Torrent(b'http://tracker', [], '', '', None,
+                      [b'http://a/files/', b'https://b/a%20file.bin',
+                       b'ftp://c/a file.bin'], info)
+    assert torrent.web_seeds == ['http://a/files/a%20file.bin',
+                                 'https://b/a%20file.bin']
+    torrent.url_list = b'http://a/file'
+    assert torrent.web_seeds == ['http://a/file']
+    torrent.url_list = None
+    assert torrent.web_seeds == []
+
+
+def test_ranges_are_runs_of_missing_pieces(tmpdir, torrent_file):
+    torrent = torrent_file(5 * PIECE_LENGTH + 100,
+                           piece_length=PIECE_LENGTH).torrent
+    manager = DownloadManager(torrent,
+                              str(tmpdir.mkdir('leech')).encode('utf-8'))
+    try:
+        manager.add_peer('web', manager.missing)
+        blocks = manager.next_range('web', 2 * PIECE_LENGTH)
+        assert {block.piece for block in blocks} == {0, 1}
+        assert all(block.status is Block.Pending for block in blocks)
+        # A run ends before pieces somebody else started
+        manager.missing[3] = 0
+        assert {block.piece for block in
+                manager.next_range('web', 10 * PIECE_LENGTH)} == {2}
+        assert {block.piece for block in
+                manager.next_range('web', 10 * PIECE_LENGTH)} == {4, 5}
+
+        # Then the blocks nobody requested of the started pieces
+        manager.block_rejected('web', 1, 0)
+        manager.block_rejected('web', 1, 2 * 16384)
+        blocks = manager.next_range('web', PIECE_LENGTH)
+        assert [(block.piece, block.offset) for block in blocks] == [(1, 0)]
+        assert manager.next_range('web', PIECE_LENGTH)[0].offset == 2 * 16384
+        assert manager.next_range('web', PIECE_LENGTH) == []
+    finally:
+        manager.close()
+
+
+def test_download_from_web_seeds(tmpdir, run):
+    async def main():
+        swarm = await LocalSwarm(str(tmpdir), size=2 * 2 ** 20,
+                                 piece_length=PIECE_LENGTH, seeders=0,
+                                 web_seeds=2).start()
+        try:
+            savedir = str(tmpdir.mkdir('leech'))
+            result = await asyncio.wait_for(swarm.download(savedir), 30)
+        finally:
+            await swarm.stop()
+        assert result.web_seed_bytes == swarm.size
+        ranges = sorted(r for web_seed in swarm.web_seeds
+                        for r in web_seed.ranges)
+        # Every byte is asked for once, in ranges of whole pieces
+        assert ranges[0][0] == 0 and ranges[-1][1] == swarm.size
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+        assert all(start % PIECE_LENGTH == 0 for start, _ in ranges)
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            assert expected.read() == got.read()
+
+    run(main())
+
+
+def test_peers_take_over_from_a_failing_web_seed(tmpdir, run):
+    async def main():
+        swarm = await LocalSwarm(str(tmpdir), size=2 * 2 ** 20,
+                                 seeders=1, web_seeds=1).start()
+        # The server ignores the Range header
+        swarm.web_seeds[0].partial = False
+        try:
+            savedir = str(tmpdir.mkdir('leech'))
+            result = await asyncio.wait_for(swarm.download(savedir), 30)
+        finally:
+            await swarm.stop()
+        assert result.web_seed_bytes == 0
+        with open(swarm.payload, 'rb') as expected, \
+                open(os.path.join(savedir, 'payload.bin'), 'rb') as got:
+            assert expected.read() == got.read()
+
+    run(main())
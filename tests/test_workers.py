@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from bt.workers import WorkerPool
+
+from benchmarks.seeding import BLOCK_SIZE, Leecher
+
+
+def test_workers_share_the_port(torrent_file, run):
+    torrent, path, torrent_path, _ = torrent_file(
+        8 * BLOCK_SIZE, piece_length=2 * BLOCK_SIZE)
+    pool = WorkerPool(torrent_path, 2, host='127.0.0.1', path=path,
+                      sendfile=False).start()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        leechers = []
+        for _ in range(4):
+            _, leecher = await loop.create_connection(
+                lambda: Leecher(torrent, 8, 4), '127.0.0.1', pool.port)
+            leechers.append(leecher)
+        await asyncio.wait_for(
+            asyncio.gather(*(leecher.done for leecher in leechers)), 10)
+
+    try:
+        run(main())
+    finally:
+        pool.stop()
+
+    stats = pool.stats()
+    assert stats['bytes'] >= 4 * 8 * BLOCK_SIZE
+    assert stats['cache_hits'] + stats['cache_misses'] == 4 * 8
+    assert stats['cpu_ms'] > 0
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+from types import SimpleNamespace
+
+from bt.message import (HaveMessage, InterestedMessage, RequestMessage,
+                        PieceMessage)
+from bt.writer import MessageWriter
+
+
+class Transport:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+def test_messages_of_one_iteration_are_written_once(run):
+    transport = Transport()
+    writer = MessageWriter(transport)
+    messages = [InterestedMessage(), RequestMessage(0, 0), HaveMessage(3)]
+
+    async def send():
+        for message in messages:
+            writer.send(message)
+            await writer.drain()
+        await asyncio.sleep(0)
+
+    run(send())
+    assert transport.writes == [b''.join(m.encode() for m in messages)]
+
+
+def test_sendfile_streams_the_file_after_the_header(tmpdir, run):
+    path = tmpdir.join('data.bin')
+    path.write_binary(bytes(range(256)) * 64)
+    fd = os.open(str(path), os.O_RDONLY)
+    header = PieceMessage.header(1, 512, 1000)
+
+    async def main():
+        # Without a socket the block is read and queued with the header
+        transport = Transport()
+        writer = MessageWriter(transport)
+        writer.sendfile(header, fd, 512, 1000)
+        writer.flush()
+        assert transport.writes == [
+            header + (bytes(range(256)) * 64)[512:1512]]
+
+        loop = asyncio.get_event_loop()
+        received = bytearray()
+        done = loop.create_future()
+
+        class Receiver(asyncio.Protocol):
+            def data_received(self, data):
+                received.extend(data)
+                if len(received) >= len(header) + 2 * 1000:
+                    done.set_result(None)
+
+        server = await loop.create_server(Receiver, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        transport, _ = await loop.create_connection(
+            asyncio.Protocol, '127.0.0.1', port)
+        writer = MessageWriter(transport, sendfile=True)
+        sent = MessageWriter.stats['sendfile']
+        with writer.corked():
+            writer.sendfile(header, fd, 512, 1000)
+            writer.write(b'x' * 1000)
+        await asyncio.wait_for(done, 1)
+        assert MessageWriter.stats['sendfile'] == sent + 1
+        transport.close()
+        server.close()
+        await server.wait_closed()
+        return bytes(received)
+
+    try:
+        received = run(main())
+    finally:
+        os.close(fd)
+    assert received == header + (bytes(range(256)) * 64)[512:1512] + \
+        b'x' * 1000
+
+
+def test_failed_sendfile_falls_back_to_reading(tmpdir, monkeypatch, loop):
+    path = tmpdir.join('data.bin')
+    path.write_binary(bytes(range(256)))
+    fd = os.open(str(path), os.O_RDONLY)
+
+    def sendfile(*args):
+        raise OSError('not supported')
+
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    transport = Transport()
+    writer = MessageWriter(transport)
+    writer.socket = SimpleNamespace(fileno=lambda: -1)
+    sent = MessageWriter.stats['sendfile']
+    try:
+        writer.sendfile(b'h', fd, 16, 100)
+    finally:
+        os.close(fd)
+    writer.flush()
+    assert b''.join(transport.writes) == b'h' + bytes(range(16, 116))
+    assert writer.socket is None
+    assert MessageWriter.stats['sendfile'] == sent